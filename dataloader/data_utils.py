@@ -1,14 +1,24 @@
 # Copyright (c) 2023 Gengshan Yang, Carnegie Mellon University.
+import atexit
+import bisect
 import configparser
 import glob
+import hashlib
+import json
 import os
 import random
+import resource
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from multiprocessing import resource_tracker, shared_memory
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, default_collate, default_convert
 
 from utils.numpy_utils import pca_numpy
+from utils.pack_utils import from_tiles, read_pack_header, tile_view
 
 
 class FrameInfo:
@@ -32,6 +42,677 @@ class FrameInfo:
         self.frame_map = [int(path.split("/")[-1].split(".")[0]) for path in ref_list]
 
 
+class MmapPool:
+    """Process-wide pool of read-only np.memmap handles with LRU eviction.
+
+    Each handle keeps a file descriptor and a virtual memory mapping alive, so
+    opening every modality of thousands of videos at once exceeds
+    `ulimit -n`. The pool bounds both the number of open handles and the total
+    number of mapped bytes; evicted files are transparently reopened on their
+    next access. Each DataLoader worker process holds its own pool.
+
+    Args:
+        max_open (int or None): Maximum number of open handles. Defaults to
+            half of the soft limit on open files
+        max_bytes (int or None): Maximum total size of mapped files, in bytes.
+            No limit if None
+    Attributes:
+        hits (int): Number of accesses served by an open handle
+        misses (int): Number of accesses that (re)opened a file
+        evictions (int): Number of handles closed to respect the bounds
+    """
+
+    def __init__(self, max_open=None, max_bytes=None):
+        if max_open is None:
+            soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+            if soft_limit == resource.RLIM_INFINITY:
+                soft_limit = 2048
+            max_open = max(1, min(1024, soft_limit // 2))
+        self.max_open = max_open
+        self.max_bytes = max_bytes
+        self.handles = OrderedDict()
+        self.mapped_bytes = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Reset hit/miss/eviction counters"""
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path, raw=False):
+        """Return an open memmap for a .npy file, opening it if needed
+
+        Args:
+            path (str): Path to a .npy file
+            raw (bool): If True, map the whole file as uint8 bytes instead of
+                parsing a .npy header
+        Returns:
+            array (np.memmap): Read-only memory-mapped array
+        """
+        array = self.handles.get(path)
+        if array is not None:
+            self.handles.move_to_end(path)
+            self.hits += 1
+            return array
+
+        self.misses += 1
+        if raw:
+            array = np.memmap(path, dtype=np.uint8, mode="r")
+        else:
+            array = np.load(path, mmap_mode="r")
+        self.handles[path] = array
+        self.mapped_bytes += array.nbytes
+        self.evict()
+        return array
+
+    def evict(self):
+        """Close least recently used handles until the pool is within bounds.
+        The most recent handle is always kept open.
+        """
+        while len(self.handles) > 1 and (
+            len(self.handles) > self.max_open
+            or (self.max_bytes is not None and self.mapped_bytes > self.max_bytes)
+        ):
+            _, array = self.handles.popitem(last=False)
+            self.mapped_bytes -= array.nbytes
+            self.evictions += 1
+
+    def resize(self, max_open=None, max_bytes=None):
+        """Change the bounds of the pool, evicting handles if needed
+
+        Args:
+            max_open (int or None): New maximum number of open handles, if given
+            max_bytes (int or None): New maximum number of mapped bytes, if given
+        """
+        if max_open is not None:
+            self.max_open = max_open
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self.evict()
+
+    def close(self, path):
+        """Close the handle of a file, if open, e.g. after it is rewritten
+
+        Args:
+            path (str): Path to a .npy file
+        """
+        array = self.handles.pop(path, None)
+        if array is not None:
+            self.mapped_bytes -= array.nbytes
+
+    def clear(self):
+        """Close all handles in the pool"""
+        self.handles.clear()
+        self.mapped_bytes = 0
+
+    def stats(self):
+        """Return pool counters, useful for sizing the pool
+
+        Returns:
+            stats (Dict): Hits, misses, evictions, open handles, and mapped bytes
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "num_open": len(self.handles),
+            "mapped_bytes": self.mapped_bytes,
+        }
+
+
+mmap_pool = MmapPool()
+
+
+class MmapArray:
+    """Lazy handle to a .npy file whose memmap is owned by `mmap_pool`.
+    Behaves like the underlying read-only array for indexing and attribute
+    access, and only holds the path, so it is cheap to pickle to workers.
+
+    Args:
+        path (str): Path to a .npy file
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def array(self):
+        return mmap_pool.get(self.path)
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+    def __len__(self):
+        return len(self.array)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.array, dtype=dtype)
+
+    def __getattr__(self, name):
+        # Avoid recursion during unpickling, before `path` is set
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.array, name)
+
+
+def eval_res_cache(path, cache_path, num_entries, resize_fn):
+    """Return per-frame data resized to the evaluation resolution, cached in a
+    .npy file that is written once. The cache is rebuilt if the size or
+    modification time of the source file changes.
+
+    Args:
+        path (str): Source file of the frame data
+        cache_path (str): Path to the cached .npy file
+        num_entries (int): Number of entries in the source data
+        resize_fn (Function): Maps an entry id to the resized (...) entry
+    Returns:
+        array (MmapArray): (num_entries, ...) Resized entries
+    """
+    stat = os.stat(path)
+    meta = {
+        "source": os.path.abspath(path),
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+    }
+    meta_path = cache_path.replace(".npy", ".json")
+    if os.path.exists(cache_path) and os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            if json.load(f) == meta:
+                return MmapArray(cache_path)
+
+    # write to temporary files and rename, since several processes may
+    # build the same cache
+    tmp_path = cache_path.replace(".npy", "-%d.tmp.npy" % os.getpid())
+    entry = resize_fn(0)
+    array = np.lib.format.open_memmap(
+        tmp_path, mode="w+", dtype=entry.dtype, shape=(num_entries,) + entry.shape
+    )
+    array[0] = entry
+    for it in range(1, num_entries):
+        array[it] = resize_fn(it)
+    array.flush()
+    del array
+    os.replace(tmp_path, cache_path)
+    mmap_pool.close(cache_path)
+
+    tmp_meta_path = tmp_path.replace(".npy", ".json")
+    with open(tmp_meta_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_meta_path, meta_path)
+    return MmapArray(cache_path)
+
+
+@lru_cache(maxsize=8)
+def pixel_grid(h, w):
+    """Homogeneous pixel coordinates of an image, memoized per size.
+    The returned array is shared and should not be modified in place.
+
+    Args:
+        h (int): Image height
+        w (int): Image width
+    Returns:
+        hxy (np.array): (h,w,3) Pixel coordinates (x, y, 1), float32
+    """
+    x0, y0 = np.meshgrid(range(w), range(h))
+    hxy = np.stack([x0, y0, np.ones_like(x0)], axis=-1)
+    return hxy.astype(np.float32)
+
+
+class SharedMemoryStore:
+    """Per-process registry of dataset arrays resident in POSIX shared memory.
+
+    One process (local rank 0) creates each segment and copies the data in;
+    the other ranks, and all DataLoader workers, attach to the same pages, so
+    host RAM does not grow with the number of ranks and workers. Segments are
+    named after the source file and its modification time. The first byte of
+    a segment flags that the copy has finished, followed by the pid of the
+    process that owns the segment, so that segments of a crashed run are
+    reused if complete, and recreated otherwise.
+
+    Attributes:
+        budget (int): Maximum number of bytes to place in shared memory
+        used_bytes (int): Number of bytes placed in shared memory so far
+    """
+
+    header_size = 64  # bytes before the array data
+    pid_offset = 8  # byte 0 is the ready flag, bytes 8-16 the owner pid
+
+    def __init__(self):
+        self.budget = 0
+        self.used_bytes = 0
+        self.segments = {}
+        self.created = []
+        atexit.register(self.unlink)
+
+    def share(self, name, src, create, timeout=600):
+        """Place an array in shared memory if it fits in the budget
+
+        Args:
+            name (str): Name of the shared memory segment
+            src: (N, ...) Array-like source data, copied entry by entry
+            create (bool): If True, create the segment and copy the data.
+                Otherwise wait for another process to do so
+            timeout (float): Seconds to wait for another process
+        Returns:
+            array (SharedArray or None): Shared array, or None if the array
+                does not fit in the budget or could not be attached
+        """
+        shape = tuple(src.shape)
+        dtype = np.dtype(src.dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if self.used_bytes + nbytes > self.budget:
+            return None
+
+        if name not in self.segments:
+            if create and not self.reuse(name):
+                try:
+                    shm = shared_memory.SharedMemory(
+                        name=name, create=True, size=self.header_size + nbytes
+                    )
+                    # processes may share a resource tracker, so segments are
+                    # untracked and unlinked explicitly at exit
+                    resource_tracker.unregister(shm._name, "shared_memory")
+                    self.segments[name] = shm
+                    self.created.append(name)
+                    self.set_owner(shm)
+                    dst = np.ndarray(
+                        shape, dtype=dtype, buffer=shm.buf, offset=self.header_size
+                    )
+                    for i in range(shape[0]):
+                        dst[i] = np.asarray(src[i])
+                    shm.buf[0] = 1
+                except FileExistsError:  # being created by a live process
+                    pass
+            if not self.attach(name, timeout=timeout):
+                print("Warning: cannot attach shared memory %s, using mmap" % name)
+                return None
+
+        self.used_bytes += nbytes
+        return SharedArray(name, shape, dtype)
+
+    def set_owner(self, shm):
+        """Record this process as the owner of a segment"""
+        offset = self.pid_offset
+        shm.buf[offset : offset + 8] = np.int64(os.getpid()).tobytes()
+
+    def owner_alive(self, shm):
+        """Whether the process that owns a segment is still running. A segment
+        whose owner is not recorded yet is being created, and counts as alive
+        """
+        offset = self.pid_offset
+        pid = int(np.frombuffer(shm.buf[offset : offset + 8], dtype=np.int64)[0])
+        if pid <= 0:
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:  # running as another user
+            return True
+        return True
+
+    def reuse(self, name):
+        """Handle a segment left behind by a crashed run. A complete segment is
+        adopted by this process, and unlinked at exit. A partial one is
+        unlinked, such that it can be created again
+
+        Args:
+            name (str): Name of the shared memory segment
+        Returns:
+            reused (bool): Whether the existing segment was adopted
+        """
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            return False
+        resource_tracker.unregister(shm._name, "shared_memory")
+        if self.owner_alive(shm):  # created or being created by another process
+            shm.close()
+            return False
+
+        if shm.buf[0] == 1:
+            self.set_owner(shm)
+            self.segments[name] = shm
+            self.created.append(name)
+            return True
+
+        print("Warning: removing partial shared memory %s of a crashed run" % name)
+        # SharedMemory.unlink() unregisters the segment from the tracker
+        resource_tracker.register(shm._name, "shared_memory")
+        shm.unlink()
+        shm.close()
+        return False
+
+    def attach(self, name, timeout=600):
+        """Attach to a segment, waiting until its creator has filled it. If the
+        creator dies first, wait for the segment to be created again
+
+        Args:
+            name (str): Name of the shared memory segment
+            timeout (float): Seconds to wait
+        Returns:
+            success (bool): Whether the segment is attached and ready
+        """
+        start = time.time()
+        while True:
+            if name not in self.segments:
+                try:
+                    shm = shared_memory.SharedMemory(name=name)
+                    # the creator owns the segment, do not unlink it on exit
+                    resource_tracker.unregister(shm._name, "shared_memory")
+                    self.segments[name] = shm
+                except FileNotFoundError:
+                    pass
+
+            shm = self.segments.get(name)
+            if shm is not None:
+                if shm.buf[0] == 1:
+                    return True
+                if not self.owner_alive(shm):
+                    # partial segment of a crashed run, reopen it by name
+                    del self.segments[name]
+                    shm.close()
+
+            if time.time() - start > timeout:
+                return False
+            time.sleep(0.1)
+
+    def unlink(self):
+        """Remove the segments created or adopted by this process. Processes
+        that are attached keep their mappings until they exit. Complete
+        segments left behind by a crash are adopted by the next run if the
+        source files are unchanged, partial ones are recreated, see `reuse`.
+        """
+        for name in self.created:
+            shm = self.segments[name]
+            # SharedMemory.unlink() unregisters the segment from the tracker
+            resource_tracker.register(shm._name, "shared_memory")
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+        self.created = []
+
+
+shm_store = SharedMemoryStore()
+
+
+class SharedArray:
+    """Array backed by a segment of `shm_store`. Pickling only stores the
+    segment name, so DataLoader workers attach without copying the data.
+
+    Args:
+        name (str): Name of the shared memory segment
+        shape (Tuple(int)): Shape of the array
+        dtype (np.dtype): Data type of the array
+    """
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.attach()
+
+    def attach(self):
+        if not shm_store.attach(self.name):
+            raise RuntimeError("Cannot attach shared memory %s" % self.name)
+        self.array = np.ndarray(
+            self.shape,
+            dtype=self.dtype,
+            buffer=shm_store.segments[self.name].buf,
+            offset=SharedMemoryStore.header_size,
+        )
+
+    def __getstate__(self):
+        return {"name": self.name, "shape": self.shape, "dtype": self.dtype.str}
+
+    def __setstate__(self, state):
+        self.__init__(state["name"], state["shape"], state["dtype"])
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.array, dtype=dtype)
+
+    def __getattr__(self, name):
+        # Avoid recursion during unpickling, before `array` is set
+        if name.startswith("__") or name == "array":
+            raise AttributeError(name)
+        return getattr(self.array, name)
+
+
+def shm_name(path, key):
+    """Name of the shared memory segment holding an array of a file. Includes
+    the file modification time, such that stale segments are not reused.
+
+    Args:
+        path (str): Path to the source file
+        key (str): Name of the array within the file
+    Returns:
+        name (str): Segment name
+    """
+    stat = os.stat(path)
+    uid = "%s:%s:%d:%d" % (os.path.abspath(path), key, stat.st_mtime_ns, stat.st_size)
+    return "reacto-%s" % hashlib.sha1(uid.encode("utf-8")).hexdigest()[:24]
+
+
+class TiledView:
+    """(H,W,...) image interface over a tiled entry of a packed file. Pixel
+    gathers are mapped to tile coordinates without copying the entry.
+
+    Args:
+        tiles (np.array): (H/T, W/T, T, T, ...) Tiles of the entry
+    """
+
+    def __init__(self, tiles):
+        self.tiles = tiles
+        self.tile_size = tiles.shape[2]
+        self.dtype = tiles.dtype
+        self.shape = (
+            tiles.shape[0] * self.tile_size,
+            tiles.shape[1] * self.tile_size,
+        ) + tiles.shape[4:]
+
+    def __getitem__(self, index):
+        # fast path for pixel gathers: image[ys, xs]
+        if isinstance(index, tuple) and len(index) == 2:
+            ys, xs = index
+            if isinstance(ys, np.ndarray) and isinstance(xs, np.ndarray):
+                ty, iy = np.divmod(ys, self.tile_size)
+                tx, ix = np.divmod(xs, self.tile_size)
+                return self.tiles[ty, tx, iy, ix]
+        return np.asarray(self)[index]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        image = from_tiles(self.tiles)
+        if dtype is not None:
+            image = image.astype(dtype)
+        return image
+
+    def astype(self, dtype):
+        return np.asarray(self, dtype=dtype)
+
+
+class PackedArray:
+    """Zero-copy view of one key of a packed sample file written by
+    `utils.pack_utils.write_pack()`. Indexing with an entry id returns a view
+    into the memory-mapped file; other indexing materializes all entries.
+
+    Args:
+        path (str): Path to a packed file
+        key (str): Key of the array to read
+        header (Dict): Output of `read_pack_header()` for this file
+    """
+
+    def __init__(self, path, key, header):
+        meta = header["arrays"][key]
+        self.path = path
+        self.key = key
+        self.dtype = np.dtype(meta["dtype"])
+        self.shape = (len(meta["offsets"]),) + tuple(meta["shape"])
+        self.offsets = np.asarray(meta["offsets"], dtype=np.int64) + header["data_start"]
+        self.tile_size = meta.get("tile_size")
+        self.tile_strides = meta.get("tile_strides")
+
+    def entry(self, index):
+        """Return a single entry as a read-only view into the file
+
+        Args:
+            index (int): Entry id
+        Returns:
+            entry (np.array or TiledView): (...) Entry data
+        """
+        buffer = mmap_pool.get(self.path, raw=True)
+        if self.tile_size is not None:
+            tiles = tile_view(
+                buffer,
+                self.offsets[index],
+                self.shape[1:],
+                self.dtype,
+                self.tile_size,
+                self.tile_strides[index],
+            )
+            return TiledView(tiles)
+        return np.ndarray(
+            self.shape[1:], dtype=self.dtype, buffer=buffer, offset=self.offsets[index]
+        )
+
+    def gather(self, indices, ys, xs):
+        """Gather pixels from several entries
+
+        Args:
+            indices (np.array): (M,) Entry ids
+            ys (np.array): (M,N) Pixel rows to read from each entry
+            xs (np.array): (M,N) Pixel columns to read from each entry
+        Returns:
+            pixels (np.array): (M,N,...) Gathered pixels
+        """
+        pixels = np.empty(ys.shape + self.shape[3:], dtype=self.dtype)
+        for it, index in enumerate(indices):
+            pixels[it] = self.entry(index)[ys[it], xs[it]]
+        return pixels
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self.entry(index)
+        if isinstance(index, tuple) and isinstance(index[0], (int, np.integer)):
+            return self.entry(index[0])[index[1:]]
+        if (
+            isinstance(index, tuple)
+            and len(index) == 3
+            and isinstance(index[0], np.ndarray)
+            and index[0].shape[-1:] == (1,)
+        ):
+            # array[ids[:, None], ys, xs], as used by bilinear_interp
+            return self.gather(index[0][:, 0], index[1], index[2])
+        return np.asarray(self)[index]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        array = np.stack([self.entry(i) for i in range(len(self))], 0)
+        if dtype is not None:
+            array = array.astype(dtype)
+        return array
+
+    def reshape(self, *shape):
+        return np.asarray(self).reshape(*shape)
+
+
+def load_packed(path, header=None):
+    """Open all per-frame arrays in a packed sample file
+
+    Args:
+        path (str): Path to a packed file
+        header (Dict or None): Output of `read_pack_header()`, read if None
+    Returns:
+        mmap_list (Dict): Maps "rgb", "mask", etc. to a PackedArray, and
+            "flowfw"/"flowbw" to a dict from frame delta to a PackedArray
+    """
+    if header is None:
+        header = read_pack_header(path)
+    mmap_list = {}
+    for key in header["arrays"].keys():
+        if key.startswith("flowfw_") or key.startswith("flowbw_"):
+            k, delta = key.split("_")
+            if k not in mmap_list:
+                mmap_list[k] = {}
+            mmap_list[k][int(delta)] = PackedArray(path, key, header)
+        else:
+            mmap_list[key] = PackedArray(path, key, header)
+    return mmap_list
+
+
+class ConcatDataset(torch.utils.data.ConcatDataset):
+    """ConcatDataset that forwards batched fetches to the datasets it contains.
+    Indices are grouped by dataset, each group is loaded with the dataset's
+    `__getitems__` if it has one, and the results are concatenated in the
+    original order.
+    """
+
+    def __getitems__(self, indices):
+        # group indices by dataset object, as duplicated datasets are shared
+        groups = {}
+        for it, idx in enumerate(indices):
+            dataset_idx = bisect.bisect_right(self.cumulative_sizes, idx)
+            if dataset_idx > 0:
+                idx = idx - self.cumulative_sizes[dataset_idx - 1]
+            dataset = self.datasets[dataset_idx]
+            if id(dataset) not in groups:
+                groups[id(dataset)] = (dataset, [], [])
+            groups[id(dataset)][1].append(it)
+            groups[id(dataset)][2].append(idx)
+
+        order = []
+        batches = []
+        for dataset, its, sample_indices in groups.values():
+            if hasattr(dataset, "__getitems__"):
+                batch = dataset.__getitems__(sample_indices)
+            else:
+                batch = stack_data_dicts([dataset[idx] for idx in sample_indices])
+            batches.append(batch)
+            order += its
+
+        inv_order = np.argsort(order)
+        batch = {}
+        for k in batches[0].keys():
+            batch[k] = np.concatenate([b[k] for b in batches], 0)[inv_order]
+        return batch
+
+
+def stack_data_dicts(data_dicts):
+    """Stack a list of data dicts along a new batch dimension
+
+    Args:
+        data_dicts (List(Dict)): Per-sample data dicts with the same keys
+    Returns:
+        data_dict (Dict): Maps each key to a (B, ...) array
+    """
+    return {k: np.stack([d[k] for d in data_dicts], 0) for k in data_dicts[0].keys()}
+
+
+def collate_data(batch):
+    """Collate function that accepts batches already stacked by `__getitems__`
+
+    Args:
+        batch (Dict or List(Dict)): A stacked data dict, or a list of samples
+    Returns:
+        batch (Dict): Maps each key to a (B, ...) tensor
+    """
+    if isinstance(batch, dict):
+        return default_convert(batch)
+    return default_collate(batch)
+
+
 def train_loader(opts_dict):
     """Construct the training dataloader.
 
@@ -69,6 +750,116 @@ def train_loader(opts_dict):
         # worker_init_fn=_init_fn,
         pin_memory=True,
         sampler=sampler,
+        collate_fn=collate_data,
+    )
+    return dataloader
+
+
+class DeviceLoader:
+    """Training loader for datasets resident on a device, see
+    `VidDatasetDevice`. Each iteration samples random first frame ids, and
+    each video loads its share of the batch with batched torch ops.
+
+    By default all random numbers are drawn from the numpy random stream, as
+    `VidDataset`, such that a fixed seed gives the same samples as the host
+    path. With `device_rng`, they are drawn from a torch.Generator on the
+    device instead.
+
+    Args:
+        dataset (ConcatDataset): Concatenation of `VidDatasetDevice`
+        batch_size (int): Number of samples per batch
+        num_iters (int): Number of batches per epoch
+        seed (int or None): Seed of the random number generator
+        device_rng (bool): If True, sample on the device
+    """
+
+    def __init__(self, dataset, batch_size, num_iters, seed=None, device_rng=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_iters = num_iters
+        if device_rng:
+            device = dataset.datasets[0].device
+            self.generator = torch.Generator(device=device)
+            if seed is not None:
+                self.generator.manual_seed(seed)
+            else:
+                self.generator.seed()
+        else:
+            self.generator = None
+            if seed is not None:
+                np.random.seed(seed)
+
+    def __len__(self):
+        return self.num_iters
+
+    def __iter__(self):
+        for _ in range(self.num_iters):
+            yield self.sample_batch()
+
+    def sample_batch(self):
+        """Load a batch of random samples
+
+        Returns:
+            batch (Dict): Maps each key to a (B, 2, ...) tensor on the device
+        """
+        if self.generator is None:
+            indices = np.random.randint(len(self.dataset), size=self.batch_size)
+            indices = indices.tolist()
+        else:
+            indices = torch.randint(
+                len(self.dataset),
+                (self.batch_size,),
+                generator=self.generator,
+                device=self.generator.device,
+            ).tolist()
+
+        # group indices by dataset
+        groups = {}
+        for it, idx in enumerate(indices):
+            dataset_idx = bisect.bisect_right(self.dataset.cumulative_sizes, idx)
+            if dataset_idx > 0:
+                idx = idx - self.dataset.cumulative_sizes[dataset_idx - 1]
+            if dataset_idx not in groups:
+                groups[dataset_idx] = ([], [])
+            groups[dataset_idx][0].append(it)
+            groups[dataset_idx][1].append(idx)
+
+        order = []
+        batches = []
+        for dataset_idx, (its, sample_indices) in groups.items():
+            dataset = self.dataset.datasets[dataset_idx]
+            batches.append(dataset.sample_batch(sample_indices, self.generator))
+            order += its
+
+        inv_order = torch.argsort(torch.tensor(order))
+        batch = {}
+        for k in batches[0].keys():
+            batch[k] = torch.cat([b[k] for b in batches], 0)[inv_order]
+        return batch
+
+
+def train_loader_device(opts_dict):
+    """Construct the training loader for device-resident datasets.
+    `opts_dict["dataset_constructor"]` should be `VidDatasetDevice`.
+
+    Args:
+        opts_dict (Dict): Defined in Trainer::construct_dataset_opts()
+    Returns:
+        dataloader (DeviceLoader): Training dataloader
+    """
+    print("# iterations per round: %d" % opts_dict["iters_per_round"])
+    print("# image samples per iteration: %d" % opts_dict["imgs_per_gpu"])
+    print("# pixel samples per image: %d" % opts_dict["pixels_per_image"])
+
+    # each video is uploaded once, no need to duplicate
+    opts_dict = dict(opts_dict, multiply=False)
+    dataset = config_to_dataset(opts_dict)
+    dataloader = DeviceLoader(
+        dataset,
+        batch_size=opts_dict["imgs_per_gpu"],
+        num_iters=opts_dict["iters_per_round"],
+        seed=opts_dict.get("seed", None),
+        device_rng=opts_dict.get("device_rng", False),
     )
     return dataloader
 
@@ -91,6 +882,7 @@ def eval_loader(opts_dict):
         drop_last=False,
         pin_memory=True,
         shuffle=False,
+        collate_fn=collate_data,
     )
     return dataset
 
@@ -141,7 +933,7 @@ def config_to_dataset(opts, is_eval=False, gpuid=[]):
         vid_per_gpu = int(np.ceil(len(datalist) / gpuid[1]))
         id_start = gpuid[0] * vid_per_gpu
         datalist = datalist[id_start : id_start + vid_per_gpu]
-    dataset = torch.utils.data.ConcatDataset(datalist)
+    dataset = ConcatDataset(datalist)
     return dataset
 
 
@@ -7,8 +7,21 @@ import cv2
 import torch
 from torch.utils.data import Dataset
 
-from utils.numpy_utils import bilinear_interp
-from dataloader.data_utils import FrameInfo
+from utils.numpy_utils import bilinear_interp, normalize_feature
+from utils.pack_utils import read_pack_header
+from utils.torch_utils import bilinear_interp_batch
+from dataloader.data_utils import (
+    FrameInfo,
+    MmapArray,
+    PackedArray,
+    eval_res_cache,
+    load_packed,
+    mmap_pool,
+    pixel_grid,
+    shm_name,
+    shm_store,
+    stack_data_dicts,
+)
 
 
 class RangeSampler:
@@ -59,19 +72,37 @@ class VidDataset(Dataset):
     def __init__(self, opts, rgblist, dataid, ks, raw_size):
         self.delta_list = opts["delta_list"]
         self.field_type = opts["field_type"]
+        self.feature_type = opts["feature_type"]
         self.dict_list = self.construct_data_list(
             rgblist, opts["data_prefix"], opts["feature_type"]
         )
         self.pixels_per_image = opts["pixels_per_image"]
+        # if > 0 and the data is tiled on disk, sample pixels from a few tiles
+        self.tiles_per_image = opts.get("tiles_per_image", 0)
         self.dataid = dataid
         self.load_pair = opts["load_pair"]
         self.ks = ks
         self.raw_size = raw_size
-        self.img_size = np.load(self.dict_list["rgb"]).shape[1:3]  # (H, W)
         self.res = (opts["eval_res"], opts["eval_res"])
+        # if True, full frames resized to eval_res are cached on disk
+        self.eval_cache = opts.get("eval_cache", True)
+        self.eval_list = {}
         self.load_data_list(self.dict_list)
 
+        # optionally keep frame data in shared memory, shared by all processes
+        shm_budget_gb = opts.get("shm_budget_gb", 0)
+        if shm_budget_gb > 0:
+            shm_store.budget = int(shm_budget_gb * (1 << 30))
+            self.share_data_list(is_creator=opts.get("local_rank", 0) == 0)
+
         self.idx_sampler = RangeSampler(num_elems=self.img_size[0] * self.img_size[1])
+        self.tile_size = getattr(self.mmap_list["rgb"], "tile_size", None)
+        if self.tile_size is not None:
+            self.num_tiles = (
+                self.img_size[0] // self.tile_size,
+                self.img_size[1] // self.tile_size,
+            )
+            self.tile_sampler = RangeSampler(num_elems=np.prod(self.num_tiles))
         self.frame_info = FrameInfo(self.dict_list["ref"])
 
     def construct_data_list(self, reflist, prefix, feature_type):
@@ -92,6 +123,7 @@ class VidDataset(Dataset):
         flowbw_path = rgb_path.replace("JPEGImages", "FlowBW")
         depth_path = rgb_path.replace("JPEGImages", "Depth")
         normal_path = rgb_path.replace("JPEGImages", "Normal")
+        packed_path = rgb_path.replace("JPEGImages", "Packed").replace(".npy", ".npk")
         if self.field_type == "bg":
             group_id = 0
         else:
@@ -137,6 +169,7 @@ class VidDataset(Dataset):
             "feature": feature_path,
             "crop2raw": crop2raw_path,
             "is_detected": is_detected_path,
+            "packed": packed_path,
         }
 
     def load_data_list(self, dict_list):
@@ -154,24 +187,40 @@ class VidDataset(Dataset):
 
         # load all .npy files using mmap
         # The number of open files is bounded by `ulimit -S -n` and `ulimit -H -n`,
-        # both of which could be easily exceeded by many videos.
+        # both of which could be easily exceeded by many videos. Handles are
+        # owned by a process-wide LRU pool and reopened lazily after eviction.
         self.mmap_list = {}
+
+        # a packed file stores all per-frame modalities of a video in one file
+        packed_list = self.load_packed_list(dict_list)
+
+        if "rgb" in packed_list:
+            self.img_size = packed_list["rgb"].shape[1:3]  # (H, W)
+        else:
+            self.img_size = mmap_pool.get(dict_list["rgb"]).shape[1:3]  # (H, W)
+
         for k, path in dict_list.items():
-            if k in ("ref", "cambg", "camfg", "crop2raw", "is_detected"):
+            if k in ("ref", "cambg", "camfg", "crop2raw", "is_detected", "packed"):
                 continue
 
             if k in ("flowfw", "flowbw"):
                 self.mmap_list[k] = {}
                 for delta in [1] + self.delta_list:
-                    path_delta = path.replace("FlowFW", f"FlowFW_{delta}").replace(
-                        "FlowBW", f"FlowBW_{delta}"
-                    )
+                    if delta in packed_list.get(k, {}):
+                        self.mmap_list[k][delta] = packed_list[k][delta]
+                        continue
+                    path_delta = self.flow_path(path, delta)
                     if os.path.exists(path_delta):
-                        self.mmap_list[k][delta] = np.load(path_delta, mmap_mode="r")
+                        self.mmap_list[k][delta] = MmapArray(path_delta)
+                continue
+
+            if k in packed_list:
+                self.mmap_list[k] = packed_list[k]
                 continue
 
             try:
-                self.mmap_list[k] = np.load(path, mmap_mode="r")
+                mmap_pool.get(path)
+                self.mmap_list[k] = MmapArray(path)
             except:
                 print(f"Warning: cannot load {path}")
                 if k=="feature":
@@ -180,6 +229,94 @@ class VidDataset(Dataset):
                     self.mmap_list[k] = np.random.rand(self.__len__() + 1, self.img_size[0], self.img_size[1], 3)
 
 
+    @staticmethod
+    def flow_path(path, delta):
+        """Path to the flow of a frame distance
+
+        Args:
+            path (str): Flow path from `construct_data_list()`
+            delta (int): Frame distance
+        Returns:
+            path_delta (str): Path to the .npy file of this distance
+        """
+        return path.replace("FlowFW", f"FlowFW_{delta}").replace(
+            "FlowBW", f"FlowBW_{delta}"
+        )
+
+    def load_packed_list(self, dict_list):
+        """Open the packed file of this video, if any. Entries packed with a
+        different feature type, or whose .npy source was modified after
+        packing, are left out such that they are read from the .npy files
+
+        Args:
+            dict_list (Dict(str, List(str))): From `construct_data_list()`
+        Returns:
+            packed_list (Dict): Output of `load_packed()`, without stale entries
+        """
+        path = dict_list["packed"]
+        if not os.path.exists(path):
+            return {}
+        header = read_pack_header(path)
+        packed_list = load_packed(path, header)
+
+        # files packed without metadata are as old as the packed file
+        meta = header["meta"]
+        mtimes = meta.get("mtimes", {})
+        pack_mtime = os.path.getmtime(path)
+
+        if "feature" in packed_list and meta.get("feature_type") != self.feature_type:
+            del packed_list["feature"]
+        for key in list(header["arrays"].keys()):
+            if key.startswith("flowfw_") or key.startswith("flowbw_"):
+                k, delta = key.split("_")
+                src_path = self.flow_path(dict_list[k], int(delta))
+                entries, entry_key = packed_list[k], int(delta)
+            else:
+                src_path = dict_list.get(key)
+                entries, entry_key = packed_list, key
+            if entry_key not in entries or src_path is None:
+                continue
+            if not os.path.exists(src_path):
+                continue
+            if os.path.getmtime(src_path) > mtimes.get(key, pack_mtime):
+                print("Warning: %s is newer than %s, reading .npy" % (src_path, path))
+                del entries[entry_key]
+        return packed_list
+
+    def share_data_list(self, is_creator):
+        """Move memory-mapped frame data into shared memory, in priority order,
+        until `shm_store.budget` is used up. Modalities that do not fit stay
+        memory-mapped.
+
+        Args:
+            is_creator (bool): If True, load the data into shared memory.
+                Otherwise attach to the data loaded by the creator
+        """
+        shared_list = [("rgb", None), ("mask", None)]
+        for delta in sorted(self.mmap_list["flowfw"].keys()):
+            shared_list += [("flowfw", delta), ("flowbw", delta)]
+        shared_list += [("depth", None), ("normal", None), ("feature", None)]
+
+        for k, delta in shared_list:
+            if delta is None:
+                array = self.mmap_list[k]
+            else:
+                array = self.mmap_list[k].get(delta)
+            if isinstance(array, MmapArray):
+                name = shm_name(array.path, k)
+            elif isinstance(array, PackedArray):
+                name = shm_name(array.path, array.key)
+            else:  # missing or placeholder data
+                continue
+
+            shared = shm_store.share(name, array, create=is_creator)
+            if shared is None:
+                continue
+            if delta is None:
+                self.mmap_list[k] = shared
+            else:
+                self.mmap_list[k][delta] = shared
+
     def __len__(self):
         return len(self.dict_list["ref"]) - 1
 
@@ -187,6 +324,53 @@ class VidDataset(Dataset):
         data_dict = self.load_data(index)
         return data_dict
 
+    def __getitems__(self, indices):
+        """Load a batch of samples at once. Equivalent to stacking the outputs
+        of `__getitem__`, but each modality is read with one vectorized gather
+
+        Args:
+            indices (List(int)): First frame id in each pair
+        Returns:
+            data_dict (Dict): Maps keys to (B, 2, ...) data
+        """
+        if self.pixels_per_image == -1:
+            return stack_data_dicts([self.load_data(index) for index in indices])
+
+        frameids, deltas, rand_xy = self.sample_frames(indices)
+        data_dict = self.read_raw_batch(frameids, deltas, rand_xy)
+
+        if self.load_pair:
+            num_pairs = len(indices)
+            for k, v in data_dict.items():
+                data_dict[k] = np.stack([v[:num_pairs], v[num_pairs:]], 1)
+        return data_dict
+
+    def sample_frames(self, indices):
+        """Sample the second frame of each pair and the pixels to load from
+        each frame. Samples follow the same distribution as `load_data`, but
+        the random numbers are drawn in a different order: all deltas first,
+        then the pixels of all frames, and no second frame if pairs are not
+        loaded. The same seed thus gives different samples on both paths
+
+        Args:
+            indices (List(int)): First frame id in each pair
+        Returns:
+            frameids (np.array): (M,) Frame ids to load, first frames then
+                second frames if pairs are loaded
+            deltas (np.array): (M,) Distance to other frame id in each pair
+            rand_xy (np.array): (M, N, 2) Pixels to load from each frame
+        """
+        im0idx = np.asarray(indices)
+        delta = np.asarray([self.sample_delta(index) for index in im0idx])
+        if self.load_pair:
+            frameids = np.concatenate([im0idx, im0idx + delta], 0)
+            deltas = np.concatenate([delta, -delta], 0)
+        else:
+            frameids = im0idx
+            deltas = delta
+        rand_xy = np.stack([self.sample_xy() for _ in frameids], 0)
+        return frameids, deltas, rand_xy
+
     def sample_delta(self, index):
         """Sample random delta frame
 
@@ -212,12 +396,44 @@ class VidDataset(Dataset):
         if self.pixels_per_image == -1:
             return None
 
+        if self.tiles_per_image > 0 and self.tile_size is not None:
+            return self.sample_xy_tiled()
+
         rand_idx = self.idx_sampler.sample(num_samples=self.pixels_per_image)
         y0 = rand_idx % self.img_size[0]
         x0 = rand_idx // self.img_size[0]
         xy = np.stack([x0, y0], axis=-1)  # (num_sample, 2)
         return xy
 
+    def sample_xy_tiled(self):
+        """Sample random pixels from a few random tiles of an image, such that
+        the pixels of a batch are read from a few contiguous ranges on disk
+
+        Returns:
+            xy: (N, 2) Sampled pixels
+        """
+        tile_size = self.tile_size
+        pixels_per_tile = tile_size * tile_size
+        num_tiles = max(
+            self.tiles_per_image, -(-self.pixels_per_image // pixels_per_tile)
+        )
+        num_tiles = min(num_tiles, self.tile_sampler.num_elems)
+        tile_idx = self.tile_sampler.sample(num_samples=num_tiles)
+
+        # sample pixels without replacement within each tile
+        samples_per_tile = min(
+            -(-self.pixels_per_image // num_tiles), pixels_per_tile
+        )
+        inner_idx = np.argsort(np.random.rand(num_tiles, pixels_per_tile), axis=-1)
+        inner_idx = inner_idx[:, :samples_per_tile]
+
+        y0 = (tile_idx // self.num_tiles[1])[:, None] * tile_size
+        x0 = (tile_idx % self.num_tiles[1])[:, None] * tile_size
+        y0 = (y0 + inner_idx // tile_size).reshape(-1)
+        x0 = (x0 + inner_idx % tile_size).reshape(-1)
+        xy = np.stack([x0, y0], axis=-1)[: self.pixels_per_image]  # (num_sample, 2)
+        return xy
+
     def load_data(self, im0idx):
         """Sample pixels from a pair of frames
 
@@ -262,11 +478,10 @@ class VidDataset(Dataset):
         feature = self.read_feature(im0idx, rand_xy=rand_xy)
 
         if rand_xy is None:
-            x0, y0 = np.meshgrid(range(self.img_size[1]), range(self.img_size[0]))
-            hp_crop = np.stack([x0, y0, np.ones_like(x0)], axis=-1)
+            hp_crop = pixel_grid(self.img_size[0], self.img_size[1])
         else:
             hp_crop = np.concatenate([rand_xy, np.ones_like(rand_xy[..., :1])], -1)
-        hp_crop = hp_crop.astype(np.float32)
+            hp_crop = hp_crop.astype(np.float32)
 
         raw_frameid_sub = self.frame_info.frame_map[im0idx]
 
@@ -286,6 +501,83 @@ class VidDataset(Dataset):
         data_dict["hxy"] = hp_crop
         return data_dict
 
+    def read_raw_batch(self, frameids, deltas, rand_xy):
+        """Read sampled pixels of several frames, batched version of `read_raw`.
+        Frames are read in sorted order so that each modality is scanned once
+        in increasing file offset.
+
+        Args:
+            frameids (np.array): (M,) Frame ids to load
+            deltas (np.array): (M,) Distance to other frame id in each pair
+            rand_xy (np.array): (M, N, 2) Pixels to load from each frame
+        Returns:
+            data_dict (Dict): Maps the keys of `read_raw` to (M, ...) data
+        """
+        order = np.argsort(frameids, kind="stable")
+        frameids = frameids[order]
+        deltas = deltas[order]
+        rand_xy = rand_xy[order]
+
+        rgb = self.gather_pixels(self.mmap_list["rgb"], frameids, rand_xy)
+        if rgb.ndim == 2:  # gray image
+            rgb = np.repeat(rgb[..., None], 3, axis=-1)
+        mask = self.gather_pixels(self.mmap_list["mask"], frameids, rand_xy)
+        depth = self.gather_pixels(self.mmap_list["depth"], frameids, rand_xy)
+        normal = self.gather_pixels(self.mmap_list["normal"], frameids, rand_xy)
+        feature = self.read_feature_batch(frameids, rand_xy)
+
+        # flow is stored per (direction, delta), gather each group at once
+        flow = np.zeros(rand_xy.shape[:2] + (3,), dtype=np.float32)
+        for delta in np.unique(deltas):
+            idx = np.where(deltas == delta)[0]
+            abs_delta = abs(delta)
+            if delta > 0:
+                flow_mmap = self.mmap_list["flowfw"][abs_delta]
+                flowids = frameids[idx] // abs_delta
+            else:
+                flow_mmap = self.mmap_list["flowbw"][abs_delta]
+                flowids = frameids[idx] // abs_delta - 1
+            flow[idx] = self.gather_pixels(flow_mmap, flowids, rand_xy[idx])
+
+        hp_crop = np.concatenate([rand_xy, np.ones_like(rand_xy[..., :1])], -1)
+        hp_crop = hp_crop.astype(np.float32)
+
+        data_dict = {}
+        data_dict["rgb"] = rgb
+        data_dict["mask"] = mask[..., :1]
+        data_dict["depth"] = depth[..., None]
+        data_dict["normal"] = normal
+        data_dict["feature"] = feature
+        data_dict["flow"] = flow[..., :2]
+        data_dict["flow_uct"] = flow[..., 2:]
+        data_dict["vis2d"] = mask[..., 1:]
+        data_dict["crop2raw"] = self.crop2raw[frameids]
+        data_dict["is_detected"] = self.is_detected[frameids]
+        data_dict["dataid"] = np.full(len(frameids), self.dataid)
+        data_dict["frameid_sub"] = np.asarray(self.frame_info.frame_map)[frameids]
+        data_dict["hxy"] = hp_crop
+
+        # restore the input order
+        inv_order = np.argsort(order)
+        for k, v in data_dict.items():
+            data_dict[k] = v[inv_order]
+        return data_dict
+
+    @staticmethod
+    def gather_pixels(array, frameids, rand_xy):
+        """Gather pixels from several frames with a single fancy index
+
+        Args:
+            array: (F, H, W, ...) Memory-mapped frame data
+            frameids (np.array): (M,) Sorted frame ids to load
+            rand_xy (np.array): (M, N, 2) Pixels to load from each frame
+        Returns:
+            pixels (np.array): (M, N, ...) Gathered pixels
+        """
+        if isinstance(array, PackedArray):
+            return array.gather(frameids, rand_xy[..., 1], rand_xy[..., 0])
+        return array[frameids[:, None], rand_xy[..., 1], rand_xy[..., 0]]
+
     def read_rgb(self, im0idx, rand_xy=None):
         """Read RGB data for a single frame
 
@@ -298,7 +590,7 @@ class VidDataset(Dataset):
         rgb = self.mmap_list["rgb"][im0idx]
         shape = rgb.shape
         if rand_xy is None:
-            rgb = cv2.resize(rgb.astype(np.float32), self.res)
+            rgb = self.read_eval("rgb", im0idx)
         else:
             rgb = rgb[rand_xy[:, 1], rand_xy[:, 0]]  # N,3
 
@@ -322,8 +614,7 @@ class VidDataset(Dataset):
         """
         mask = self.mmap_list["mask"][im0idx]
         if rand_xy is None:
-            mask = mask.astype(int)
-            mask = cv2.resize(mask, self.res, interpolation=cv2.INTER_NEAREST)
+            mask = self.read_eval("mask", im0idx)
         else:
             mask = mask[rand_xy[:, 1], rand_xy[:, 0]]  # N,3
 
@@ -345,7 +636,7 @@ class VidDataset(Dataset):
         """
         depth = self.mmap_list["depth"][im0idx]
         if rand_xy is None:
-            depth = cv2.resize(depth.astype(np.float32), self.res)
+            depth = self.read_eval("depth", im0idx)
         else:
             depth = depth[rand_xy[:, 1], rand_xy[:, 0]]
 
@@ -362,7 +653,7 @@ class VidDataset(Dataset):
         """
         normal = self.mmap_list["normal"][im0idx]
         if rand_xy is None:
-            normal = cv2.resize(normal.astype(np.float32), self.res)
+            normal = self.read_eval("normal", im0idx)
         else:
             normal = normal[rand_xy[:, 1], rand_xy[:, 0]]
         return normal
@@ -376,15 +667,32 @@ class VidDataset(Dataset):
         Returns:
             feat (np.array): (112,112,16) or (N,16) Feature map, float32
         """
-        feat = self.mmap_list["feature"][im0idx]  # (112,112,16)
         if rand_xy is None:
-            feat = cv2.resize(feat.astype(np.float32), self.res)
-        else:
-            rand_xy = rand_xy / self.img_size[0] * 112
-            feat = bilinear_interp(feat, rand_xy)
-        # normalize
-        feat = feat / (np.linalg.norm(feat, axis=-1, keepdims=True) + 1e-6)
-        feat = feat.astype(np.float32)
+            return self.read_eval("feature", im0idx)
+
+        feat = self.mmap_list["feature"][im0idx]  # (112,112,16)
+        rand_xy = rand_xy / self.img_size[0] * feat.shape[0]
+        feat = bilinear_interp(feat, rand_xy)
+        # normalize, features are unit length at preprocessing but
+        # interpolation and resizing shrink them
+        feat = normalize_feature(feat)
+        return feat
+
+    def read_feature_batch(self, frameids, rand_xy):
+        """Read sampled features of several frames with one interpolation
+
+        Args:
+            frameids (np.array): (M,) Frame ids to load
+            rand_xy (np.array): (M,N,2) Pixels to load from each frame
+        Returns:
+            feat (np.array): (M,N,16) Features, float32
+        """
+        feat = self.mmap_list["feature"]  # (F,112,112,16)
+        # use the underlying array of memmap and shared memory handles
+        feat = getattr(feat, "array", feat)
+        rand_xy = rand_xy / self.img_size[0] * feat.shape[1]
+        feat = bilinear_interp(feat, rand_xy, frameid=frameids)
+        feat = normalize_feature(feat)
         return feat
 
     def read_flow(self, im0idx, delta, rand_xy=None):
@@ -400,15 +708,291 @@ class VidDataset(Dataset):
         is_fw = delta > 0
         delta = abs(delta)
         if is_fw:
-            flow = self.mmap_list["flowfw"][delta][im0idx // delta]
+            k = "flowfw"
+            flowid = im0idx // delta
         else:
-            flow = self.mmap_list["flowbw"][delta][im0idx // delta - 1]
+            k = "flowbw"
+            flowid = im0idx // delta - 1
         if rand_xy is None:
-            flow = cv2.resize(flow.astype(np.float32), self.res)
-            flow[..., 0] *= self.res[1] / self.img_size[1]
-            flow[..., 1] *= self.res[0] / self.img_size[0]
+            flow = self.read_eval(k, flowid, delta=delta)
         else:
+            flow = self.mmap_list[k][delta][flowid]
             flow = flow[rand_xy[:, 1], rand_xy[:, 0]]
 
         flow = flow.astype(np.float32)
         return flow
+
+    def read_eval(self, k, index, delta=None):
+        """Read one entry of frame data resized to the evaluation resolution.
+        Resized entries are cached on disk next to the source data, so repeated
+        evaluation passes only read memory-mapped arrays.
+
+        Args:
+            k (str): Key of `mmap_list`
+            index (int): Entry id
+            delta (int or None): Frame distance, for flow
+        Returns:
+            entry (np.array): (eval_res, eval_res, ...) Resized entry
+        """
+        cache_key = k if delta is None else "%s_%d" % (k, delta)
+        if cache_key not in self.eval_list:
+            self.eval_list[cache_key] = self.load_eval_cache(k, delta=delta)
+
+        eval_array = self.eval_list[cache_key]
+        if eval_array is None:
+            return self.resize_entry(k, index, delta=delta)
+        return np.array(eval_array[index])
+
+    def load_eval_cache(self, k, delta=None):
+        """Load or build the eval-resolution cache of one modality
+
+        Args:
+            k (str): Key of `mmap_list`
+            delta (int or None): Frame distance, for flow
+        Returns:
+            eval_array (MmapArray or None): Resized entries, or None if the
+                data cannot be cached
+        """
+        array = self.mmap_list[k] if delta is None else self.mmap_list[k][delta]
+        path = getattr(array, "path", None)
+        if not self.eval_cache or path is None:  # placeholder or shared data
+            return None
+
+        cache_key = k if delta is None else "%s_%d" % (k, delta)
+        cache_path = os.path.splitext(path)[0] + "-%s-eval%d.npy" % (
+            cache_key,
+            self.res[0],
+        )
+        try:
+            return eval_res_cache(
+                path,
+                cache_path,
+                len(array),
+                lambda index: self.resize_entry(k, index, delta=delta),
+            )
+        except OSError as e:  # e.g. read-only dataset
+            print("Warning: cannot cache %s: %s" % (cache_path, e))
+            return None
+
+    def resize_entry(self, k, index, delta=None):
+        """Resize one entry of frame data to the evaluation resolution
+
+        Args:
+            k (str): Key of `mmap_list`
+            index (int): Entry id
+            delta (int or None): Frame distance, for flow
+        Returns:
+            entry (np.array): (eval_res, eval_res, ...) Resized entry
+        """
+        array = self.mmap_list[k] if delta is None else self.mmap_list[k][delta]
+        entry = array[index]
+        if k == "mask":
+            entry = entry.astype(int)
+            return cv2.resize(entry, self.res, interpolation=cv2.INTER_NEAREST)
+
+        entry = cv2.resize(entry.astype(np.float32), self.res)
+        if k == "feature":
+            entry = normalize_feature(entry)
+        elif k in ("flowfw", "flowbw"):
+            entry[..., 0] *= self.res[1] / self.img_size[1]
+            entry[..., 1] *= self.res[0] / self.img_size[0]
+        return entry
+
+
+class VidDatasetDevice(VidDataset):
+    """Frame data and annotations for a single video, resident on a torch
+    device. Pixel gathers, feature interpolation and normalization run as
+    batched torch ops on the device, so only the sampled frame ids and pixels
+    are copied per iteration. Intended for videos that fit in device memory.
+
+    By default deltas and pixels are sampled on the host by `sample_frames`,
+    so a fixed numpy seed gives the same data as `VidDataset`. Given a
+    torch.Generator, they are sampled on the device instead, which draws
+    from a different random stream.
+
+    Args:
+        opts (Dict): Defined in Trainer::construct_dataset_opts(). The device is
+            given by opts["data_device"] (default "cuda")
+        rgblist (List(str)): List of paths to all RGB frames in this video
+        dataid (int): Video ID
+        ks (List(int)): Camera intrinsics: [fx, fy, cx, cy]
+        raw_size (List(int)): Shape of the raw frames, [H, W]
+    """
+
+    def __init__(self, opts, rgblist, dataid, ks, raw_size):
+        super().__init__(opts, rgblist, dataid, ks, raw_size)
+        self.device = torch.device(opts.get("data_device", "cuda"))
+        self.upload()
+
+    def upload(self):
+        """Copy all frame data and annotations to the device"""
+
+        def to_device(array):
+            return torch.tensor(np.asarray(array), device=self.device)
+
+        self.tensor_list = {}
+        for k, v in self.mmap_list.items():
+            if isinstance(v, dict):
+                self.tensor_list[k] = {delta: to_device(vv) for delta, vv in v.items()}
+            else:
+                self.tensor_list[k] = to_device(v)
+        self.tensor_list["crop2raw"] = to_device(self.crop2raw)
+        self.tensor_list["is_detected"] = to_device(self.is_detected)
+        self.tensor_list["frame_map"] = to_device(self.frame_info.frame_map)
+        self.xy_queue = torch.zeros(0, dtype=torch.long, device=self.device)
+
+    def sample_delta_batch(self, im0idx, generator=None):
+        """Sample a random delta frame for each first index, batched version
+        of `sample_delta`
+
+        Args:
+            im0idx: (M,) First index in each pair
+            generator (torch.Generator or None): Random number generator
+        Returns:
+            delta: (M,) Delta between first and second index
+        """
+        delta_list = torch.tensor([1] + self.delta_list, device=self.device)
+        num_frames = len(self.dict_list["ref"])
+        valid = torch.logical_and(
+            im0idx[:, None] % delta_list == 0, im0idx[:, None] + delta_list < num_frames
+        )
+        valid[:, 0] = True  # delta=1 is always valid
+        idx = torch.multinomial(valid.float(), 1, generator=generator)[:, 0]
+        return delta_list[idx]
+
+    def sample_xy_batch(self, num_frames, generator=None):
+        """Sample random pixels for several frames, batched version of
+        `sample_xy`. Pixels of a frame are sampled without replacement
+
+        Args:
+            num_frames (int): Number of frames M
+            generator (torch.Generator or None): Random number generator
+        Returns:
+            xy: (M, N, 2) Sampled pixels, or None to load full frames
+        """
+        if self.pixels_per_image == -1:
+            return None
+
+        num_elems = self.img_size[0] * self.img_size[1]
+        # as RangeSampler, at most all pixels of a frame are sampled
+        num_samples = min(self.pixels_per_image, num_elems)
+        frames_per_perm = max(num_elems // num_samples, 1)
+        # each frame reads a contiguous slice of a permutation, as RangeSampler
+        num_perms = -(-num_frames // frames_per_perm)
+        rand_idx = torch.stack(
+            [
+                torch.randperm(num_elems, generator=generator, device=self.device)[
+                    : frames_per_perm * num_samples
+                ]
+                for _ in range(num_perms)
+            ],
+            0,
+        )
+        rand_idx = rand_idx.view(-1, num_samples)[:num_frames]
+        y0 = rand_idx % self.img_size[0]
+        x0 = rand_idx // self.img_size[0]
+        xy = torch.stack([x0, y0], -1)  # (M, num_sample, 2)
+        return xy
+
+    def sample_batch(self, indices, generator=None):
+        """Load a batch of samples on the device, equivalent to `__getitems__`
+
+        Args:
+            indices: (B,) First frame id in each pair
+            generator (torch.Generator or None): If given, deltas and pixels
+                are sampled on the device with this generator. Otherwise they
+                are sampled on the host, as `__getitems__`
+        Returns:
+            data_dict (Dict): Maps keys to (B, 2, ...) tensors
+        """
+        if self.pixels_per_image == -1:
+            # full frames are resized on the host
+            data_dict = self.__getitems__(indices)
+            return {k: torch.as_tensor(v, device=self.device) for k, v in data_dict.items()}
+
+        if generator is None:
+            frameids, deltas, rand_xy = self.sample_frames(indices)
+            frameids = torch.as_tensor(frameids, device=self.device)
+            deltas = torch.as_tensor(deltas, device=self.device)
+            rand_xy = torch.as_tensor(rand_xy, device=self.device)
+        else:
+            im0idx = torch.as_tensor(indices, device=self.device)
+            delta = self.sample_delta_batch(im0idx, generator=generator)
+            if self.load_pair:
+                frameids = torch.cat([im0idx, im0idx + delta], 0)
+                deltas = torch.cat([delta, -delta], 0)
+            else:
+                frameids = im0idx
+                deltas = delta
+            rand_xy = self.sample_xy_batch(len(frameids), generator=generator)
+
+        data_dict = self.read_raw_device(frameids, deltas, rand_xy)
+
+        if self.load_pair:
+            num_pairs = len(indices)
+            for k, v in data_dict.items():
+                data_dict[k] = torch.stack([v[:num_pairs], v[num_pairs:]], 1)
+        return data_dict
+
+    def read_raw_device(self, frameids, deltas, rand_xy):
+        """Read sampled pixels of several frames on the device, torch version of
+        `read_raw_batch`
+
+        Args:
+            frameids: (M,) Frame ids to load
+            deltas: (M,) Distance to other frame id in each pair
+            rand_xy: (M, N, 2) Pixels to load from each frame
+        Returns:
+            data_dict (Dict): Maps the keys of `read_raw` to (M, ...) tensors
+        """
+        tensor_list = self.tensor_list
+        frameids = frameids.long()
+        ys = rand_xy[..., 1].long()
+        xs = rand_xy[..., 0].long()
+        fids = frameids[:, None]
+
+        rgb = tensor_list["rgb"][fids, ys, xs]
+        if rgb.ndim == 2:  # gray image
+            rgb = rgb[..., None].repeat(1, 1, 3)
+        mask = tensor_list["mask"][fids, ys, xs]
+        depth = tensor_list["depth"][fids, ys, xs]
+        normal = tensor_list["normal"][fids, ys, xs]
+
+        # feature
+        feat = tensor_list["feature"]
+        # float64 coordinates as `read_raw`, such that features match the host
+        xy_feat = rand_xy.double() / self.img_size[0] * feat.shape[1]
+        feature = bilinear_interp_batch(feat, frameids, xy_feat)
+        norm = torch.sqrt(torch.sum(feature * feature, -1, keepdim=True))
+        feature = feature / (norm + 1e-6)
+
+        # flow is stored per (direction, delta), gather each group at once
+        flow = torch.zeros(rand_xy.shape[:2] + (3,), device=self.device)
+        for delta in torch.unique(deltas).tolist():
+            idx = torch.where(deltas == delta)[0]
+            abs_delta = abs(delta)
+            if delta > 0:
+                flow_tensor = tensor_list["flowfw"][abs_delta]
+                flowids = frameids[idx] // abs_delta
+            else:
+                flow_tensor = tensor_list["flowbw"][abs_delta]
+                flowids = frameids[idx] // abs_delta - 1
+            flow[idx] = flow_tensor[flowids[:, None], ys[idx], xs[idx]].float()
+
+        hp_crop = torch.cat([rand_xy, torch.ones_like(rand_xy[..., :1])], -1)
+
+        data_dict = {}
+        data_dict["rgb"] = rgb
+        data_dict["mask"] = mask[..., :1]
+        data_dict["depth"] = depth[..., None]
+        data_dict["normal"] = normal
+        data_dict["feature"] = feature
+        data_dict["flow"] = flow[..., :2]
+        data_dict["flow_uct"] = flow[..., 2:]
+        data_dict["vis2d"] = mask[..., 1:]
+        data_dict["crop2raw"] = tensor_list["crop2raw"][frameids]
+        data_dict["is_detected"] = tensor_list["is_detected"][frameids]
+        data_dict["dataid"] = torch.full_like(frameids, self.dataid)
+        data_dict["frameid_sub"] = tensor_list["frame_map"][frameids]
+        data_dict["hxy"] = hp_crop.float()
+        return data_dict
@@ -17,37 +17,93 @@ sys.path.insert(
 from flowutils.flowlib import warp_flow
 
 
-@record_function("compute_procrustes")
-def compute_procrustes_robust(pts0, pts1):
+@record_function("compute_procrustes_robust")
+def compute_procrustes_robust(
+    pts0,
+    pts1,
+    num_samples=2000,
+    min_samples=10,
+    batch_size=256,
+    num_eval=2000,
+    confidence=0.99,
+    seed=0,
+):
     """
-    analytical solution of R/t from correspondence
+    RANSAC solution of R/t from correspondence. Hypotheses are drawn and
+    solved in batches, with one batched SVD per batch, and scored on a random
+    subset of the points. Sampling stops once enough hypotheses were drawn
+    to find an all-inlier sample with the given confidence, based on the best
+    inlier ratio so far. R/t is refit on the inliers of the best hypothesis.
+
     pts0: N x 3
     pts1: N x 3
     """
-    num_samples = 2000
-    min_samples = 10
+    num_pts = pts0.shape[0]
+    if num_pts < min_samples:
+        return compute_procrustes(pts0, pts1)
+    rng = np.random.default_rng(seed)
     extent = (pts0.max(0) - pts0.min(0)).mean()
     threshold = extent * 0.05
 
-    inliers = []
-    samples = []
-    idx_array = np.arange(pts0.shape[0])
-    for i in range(num_samples):
-        sample = np.random.choice(idx_array, size=min_samples, replace=False)
-        sol = compute_procrustes(pts0[sample], pts1[sample])
+    eval_idx = rng.choice(num_pts, size=min(num_eval, num_pts), replace=False)
+    eval0 = pts0[eval_idx]
+    eval1 = pts1[eval_idx]
 
-        # evaluate inliers
-        R, t = sol
-        pts2 = R @ pts0.T + t[:, np.newaxis]
-        dist = np.linalg.norm(pts2.T - pts1, 2, axis=1)
-        inliers.append((dist < threshold).sum())
-        samples.append(sample)
+    best_inliers = -1
+    best_sol = None
+    num_drawn = 0
+    while num_drawn < num_samples:
+        # draw with replacement, duplicates are rare and only weaken a sample
+        num_batch = min(batch_size, num_samples - num_drawn)
+        sample = rng.integers(0, num_pts, size=(num_batch, min_samples))
+        rmat, trans = kabsch_batch(pts0[sample], pts1[sample])
+        num_drawn += num_batch
 
-    best_idx = np.argmax(np.sum(inliers, axis=0))
-    print("inlier_ratio: ", np.max(inliers) / pts0.shape[0])
-    best_sample = samples[best_idx]
-    sol = compute_procrustes(pts0[best_sample], pts1[best_sample])
-    return sol
+        # evaluate inliers
+        pts2 = eval0 @ rmat.transpose(0, 2, 1) + trans[:, None]
+        dist = np.linalg.norm(pts2 - eval1, 2, axis=-1)
+        inliers = (dist < threshold).sum(1)
+        best_idx = np.argmax(inliers)
+        if inliers[best_idx] > best_inliers:
+            best_inliers = inliers[best_idx]
+            best_sol = (rmat[best_idx], trans[best_idx])
+
+        # early termination
+        inlier_ratio = best_inliers / len(eval_idx)
+        if inlier_ratio >= 1:
+            break
+        prob_good = inlier_ratio**min_samples
+        if prob_good > 0 and num_drawn >= np.log(1 - confidence) / np.log(1 - prob_good):
+            break
+
+    print("inlier_ratio: ", best_inliers / len(eval_idx))
+    R, t = best_sol
+    dist = np.linalg.norm(pts0 @ R.T + t - pts1, 2, axis=1)
+    inlier_mask = dist < threshold
+    if inlier_mask.sum() < min_samples:
+        return best_sol
+    return compute_procrustes(pts0[inlier_mask], pts1[inlier_mask])
+
+
+def kabsch_batch(pts0, pts1):
+    """
+    analytical solution of R/t for a batch of correspondence sets
+    pts0: K x M x 3
+    pts1: K x M x 3
+    returns R: K x 3 x 3, t: K x 3
+    """
+    pts0_mean = pts0.mean(1)
+    pts1_mean = pts1.mean(1)
+    pts0_centered = pts0 - pts0_mean[:, None]
+    pts1_centered = pts1 - pts1_mean[:, None]
+    H = pts0_centered.transpose(0, 2, 1) @ pts1_centered
+    U, S, Vt = np.linalg.svd(H)
+    # flip the last singular vector of reflections
+    sign = np.sign(np.linalg.det(Vt.transpose(0, 2, 1) @ U.transpose(0, 2, 1)))
+    Vt[:, 2, :] *= np.where(sign < 0, -1, 1)[:, None]
+    R = Vt.transpose(0, 2, 1) @ U.transpose(0, 2, 1)
+    t = pts1_mean - (R @ pts0_mean[..., None])[..., 0]
+    return R, t
 
 
 @record_function("compute_procrustes")
@@ -105,7 +161,10 @@ def two_frame_registration(
         # Procrustes
         valid_mask = np.logical_and(valid_mask, depth1_warped > 0)
         rmat, trans = compute_procrustes(pts0.T[valid_mask], pts1.T[valid_mask])
-        # rmat, trans = compute_procrustes_robust(pts0.T[valid_mask], pts1.T[valid_mask])
+    elif registration_type == "procrustes_robust":
+        # Procrustes with RANSAC
+        valid_mask = np.logical_and(valid_mask, depth1_warped > 0)
+        rmat, trans = compute_procrustes_robust(pts0.T[valid_mask], pts1.T[valid_mask])
     elif registration_type == "pnp":
         # PnP
         _, rvec, trans = cv2.solvePnP(
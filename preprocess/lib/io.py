@@ -1,7 +1,12 @@
 # Copyright (c) 2023 Gengshan Yang, Carnegie Mellon University.
+import glob
+import hashlib
 import os
 import subprocess
 import sys
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 
 import cv2
 import numpy as np
@@ -16,12 +21,218 @@ sys.path.insert(
     0,
     "%s/../../" % os.path.join(os.path.dirname(__file__)),
 )
-from flowutils.flowlib import warp_flow
 from libs.utils import reduce_component
 
 from utils.geom_utils import K2mat, compute_crop_params
 
 
+class FrameCache:
+    """Process-wide cache of decoded frames, shared by all preprocessing stages.
+    Frames are kept as uint8 BGR images, as returned by `cv2.imread`, in an LRU
+    bounded by the number of bytes. If `spill_dir` is given, decoded frames are
+    also written to one uint8 memmap per sequence, so frames evicted from memory
+    or decoded by other processes are read back without decoding.
+
+    Args:
+        max_bytes (int): Maximum number of bytes of frames kept in memory
+        spill_dir (str or None): Directory of the per-sequence memmaps
+    Attributes:
+        decodes (int): Number of frames decoded from jpg
+        hits (int): Number of frames served from memory
+        spill_hits (int): Number of frames served from a spilled memmap
+    """
+
+    def __init__(self, max_bytes, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.lock = threading.Lock()  # frames may be read by several threads
+        self.frames = OrderedDict()
+        self.cached_bytes = 0
+        self.spills = {}
+        self.decodes = 0
+        self.hits = 0
+        self.spill_hits = 0
+
+    def imread(self, path):
+        """Read a frame through the cache, equivalent to `cv2.imread(path)`.
+        The returned array is shared and read-only.
+
+        Args:
+            path (str): Path to a jpg frame
+        Returns:
+            img (np.array): (H,W,3) Image, BGR, uint8
+        """
+        with self.lock:
+            img = self.frames.get(path)
+            if img is not None:
+                self.frames.move_to_end(path)
+                self.hits += 1
+                return img
+            spill, index, mtime = self.get_spill(path)
+
+        spill_hit = spill is not None and spill["mtime"][index] == mtime
+        if spill_hit:
+            img = np.array(spill["frames"][index])
+        else:
+            img = cv2.imread(path)
+            if spill is not None and img.shape == spill["frames"].shape[1:]:
+                spill["frames"][index] = img
+                spill["mtime"][index] = mtime
+
+        img.flags.writeable = False
+        with self.lock:
+            if spill_hit:
+                self.spill_hits += 1
+            else:
+                self.decodes += 1
+            if path not in self.frames:
+                self.frames[path] = img
+                self.cached_bytes += img.nbytes
+            while len(self.frames) > 1 and self.cached_bytes > self.max_bytes:
+                _, evicted = self.frames.popitem(last=False)
+                self.cached_bytes -= evicted.nbytes
+        return img
+
+    def get_spill(self, path):
+        """Open or create the memmap of the sequence that contains a frame.
+        The file stores the mtime of each spilled frame, followed by the
+        frames. A frame is valid if its mtime matches the jpg.
+
+        Args:
+            path (str): Path to a jpg frame
+        Returns:
+            spill (Dict or None): Maps "mtime" and "frames" to memmaps
+            index (int): Index of the frame in the sequence
+            mtime (int): Modification time of the jpg, in ns
+        """
+        if self.spill_dir is None:
+            return None, None, None
+        seqdir = os.path.dirname(os.path.abspath(path))
+        if seqdir not in self.spills:
+            self.spills[seqdir] = self.open_spill(seqdir, path)
+        spill = self.spills[seqdir]
+        abspath = os.path.abspath(path)
+        if spill is None or abspath not in spill["index"]:
+            return None, None, None
+        return spill, spill["index"][abspath], os.stat(path).st_mtime_ns
+
+    def open_spill(self, seqdir, path):
+        imglist = sorted(glob.glob("%s/*.jpg" % seqdir))
+        if len(imglist) == 0:
+            return None
+        shape = cv2.imread(path).shape  # frames of a video share the shape
+        self.decodes += 1
+        num_frames = len(imglist)
+        header_size = (num_frames * 8 + 4095) // 4096 * 4096
+        frame_size = int(np.prod(shape))
+        file_size = header_size + num_frames * frame_size
+        name = hashlib.sha1(("%s-%s" % (seqdir, shape)).encode()).hexdigest()
+        spill_path = "%s/%s-%d.frames" % (self.spill_dir, name, num_frames)
+
+        if not os.path.exists(spill_path) or os.path.getsize(spill_path) != file_size:
+            # create with a temporary name, as several processes may spill
+            os.makedirs(self.spill_dir, exist_ok=True)
+            tmp_path = "%s.%d.tmp" % (spill_path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                f.truncate(file_size)
+            os.replace(tmp_path, spill_path)
+
+        buffer = np.memmap(spill_path, dtype=np.uint8, mode="r+")
+        spill = {
+            "index": {p: i for i, p in enumerate(imglist)},
+            "mtime": np.ndarray((num_frames,), dtype=np.int64, buffer=buffer),
+            "frames": np.ndarray(
+                (num_frames,) + shape, dtype=np.uint8, buffer=buffer, offset=header_size
+            ),
+        }
+        return spill
+
+    def clear(self):
+        """Drop all frames kept in memory"""
+        self.frames.clear()
+        self.cached_bytes = 0
+
+    def stats(self):
+        """Return cache counters, to measure the number of decodes
+
+        Returns:
+            stats (Dict): Decode/hit counters and bytes kept in memory
+        """
+        return {
+            "decodes": self.decodes,
+            "hits": self.hits,
+            "spill_hits": self.spill_hits,
+            "cached_frames": len(self.frames),
+            "cached_bytes": self.cached_bytes,
+        }
+
+
+# Size of the in-memory frame cache and optional spill directory, read from the
+# environment so that they also apply to workers of gpu_map
+frame_cache = FrameCache(
+    max_bytes=int(os.environ.get("REACTO_FRAME_CACHE_MB", 2048)) << 20,
+    spill_dir=os.environ.get("REACTO_FRAME_SPILL_DIR"),
+)
+
+
+class NpyWriter:
+    """Write a (L, ...) .npy file one entry at a time, instead of stacking a
+    list of entries in memory. The file is allocated as a memmap on the first
+    write, with the shape and dtype of that entry, and renamed to its final
+    path on `close()`, so an interrupted writer leaves no partial output.
+
+    Args:
+        path (str): Output path
+        length (int): Number of entries L
+    """
+
+    def __init__(self, path, length):
+        self.path = path
+        self.length = length
+        self.tmp_path = "%s.%d.tmp.npy" % (path, os.getpid())
+        self.array = None
+
+    def write(self, index, entry):
+        """Write entry `index`, equivalent to `array[index] = entry`"""
+        entry = np.asarray(entry)
+        if self.array is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.array = np.lib.format.open_memmap(
+                self.tmp_path,
+                mode="w+",
+                dtype=entry.dtype,
+                shape=(self.length,) + entry.shape,
+            )
+        self.array[index] = entry
+
+    def close(self):
+        """Flush the file and move it to its final path. Nothing is written if
+        no entry was"""
+        if self.array is None:
+            return
+        self.array.flush()
+        self.array = None
+        os.replace(self.tmp_path, self.path)
+
+
+def default_workers(num_tasks, workers=None):
+    """Number of workers for a pool running independent tasks
+
+    Args:
+        num_tasks (int): Number of tasks
+        workers (int or None): Requested number of workers. Defaults to the
+            REACTO_WORKERS environment variable, or to the number of CPUs
+            capped by the number of tasks
+    Returns:
+        workers (int): Number of workers, at least 1
+    """
+    if workers is None:
+        workers = os.environ.get("REACTO_WORKERS")
+    if workers is None:
+        workers = min(os.cpu_count() or 1, num_tasks)
+    return max(int(workers), 1)
+
+
 def run_bash_command(cmd):
     # print(cmd)
     subprocess.run(cmd, shell=True, check=True)
@@ -42,7 +253,7 @@ def read_images_densepose(imglist, obj_idx):
         # h, w, _ = rgb.shape
 
         # crop without resizing
-        rgb = cv2.imread(imgpath)
+        rgb = np.array(frame_cache.imread(imgpath))
         mask = np.load(
             imgpath.replace("JPEGImages", "Annotations").replace(".jpg", "-%02d.npy" % obj_idx)
         )
@@ -59,32 +270,49 @@ def read_images_densepose(imglist, obj_idx):
 def read_frame_data(imgpath, crop_size, use_full, obj_idx=None, num_obj=None, with_flow=True):
     # compute intrincs for the cropped images
     data_dict0 = read_raw(imgpath, 1, crop_size, use_full, obj_idx, num_obj, with_flow=with_flow)
-    depth = data_dict0["depth"]
+    depth = np.array(data_dict0["depth"])  # writable, callers mask it in place
     rgb = data_dict0["img"]
-    
+    mask = select_mask(data_dict0["mask"], obj_idx)
+    return rgb, depth, mask, data_dict0["crop2raw"]
+
+
+def select_mask(mask, obj_idx=None):
+    """Select the pixels of an object, or of the background if obj_idx is None
+
+    Args:
+        mask (np.array): (S,S,2) Cropped mask, see `crop_mask`
+        obj_idx (int or None): Object index
+    Returns:
+        mask (np.array): (S,S) Boolean mask
+    """
     if obj_idx is not None:#component_id > 0:
-        mask = data_dict0["mask"][..., 0].astype(int) == 1
+        mask = mask[..., 0].astype(int) == 1
         # reduce the mask to the largest connected component
         mask = reduce_component(mask)
     else:
-        mask = data_dict0["mask"][..., 0].astype(int) == 0
-        
-    return rgb, depth, mask, data_dict0["crop2raw"]
+        mask = mask[..., 0].astype(int) == 0
+    return mask
 
 
-@record_function("read_mask")
-def read_mask(img_path, shape, obj_idx=None, num_obj=None):
+def mask_paths(img_path, obj_idx=None, num_obj=None):
+    """List the annotation files read by `read_mask`, summed if more than one"""
     if obj_idx is not None:
         mask_path = img_path.replace("JPEGImages", "Annotations").replace(".jpg", "-%02d.npy" % obj_idx)
     else:
         mask_path = img_path.replace("JPEGImages", "Annotations")
 
     if num_obj is not None:
-        mask = np.load(mask_path.replace(".jpg", "-00.npy"))
-        for obj_idx in range(1, num_obj):
-            mask += np.load(mask_path.replace(".jpg", "-%02d.npy" % obj_idx))  ### modify for bg camera_regist and tsdf_fusion, add all obj_mask together
-    else:
-        mask = np.load(mask_path)
+        ### modify for bg camera_regist and tsdf_fusion, add all obj_mask together
+        return [mask_path.replace(".jpg", "-%02d.npy" % i) for i in range(max(num_obj, 1))]
+    return [mask_path]
+
+
+@record_function("read_mask")
+def read_mask(img_path, shape, obj_idx=None, num_obj=None):
+    paths = mask_paths(img_path, obj_idx, num_obj)
+    mask = np.load(paths[0])
+    for path in paths[1:]:
+        mask += np.load(path)
     if mask.shape[0] != shape[0] or mask.shape[1] != shape[1]:
         mask = cv2.resize(mask, shape[:2][::-1], interpolation=cv2.INTER_NEAREST)
     mask = np.expand_dims(mask, -1)
@@ -123,18 +351,8 @@ def read_depth(depth_path, shape):
     return depth
 
 
-@record_function("read_raw")
-def read_raw(img_path, delta, crop_size, use_full, obj_idx=None, num_obj=None, with_flow=True):
-    img = cv2.imread(img_path)[..., ::-1] / 255.0
-    shape = img.shape
-    
-    mask, vis2d, is_detected = read_mask(img_path, shape, obj_idx, num_obj)
-    if not is_detected:  # force using full if there is no detection
-        use_full = True
-    crop2raw = compute_crop_params(mask, crop_size=crop_size, use_full=use_full)
-    depth_path = img_path.replace("JPEGImages", "Depth").replace(".jpg", ".npy")
-    depth = read_depth(depth_path, shape)
-
+def flow_path(img_path, delta):
+    """Path to the forward (delta > 0) or backward (delta < 0) flow of a frame"""
     is_fw = delta > 0
     delta = abs(delta)
     if is_fw:
@@ -145,36 +363,180 @@ def read_raw(img_path, delta, crop_size, use_full, obj_idx=None, num_obj=None, w
         flowpath = img_path.replace("JPEGImages", "FlowBW_%d" % (delta)).replace(
             ".jpg", ".npy"
         )
-    if with_flow:
-        flow, occ = read_flow(flowpath, shape)
+    return flowpath
 
-    # crop the image according to mask
+
+@lru_cache(maxsize=8)
+def crop_grid(crop_size):
+    """Homogeneous pixel coordinates of a crop, shared by all frames
+
+    Returns:
+        hp_crop (np.array): (S,S,3) Read-only (x, y, 1) grid, float32
+    """
     x0, y0 = np.meshgrid(range(crop_size), range(crop_size))
     hp_crop = np.stack([x0, y0, np.ones_like(x0)], -1)  # augmented coord
     hp_crop = hp_crop.astype(np.float32)
+    hp_crop.flags.writeable = False
+    return hp_crop
+
+
+def crop_image(img, depth, crop2raw, crop_size):
+    """Crop the image and depth of a raw frame. The result only depends on the
+    crop parameters, not on the mask, so it can be shared by objects whose
+    crops coincide, e.g. full frames. Returned arrays are read-only.
+
+    Args:
+        img (np.array): (H,W,3) Raw image, RGB, 0-1
+        depth (np.array): (H,W) Raw depth
+        crop2raw (np.array): (4,) Camera intrinsics transform from crop to raw
+        crop_size (int): Side length of the crop, in pixels
+    Returns:
+        data_dict (Dict): Maps "img", "depth", "crop2raw", "hxy" and "hp_raw"
+            to the cropped frame
+    """
+    hp_crop = crop_grid(crop_size)
     hp_raw = hp_crop @ K2mat(crop2raw).T  # raw image coord
     x0 = hp_raw[..., 0].astype(np.float32)
     y0 = hp_raw[..., 1].astype(np.float32)
     img = cv2.remap(img, x0, y0, interpolation=cv2.INTER_LINEAR)
-    mask = cv2.remap(mask, x0, y0, interpolation=cv2.INTER_NEAREST)
-    vis2d = cv2.remap(vis2d, x0, y0, interpolation=cv2.INTER_NEAREST)
-    if with_flow:
-        flow = cv2.remap(flow, x0, y0, interpolation=cv2.INTER_LINEAR)
-        occ = cv2.remap(occ, x0, y0, interpolation=cv2.INTER_LINEAR)
     depth = cv2.remap(depth, x0, y0, interpolation=cv2.INTER_LINEAR)
-    # print('crop:%f'%(time.time()-ss))
 
     data_dict = {}
     data_dict["img"] = img.astype(np.float16)
-    data_dict["mask"] = np.stack([mask, vis2d], -1).astype(bool)
-    if with_flow:
-        data_dict["flow"] = flow
-        data_dict["occ"] = occ
     data_dict["depth"] = depth.astype(np.float16)
     data_dict["crop2raw"] = crop2raw
     data_dict["hxy"] = hp_crop
     data_dict["hp_raw"] = hp_raw
+    for v in data_dict.values():
+        v.flags.writeable = False
+    return data_dict
+
+
+def crop_mask(mask, vis2d, hp_raw):
+    """Crop a raw mask with the sampling grid `hp_raw` of `crop_image`
+
+    Returns:
+        mask (np.array): (S,S,2) Object mask and visibility, read-only
+    """
+    x0 = hp_raw[..., 0].astype(np.float32)
+    y0 = hp_raw[..., 1].astype(np.float32)
+    mask = cv2.remap(mask, x0, y0, interpolation=cv2.INTER_NEAREST)
+    vis2d = cv2.remap(vis2d, x0, y0, interpolation=cv2.INTER_NEAREST)
+    mask = np.stack([mask, vis2d], -1).astype(bool)
+    mask.flags.writeable = False
+    return mask
+
+
+def crop_flow(flow, occ, hp_raw):
+    """Crop a raw flow and occlusion map with the sampling grid `hp_raw` of
+    `crop_image`. Flow vectors stay in raw image coordinates, see
+    `flow_process`
+    """
+    x0 = hp_raw[..., 0].astype(np.float32)
+    y0 = hp_raw[..., 1].astype(np.float32)
+    flow = cv2.remap(flow, x0, y0, interpolation=cv2.INTER_LINEAR)
+    occ = cv2.remap(occ, x0, y0, interpolation=cv2.INTER_LINEAR)
+    return flow, occ
+
+
+# Number of cropped frames memoized by `read_frame_crop`. Consecutive calls of
+# `read_raw` for the deltas of a frame pair reuse the crop of each frame
+CROP_CACHE_FRAMES = 16
+crop_cache = OrderedDict()
+crop_cache_stats = {"crops": 0, "hits": 0}
+
+
+@record_function("read_frame_crop")
+def read_frame_crop(img_path, crop_size, use_full, obj_idx=None, num_obj=None):
+    """Crop the image, mask and depth of a frame. The result only depends on
+    the frame and crop arguments, so it is memoized for the most recent frames
+    and validated by the mtimes of the files read. Returned arrays are shared
+    and read-only.
+
+    Args:
+        img_path (str): Path to a jpg frame
+        crop_size (int): Side length of the crop, in pixels
+        use_full (bool): If True, crop the full frame instead of the mask bbox
+        obj_idx (int or None): Object whose mask is read
+        num_obj (int or None): If given, sum the masks of num_obj objects
+    Returns:
+        data_dict (Dict): Maps "img", "mask", "depth", "crop2raw", "hxy",
+            "hp_raw" and "is_detected" to the cropped frame
+        shape (Tuple): (H,W,3) shape of the raw frame
+    """
+    depth_path = img_path.replace("JPEGImages", "Depth").replace(".jpg", ".npy")
+    paths = [img_path, depth_path] + mask_paths(img_path, obj_idx, num_obj)
+    mtimes = tuple(os.stat(path).st_mtime_ns for path in paths)
+    key = (img_path, crop_size, use_full, obj_idx, num_obj)
+    cached = crop_cache.get(key)
+    if cached is not None and cached[0] == mtimes:
+        crop_cache.move_to_end(key)
+        crop_cache_stats["hits"] += 1
+        return cached[1], cached[2]
+
+    img = frame_cache.imread(img_path)[..., ::-1] / 255.0
+    shape = img.shape
+
+    mask, vis2d, is_detected = read_mask(img_path, shape, obj_idx, num_obj)
+    if not is_detected:  # force using full if there is no detection
+        use_full = True
+    crop2raw = compute_crop_params(mask, crop_size=crop_size, use_full=use_full)
+    depth = read_depth(depth_path, shape)
+
+    # crop the image according to mask
+    data_dict = crop_image(img, depth, crop2raw, crop_size)
+    data_dict["mask"] = crop_mask(mask, vis2d, data_dict["hp_raw"])
     data_dict["is_detected"] = is_detected
+
+    crop_cache_stats["crops"] += 1
+    crop_cache[key] = (mtimes, data_dict, shape)
+    while len(crop_cache) > CROP_CACHE_FRAMES:
+        crop_cache.popitem(last=False)
+    return data_dict, shape
+
+
+@record_function("read_frame_depth")
+def read_frame_depth(img_path, shape, crop_size, use_full, obj_idx=None, num_obj=None):
+    """Crop the depth and mask of a frame as `read_frame_data` does, without
+    decoding the image or reading the flow
+
+    Args:
+        img_path (str): Path to a jpg frame
+        shape (Tuple): (H,W) shape of the raw frame
+        crop_size (int): Side length of the crop, in pixels
+        use_full (bool): If True, crop the full frame instead of the mask bbox
+        obj_idx (int or None): Object whose mask is read
+        num_obj (int or None): If given, sum the masks of num_obj objects
+    Returns:
+        depth (np.array): (S,S) Cropped depth, writable
+        mask (np.array): (S,S) Boolean mask, see `select_mask`
+        crop2raw (np.array): (4,) Camera intrinsics transform from crop to raw
+    """
+    mask, vis2d, is_detected = read_mask(img_path, shape, obj_idx, num_obj)
+    if not is_detected:  # force using full if there is no detection
+        use_full = True
+    crop2raw = compute_crop_params(mask, crop_size=crop_size, use_full=use_full)
+    depth_path = img_path.replace("JPEGImages", "Depth").replace(".jpg", ".npy")
+    depth = read_depth(depth_path, shape)
+
+    hp_raw = crop_grid(crop_size) @ K2mat(crop2raw).T  # raw image coord
+    x0 = hp_raw[..., 0].astype(np.float32)
+    y0 = hp_raw[..., 1].astype(np.float32)
+    depth = cv2.remap(depth, x0, y0, interpolation=cv2.INTER_LINEAR)
+    depth = depth.astype(np.float16)
+    mask = select_mask(crop_mask(mask, vis2d, hp_raw), obj_idx)
+    return depth, mask, crop2raw
+
+
+@record_function("read_raw")
+def read_raw(img_path, delta, crop_size, use_full, obj_idx=None, num_obj=None, with_flow=True):
+    data_dict, shape = read_frame_crop(img_path, crop_size, use_full, obj_idx, num_obj)
+    data_dict = dict(data_dict)
+    if not with_flow:
+        return data_dict
+
+    flow, occ = read_flow(flow_path(img_path, delta), shape)
+    data_dict["flow"], data_dict["occ"] = crop_flow(flow, occ, data_dict["hp_raw"])
     return data_dict
 
 
@@ -182,7 +544,7 @@ def get_bbox(img_path, obj_idx=None):
     """
     [x0, y0, w, h]
     """
-    img = cv2.imread(img_path)[..., ::-1] / 255.0
+    img = frame_cache.imread(img_path)[..., ::-1] / 255.0
     shape = img.shape
     # mask_path = img_path.replace("JPEGImages", "Annotations").replace(".jpg", "-%02d.npy" % obj_idx)
     mask, _, _ = read_mask(img_path, shape, obj_idx)
@@ -202,21 +564,94 @@ def get_bbox(img_path, obj_idx=None):
 
 
 @record_function("compute_flow_uct")
-def compute_flow_uct(occ, flow0, hp1, hp0):
+def compute_flow_uct(occ, fw, bw, grid):
     """
-    hp1: homogeneous coord displaced by 2nd frame flow backwards
+    Forward-backward consistency of N frame pairs
+
+    Args:
+        occ (np.array): (N,S,S) Predicted occlusion
+        fw (Tuple(np.array)): (N,S,S) x and y of the pixels of the 1st frame
+            displaced by the forward flow, float32
+        bw (Tuple(np.array)): (N,S,S) x and y of the pixels of the 2nd frame
+            displaced by the backward flow, float32
+        grid (Tuple(np.array)): (1,1,S) x and (1,S,1) y pixel coordinates
+    Returns:
+        flow_uct (np.array): (N,S,S) Forward-backward consistency, 0-1
     """
     # cycle uncertainty: distance = ||disp_bw(disp_fw(x,y)) - (x,y)||
-    img_size = occ.shape[0]
-    dis = warp_flow(hp1[:, :, :2], flow0) - hp0
-    dis = np.linalg.norm(dis[:, :, :2], 2, -1)
-    dis_norm = dis / img_size * 2
+    img_size = occ.shape[1]
+    dis = 0
+    for bw_axis, grid_axis in zip(bw, grid):
+        cycle = np.stack(
+            [
+                cv2.remap(bw_axis[i], fw[0][i], fw[1][i], cv2.INTER_LINEAR)
+                for i in range(len(occ))
+            ]
+        )
+        dis = dis + (cycle - grid_axis) ** 2
+    dis = np.sqrt(dis)
+    dis_norm = dis * np.float32(2 / img_size)
     flow_uct = np.exp(-25 * dis_norm)
     flow_uct[flow_uct < 0.25] = 0.0  # this corresps to 1/40 img size
     flow_uct[occ > 0] = 0  # predictive uncertainty
     return flow_uct
 
 
+@record_function("flow_process_batch")
+def flow_process_batch(flow0, flow1, occ0, occ1, crop2raw0, crop2raw1):
+    """Batched `flow_process` for N frame pairs of the same crop size. Flows
+    are converted to the cropped coordinates and forward-backward consistency
+    is computed for all pairs at once.
+
+    crop2raw is a scale and offset per axis, so pixels are mapped between raw
+    and cropped frames per axis in float32, on (N,S,S) planes and a shared
+    pixel grid, instead of as 3x3 matmuls of homogeneous coordinates.
+
+    Args:
+        flow0 (np.array): (N,S,S,2) Forward flow of the 1st frames, cropped
+            with `crop_flow`, in raw pixels
+        flow1 (np.array): (N,S,S,2) Backward flow of the 2nd frames
+        occ0 (np.array): (N,S,S) Occlusion of the 1st frames
+        occ1 (np.array): (N,S,S) Occlusion of the 2nd frames
+        crop2raw0 (np.array): (N,4) Crop parameters of the 1st frames
+        crop2raw1 (np.array): (N,4) Crop parameters of the 2nd frames
+    Returns:
+        flow0 (np.array): (N,S,S,3) Cropped forward flow and uncertainty, float16
+        flow1 (np.array): (N,S,S,3) Cropped backward flow and uncertainty, float16
+    """
+    num_pairs, crop_size = flow0.shape[:2]
+    hp = crop_grid(crop_size)
+    grid = (hp[None, :1, :, 0], hp[None, :, :1, 1])  # (1,1,S) x, (1,S,1) y
+    # (N,1,1) focal length and offset of each axis
+    crop2raw0 = crop2raw0.astype(np.float32)[:, :, None, None]
+    crop2raw1 = crop2raw1.astype(np.float32)[:, :, None, None]
+
+    # pixels displaced by the flow, in the cropped coordinate of the other
+    # frame: crop 0 -> raw 0 -> raw 1 -> crop 1
+    fw = []
+    bw = []
+    for axis in range(2):
+        fl0, pp0 = crop2raw0[:, axis], crop2raw0[:, axis + 2]
+        fl1, pp1 = crop2raw1[:, axis], crop2raw1[:, axis + 2]
+        raw0 = grid[axis] * fl0 + pp0
+        raw1 = grid[axis] * fl1 + pp1
+        fw.append((flow0[..., axis] + (raw0 - pp1)) / fl1)
+        bw.append((flow1[..., axis] + (raw1 - pp0)) / fl0)
+
+    # fb check
+    flow_uct0 = compute_flow_uct(occ0, fw, bw, grid)
+    flow_uct1 = compute_flow_uct(occ1, bw, fw, grid)
+
+    flow0 = np.empty((num_pairs, crop_size, crop_size, 3), dtype=np.float16)
+    flow1 = np.empty((num_pairs, crop_size, crop_size, 3), dtype=np.float16)
+    for axis in range(2):
+        flow0[..., axis] = fw[axis] - grid[axis]
+        flow1[..., axis] = bw[axis] - grid[axis]
+    flow0[..., 2] = flow_uct0
+    flow1[..., 2] = flow_uct1
+    return flow0, flow1
+
+
 @record_function("flow_process")
 def flow_process(data_dict0, data_dict1):
     """
@@ -224,39 +659,14 @@ def flow_process(data_dict0, data_dict1):
     compute uncertainty
     normalize flow
     """
-    flow0, flow1, occ0, occ1, hp_raw0, hp_raw1 = (
-        data_dict0["flow"],
-        data_dict1["flow"],
-        data_dict0["occ"],
-        data_dict1["occ"],
-        data_dict0["hp_raw"],
-        data_dict1["hp_raw"],
-    )
-    hp = data_dict0["hxy"][:, :, :2]
-    ones = np.ones_like(hp[..., :1])
-    crop2raw0 = K2mat(data_dict0["crop2raw"])
-    crop2raw1 = K2mat(data_dict1["crop2raw"])
-
-    # flow in the cropped coordinate
-    hp_raw1c = np.concatenate([flow0 + hp_raw0[:, :, :2], ones], -1)
-    hp_crop1 = hp_raw1c @ np.linalg.inv(crop2raw1).T
-    flow0_crop = hp_crop1[:, :, :2] - hp
-
-    hp_raw0c = np.concatenate([flow1 + hp_raw1[:, :, :2], ones], -1)
-    hp_crop0 = hp_raw0c.dot(np.linalg.inv(crop2raw0.T))
-    flow1_crop = hp_crop0[:, :, :2] - hp
-
-    # fb check
-    flow_uct0 = compute_flow_uct(occ0, flow0_crop, hp_crop0, hp)
-    flow_uct1 = compute_flow_uct(occ1, flow1_crop, hp_crop1, hp)
-
-    (
-        data_dict0["flow"],
-        data_dict1["flow"],
-    ) = (
-        np.concatenate([flow0_crop, flow_uct0[..., None]], -1),
-        np.concatenate([flow1_crop, flow_uct1[..., None]], -1),
+    flow0, flow1 = flow_process_batch(
+        data_dict0["flow"][None],
+        data_dict1["flow"][None],
+        data_dict0["occ"][None],
+        data_dict1["occ"][None],
+        data_dict0["crop2raw"][None],
+        data_dict1["crop2raw"][None],
     )
-    data_dict0["flow"] = data_dict0["flow"].astype(np.float16)
-    data_dict1["flow"] = data_dict1["flow"].astype(np.float16)
+    data_dict0["flow"] = flow0[0]
+    data_dict1["flow"] = flow1[0]
     return
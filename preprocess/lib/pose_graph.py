@@ -0,0 +1,213 @@
+import numpy as np
+from scipy.linalg import solveh_banded
+from scipy.spatial.transform import Rotation as R
+
+from utils.profile_utils import record_function
+
+
+def skew(vec):
+    """Skew-symmetric matrices of a batch of vectors
+
+    Args:
+        vec (np.array): (..., 3) Vectors
+    Returns:
+        mat (np.array): (..., 3, 3) Matrices such that mat @ x = cross(vec, x)
+    """
+    mat = np.zeros(vec.shape + (3,))
+    mat[..., 0, 1] = -vec[..., 2]
+    mat[..., 0, 2] = vec[..., 1]
+    mat[..., 1, 0] = vec[..., 2]
+    mat[..., 1, 2] = -vec[..., 0]
+    mat[..., 2, 0] = -vec[..., 1]
+    mat[..., 2, 1] = vec[..., 0]
+    return mat
+
+
+def se3_exp(xi):
+    """Exponential map of se(3)
+
+    Args:
+        xi (np.array): (N, 6) Twists, translation part first
+    Returns:
+        mat (np.array): (N, 4, 4) Rigid transforms
+    """
+    rotvec = xi[:, 3:]
+    theta = np.linalg.norm(rotvec, 2, axis=-1)[:, None, None]
+    small = theta < 1e-6
+    theta = np.where(small, 1, theta)
+    coef_b = np.where(small, 1 / 2, (1 - np.cos(theta)) / theta**2)
+    coef_c = np.where(small, 1 / 6, (theta - np.sin(theta)) / theta**3)
+    W = skew(rotvec)
+    V = np.eye(3) + coef_b * W + coef_c * W @ W
+
+    mat = np.tile(np.eye(4), (len(xi), 1, 1))
+    mat[:, :3, :3] = R.from_rotvec(rotvec).as_matrix()
+    mat[:, :3, 3] = (V @ xi[:, :3, None])[..., 0]
+    return mat
+
+
+def se3_log(mat):
+    """Logarithm map of SE(3), inverse of `se3_exp()`
+
+    Args:
+        mat (np.array): (N, 4, 4) Rigid transforms
+    Returns:
+        xi (np.array): (N, 6) Twists, translation part first
+    """
+    rotvec = R.from_matrix(mat[:, :3, :3]).as_rotvec()
+    theta = np.linalg.norm(rotvec, 2, axis=-1)[:, None, None]
+    small = theta < 1e-6
+    theta = np.where(small, 1, theta)
+    half = theta / 2
+    coef = np.where(small, 1 / 12, (1 - half / np.tan(half)) / theta**2)
+    W = skew(rotvec)
+    V_inv = np.eye(3) - W / 2 + coef * W @ W
+    trans = (V_inv @ mat[:, :3, 3:])[..., 0]
+    return np.concatenate([trans, rotvec], -1)
+
+
+def se3_adjoint(mat):
+    """Adjoint of SE(3), such that mat @ exp(xi) = exp(adj @ xi) @ mat
+
+    Args:
+        mat (np.array): (N, 4, 4) Rigid transforms
+    Returns:
+        adj (np.array): (N, 6, 6) Adjoint matrices
+    """
+    rmat = mat[:, :3, :3]
+    adj = np.zeros((len(mat), 6, 6))
+    adj[:, :3, :3] = rmat
+    adj[:, :3, 3:] = skew(mat[:, :3, 3]) @ rmat
+    adj[:, 3:, 3:] = rmat
+    return adj
+
+
+def pose_graph_residuals(cams, idx0, idx1, cams_0_to_1):
+    """Residuals of the relative transform constraints of a pose graph
+
+    Args:
+        cams (np.array): (N, 4, 4) Scene to camera transforms
+        idx0 (np.array): (E,) First frame of each edge
+        idx1 (np.array): (E,) Second frame of each edge
+        cams_0_to_1 (np.array): (E, 4, 4) Measured transforms from the camera
+            of the first frame to the camera of the second frame
+    Returns:
+        res (np.array): (E, 6) Residual twists
+        err (np.array): (E, 4, 4) Error transforms, identity if consistent
+    """
+    err = np.linalg.inv(cams_0_to_1) @ cams[idx1] @ np.linalg.inv(cams[idx0])
+    res = se3_log(err)
+    return res, err
+
+
+@record_function("optimize_pose_graph")
+def optimize_pose_graph(
+    cams,
+    idx0,
+    idx1,
+    cams_0_to_1,
+    trans_sigma=None,
+    rot_sigma=0.01,
+    huber=3.0,
+    num_iters=20,
+):
+    """Refine cameras to agree with relative transforms between nearby
+    frames, with Levenberg-Marquardt on SE(3). The first camera is fixed.
+
+    Edges only connect frames at most `max(|idx1 - idx0|)` apart, so the
+    normal equations are block-banded and solved in O(N) with a banded
+    Cholesky solve instead of a dense one. Residuals are weighted with a
+    Huber loss, so that failed registrations are down-weighted.
+
+    Args:
+        cams (np.array): (N, 4, 4) Initial scene to camera transforms
+        idx0 (np.array): (E,) First frame of each edge
+        idx1 (np.array): (E,) Second frame of each edge
+        cams_0_to_1 (np.array): (E, 4, 4) Measured transforms from the camera
+            of the first frame to the camera of the second frame
+        trans_sigma (float or None): Expected translation error of an edge.
+            Defaults to 10% of the median edge translation
+        rot_sigma (float): Expected rotation error of an edge, in radians
+        huber (float): Threshold of the Huber loss, in standard deviations
+        num_iters (int): Maximum number of iterations
+    Returns:
+        cams (np.array): (N, 4, 4) Refined scene to camera transforms
+    """
+    cams = np.asarray(cams, dtype=np.float64)
+    idx0 = np.asarray(idx0)
+    idx1 = np.asarray(idx1)
+    cams_0_to_1 = np.asarray(cams_0_to_1, dtype=np.float64)
+    num_cams = len(cams)
+    if num_cams < 2 or len(idx0) == 0:
+        return cams
+
+    if trans_sigma is None:
+        trans_sigma = 0.1 * np.median(np.linalg.norm(cams_0_to_1[:, :3, 3], 2, -1))
+        trans_sigma = max(trans_sigma, 1e-6)
+    info = np.array([trans_sigma**-2] * 3 + [rot_sigma**-2] * 3)
+
+    # variables are the twists of cameras 1..N-1, columns of edges to the
+    # fixed camera 0 are dropped
+    num_vars = 6 * (num_cams - 1)
+    bandwidth = 6 * np.abs(idx1 - idx0).max() + 5
+    var_idx = np.concatenate(
+        [6 * (idx0 - 1)[:, None] + np.arange(6), 6 * (idx1 - 1)[:, None] + np.arange(6)],
+        -1,
+    )  # E, 12
+    rows = np.broadcast_to(var_idx[:, :, None], var_idx.shape + (12,))
+    cols = np.broadcast_to(var_idx[:, None, :], var_idx.shape + (12,))
+    # lower band storage: ab[row - col, col] = H[row, col] for row >= col
+    in_band = (rows >= cols) & (cols >= 0)
+    band_idx = (rows[in_band] - cols[in_band], cols[in_band])
+    grad_valid = var_idx >= 0
+
+    def robust_cost(res):
+        err = np.sqrt(np.sum(res**2 * info, -1))
+        weight = np.where(err < huber, 1, huber / np.maximum(err, 1e-12))
+        cost = np.where(err < huber, err**2 / 2, huber * (err - huber / 2))
+        return cost.sum(), weight
+
+    res, err = pose_graph_residuals(cams, idx0, idx1, cams_0_to_1)
+    cost, weight = robust_cost(res)
+    cost_init = cost
+    damping = 1e-4
+    for _ in range(num_iters):
+        # linearize around the current cameras, with left perturbations
+        # cams[i] <- exp(xi_i) @ cams[i]
+        jac = np.concatenate(
+            [-se3_adjoint(err), se3_adjoint(np.linalg.inv(cams_0_to_1))], -1
+        )  # E, 6, 12
+        jac_w = jac * (info * weight[:, None])[..., None]
+        hess_edge = jac.transpose(0, 2, 1) @ jac_w  # E, 12, 12
+        grad_edge = (jac_w.transpose(0, 2, 1) @ res[..., None])[..., 0]  # E, 12
+
+        hess_band = np.zeros((bandwidth + 1, num_vars))
+        np.add.at(hess_band, band_idx, hess_edge[in_band])
+        grad = np.zeros(num_vars)
+        np.add.at(grad, var_idx[grad_valid], grad_edge[grad_valid])
+
+        while damping < 1e8:
+            hess_damped = hess_band.copy()
+            hess_damped[0] = hess_damped[0] * (1 + damping) + 1e-9
+            step = solveh_banded(hess_damped, -grad, lower=True)
+            step = np.concatenate([np.zeros(6), step]).reshape(-1, 6)
+            cams_new = se3_exp(step) @ cams
+            res_new, err_new = pose_graph_residuals(cams_new, idx0, idx1, cams_0_to_1)
+            cost_new, weight_new = robust_cost(res_new)
+            if cost_new <= cost:
+                damping = max(damping / 10, 1e-8)
+                break
+            damping *= 10
+        else:
+            break
+
+        converged = cost - cost_new < 1e-6 * cost
+        cams, res, err, cost, weight = cams_new, res_new, err_new, cost_new, weight_new
+        if converged:
+            break
+
+    print(
+        "pose graph: %d cameras, %d edges, cost %.4g -> %.4g"
+        % (num_cams, len(idx0), cost_init, cost)
+    )
+    return cams
@@ -0,0 +1,669 @@
+import numpy as np
+import torch
+from skimage import measure
+
+from utils.profile_utils import record_function
+
+
+class TorchTSDFVolume:
+    """Volumetric TSDF fusion of RGB-D images with torch, on CPU or GPU. Same
+    update rule as `fusion.TSDFVolume`, but the volume is split into bricks
+    that are culled against the view frustum of each frame, the remaining
+    voxels are processed in chunks to bound memory, and a batch of frames is
+    integrated per call.
+
+    By default voxels are stored as in `fusion.TSDFVolume`, with float32 TSDF,
+    weight and color folded as b*256*256 + g*256 + r. With `compact`, the TSDF
+    and weight are stored as float16 and the color as uint8 RGB, which takes
+    7 instead of 12 bytes per voxel and blends colors without folding them.
+    Float16 weights count observations exactly up to 2048, after which new
+    observations stop being averaged in.
+
+    Args:
+        vol_bnds (np.array): (3, 2) xyz bounds (min/max) of the volume
+        voxel_size (float): Side length of a voxel
+        device (str or torch.device): Device holding the volume
+        brick_size (int): Side length of a brick, in voxels
+        chunk_size (int): Maximum number of voxels processed at once
+        compact (bool): Store voxels as float16 TSDF/weight and uint8 color
+    """
+
+    def __init__(
+        self,
+        vol_bnds,
+        voxel_size,
+        device="cpu",
+        brick_size=16,
+        chunk_size=1 << 20,
+        compact=False,
+    ):
+        vol_bnds = np.array(vol_bnds, dtype=np.float64)
+        assert vol_bnds.shape == (3, 2), "[!] `vol_bnds` should be of shape (3, 2)."
+
+        # Define voxel volume parameters
+        self._voxel_size = float(voxel_size)
+        self._trunc_margin = 5 * self._voxel_size  # truncation on SDF
+        self._color_const = 256 * 256
+
+        # Adjust volume bounds
+        self._vol_dim = np.ceil(
+            (vol_bnds[:, 1] - vol_bnds[:, 0]) / self._voxel_size
+        ).astype(int)
+        vol_bnds[:, 1] = vol_bnds[:, 0] + self._vol_dim * self._voxel_size
+        self._vol_bnds = vol_bnds
+        self._vol_origin = vol_bnds[:, 0].astype(np.float32)
+        self.device = torch.device(device)
+        self.brick_size = brick_size
+        self.chunk_size = chunk_size
+        self.compact = compact
+
+        print(
+            "Voxel volume size: {} x {} x {} - # points: {:,}".format(
+                self._vol_dim[0],
+                self._vol_dim[1],
+                self._vol_dim[2],
+                self._vol_dim[0] * self._vol_dim[1] * self._vol_dim[2],
+            )
+        )
+
+        # the volume is padded to a whole number of bricks
+        num_bricks = -(-self._vol_dim // brick_size)
+        pad_dim = tuple(int(d) for d in num_bricks * brick_size)
+        self._tsdf_vol, self._weight_vol, self._color_vol = self.new_voxels(pad_dim)
+
+        # voxel index of the first voxel of each brick, and of each voxel
+        # relative to it, with their linear indices in the padded volume
+        strides = torch.tensor(self._tsdf_vol.stride(), device=self.device)
+        self._brick_coords = grid_coords(num_bricks, self.device) * brick_size
+        self._brick_lin = self._brick_coords @ strides
+        self._num_bricks = len(self._brick_coords)
+        self._local_coords = grid_coords([brick_size] * 3, self.device)
+        self._local_lin = self._local_coords @ strides
+
+    def new_voxels(self, shape):
+        """Storage for empty voxels
+
+        Args:
+            shape (tuple): Shape of the voxel grid
+        Returns:
+            tsdf_vol (torch.Tensor): TSDF, initialized to 1
+            weight_vol (torch.Tensor): Weights, for computing the cumulative
+                moving average of observations per voxel
+            color_vol (torch.Tensor): Folded colors, or (..., 3) RGB colors if
+                compact
+        """
+        if self.compact:
+            tsdf_vol = torch.ones(shape, dtype=torch.float16, device=self.device)
+            weight_vol = torch.zeros_like(tsdf_vol)
+            color_vol = torch.zeros(
+                tuple(shape) + (3,), dtype=torch.uint8, device=self.device
+            )
+        else:
+            tsdf_vol = torch.ones(shape, dtype=torch.float32, device=self.device)
+            weight_vol = torch.zeros_like(tsdf_vol)
+            color_vol = torch.zeros_like(tsdf_vol)
+        return tsdf_vol, weight_vol, color_vol
+
+    def memory(self):
+        """Number of bytes taken by the voxels"""
+        return sum(
+            vol.numel() * vol.element_size()
+            for vol in (self._tsdf_vol, self._weight_vol, self._color_vol)
+        )
+
+    def visible_bricks(self, rot, trans, intr, im_h, im_w, max_depth):
+        """Find the bricks that may contain voxels updated by each frame. A
+        brick is skipped if all its corners are behind the camera, beyond the
+        truncated depth range, or on the same side outside the image
+
+        Args:
+            rot (torch.Tensor): (B,3,3) Voxel index to camera rotation, scaled
+                by the voxel size
+            trans (torch.Tensor): (B,3) Camera coordinates of voxel (0,0,0)
+            intr (torch.Tensor): (B,4) fx, fy, cx, cy
+            im_h (int): Image height
+            im_w (int): Image width
+            max_depth (torch.Tensor): (B,) Maximum depth of each frame
+        Returns:
+            visible (torch.Tensor): (B, num_bricks) Boolean mask
+        """
+        lo = self._brick_coords[: self._num_bricks]
+        hi = lo + self.brick_size - 1
+        corner_sel = grid_coords([2, 2, 2], self.device).bool()
+        corners = torch.where(corner_sel, hi[:, None], lo[:, None]).float()  # NB,8,3
+        cam = torch.einsum("bij,nkj->bnki", rot, corners) + trans[:, None, None]
+        x, y, z = cam.unbind(-1)
+
+        fx, fy, cx, cy = [v[:, None, None] for v in intr.unbind(-1)]
+        # pixels are rounded, keep a margin of one pixel
+        outside = [
+            z <= 0,
+            z > max_depth[:, None, None] + self._trunc_margin,
+            x * fx + (cx + 1) * z < 0,
+            (im_w - cx) * z - x * fx < 0,
+            y * fy + (cy + 1) * z < 0,
+            (im_h - cy) * z - y * fy < 0,
+        ]
+        culled = torch.stack([v.all(-1) for v in outside], 0).any(0)
+        return ~culled
+
+    def frame_params(self, cam_intrs, cam_poses):
+        """Voxel index to camera transforms of a batch of frames, such that
+        camera coordinates are rot @ ijk + trans
+
+        Args:
+            cam_intrs (np.array): (B,3,3) Camera intrinsics
+            cam_poses (np.array): (B,4,4) Camera to world transforms
+        Returns:
+            rot (torch.Tensor): (B,3,3) Rotations, scaled by the voxel size
+            trans (torch.Tensor): (B,3) Camera coordinates of voxel (0,0,0)
+            intr (torch.Tensor): (B,4) fx, fy, cx, cy
+        """
+        world2cam = np.linalg.inv(np.asarray(cam_poses, dtype=np.float64))
+        rot = world2cam[:, :3, :3] * self._voxel_size
+        trans = world2cam[:, :3, :3] @ self._vol_origin + world2cam[:, :3, 3]
+        rot = torch.as_tensor(rot, dtype=torch.float32, device=self.device)
+        trans = torch.as_tensor(trans, dtype=torch.float32, device=self.device)
+        cam_intrs = np.asarray(cam_intrs, dtype=np.float32)
+        intr = cam_intrs[:, [0, 1, 0, 1], [0, 1, 2, 2]]  # fx, fy, cx, cy
+        intr = torch.as_tensor(intr, device=self.device)
+        return rot, trans, intr
+
+    @record_function("TorchTSDFVolume.integrate_batch")
+    def integrate_batch(self, color_ims, depth_ims, cam_intrs, cam_poses, obs_weight=1.0):
+        """Integrate a batch of RGB-D frames into the TSDF volume, in order
+
+        Args:
+            color_ims (np.array): (B,H,W,3) RGB images
+            depth_ims (np.array): (B,H,W) Depth images, 0 where invalid
+            cam_intrs (np.array): (B,3,3) Camera intrinsics
+            cam_poses (np.array): (B,4,4) Camera to world transforms
+            obs_weight (float): Weight of each observation
+        """
+        device = self.device
+        num_frames, im_h, im_w = np.shape(depth_ims)[:3]
+        color_ims = torch.as_tensor(np.asarray(color_ims, dtype=np.float32), device=device)
+        depth_ims = torch.as_tensor(np.asarray(depth_ims, dtype=np.float32), device=device)
+        if self.compact:
+            color_ims = torch.floor(color_ims)
+        else:
+            # Fold RGB color images into single channel images
+            color_ims = torch.floor(
+                color_ims[..., 2] * self._color_const
+                + color_ims[..., 1] * 256
+                + color_ims[..., 0]
+            )
+
+        rot, trans, intr = self.frame_params(cam_intrs, cam_poses)
+
+        max_depth = depth_ims.reshape(num_frames, -1).max(1).values
+        bricks_per_chunk = max(1, self.chunk_size // len(self._local_lin))
+        local_coords = self._local_coords.float()
+        for it in range(num_frames):
+            self.allocate_bricks(depth_ims[it], rot[it], trans[it], intr[it])
+            visible = self.visible_bricks(
+                rot[it, None],
+                trans[it, None],
+                intr[it, None],
+                im_h,
+                im_w,
+                max_depth[it, None],
+            )[0]
+            # camera coordinates of the voxels relative to their brick
+            local_cam = local_coords @ rot[it].T
+            bricks = torch.nonzero(visible)[:, 0]
+            for start in range(0, len(bricks), bricks_per_chunk):
+                self.integrate_bricks(
+                    bricks[start : start + bricks_per_chunk],
+                    local_cam,
+                    color_ims[it],
+                    depth_ims[it],
+                    rot[it],
+                    trans[it],
+                    intr[it],
+                    obs_weight,
+                )
+
+    def allocate_bricks(self, depth_im, rot, trans, intr):
+        """Allocate the bricks observed by a frame. All bricks of a dense
+        volume are allocated up front"""
+        pass
+
+    def integrate(self, color_im, depth_im, cam_intr, cam_pose, obs_weight=1.0):
+        """Integrate an RGB-D frame into the TSDF volume, see `integrate_batch`"""
+        self.integrate_batch(
+            color_im[None], depth_im[None], cam_intr[None], cam_pose[None], obs_weight
+        )
+
+    def integrate_bricks(
+        self, bricks, local_cam, color_im, depth_im, rot, trans, intr, obs_weight
+    ):
+        """Update the voxels of some bricks observed by a frame
+
+        Args:
+            bricks (torch.Tensor): (N,) Brick indices
+            local_cam (torch.Tensor): (V,3) Camera coordinates of the voxels of
+                a brick relative to its first voxel
+            color_im (torch.Tensor): (H,W) Folded color image, or (H,W,3) RGB
+                image if compact
+            depth_im (torch.Tensor): (H,W) Depth image
+            rot (torch.Tensor): (3,3) Voxel index to camera rotation
+            trans (torch.Tensor): (3,) Camera coordinates of voxel (0,0,0)
+            intr (torch.Tensor): (4,) fx, fy, cx, cy
+            obs_weight (float): Weight of the observation
+        """
+        im_h, im_w = depth_im.shape
+        fx, fy, cx, cy = intr.tolist()
+        voxels_per_brick = len(local_cam)
+
+        # Convert voxel grid coordinates to pixel coordinates, (N,V) each
+        brick_cam = self._brick_coords[bricks].float() @ rot.T + trans
+        cam_x, cam_y, pix_z = [
+            brick_cam[:, i, None] + local_cam[None, :, i] for i in range(3)
+        ]
+        pix_x = torch.round(cam_x * fx / pix_z + cx)
+        pix_y = torch.round(cam_y * fy / pix_z + cy)
+
+        # Eliminate pixels outside view frustum
+        valid_pix = (
+            (pix_x >= 0) & (pix_x < im_w) & (pix_y >= 0) & (pix_y < im_h) & (pix_z > 0)
+        )
+        idx = torch.nonzero(valid_pix.reshape(-1))[:, 0]
+        pix_x = pix_x.reshape(-1)[idx].long()
+        pix_y = pix_y.reshape(-1)[idx].long()
+        depth_val = depth_im[pix_y, pix_x]
+
+        # Integrate TSDF
+        depth_diff = depth_val - pix_z.reshape(-1)[idx]
+        valid_pts = (depth_val > 0) & (depth_diff >= -self._trunc_margin)
+        idx = idx[valid_pts]
+        pix_x = pix_x[valid_pts]
+        pix_y = pix_y[valid_pts]
+        dist = torch.clamp(depth_diff[valid_pts] / self._trunc_margin, max=1)
+        vox = (
+            self._brick_lin[bricks[idx // voxels_per_brick]]
+            + self._local_lin[idx % voxels_per_brick]
+        )
+        tsdf_vol = self._tsdf_vol.view(-1)
+        weight_vol = self._weight_vol.view(-1)
+        w_old = weight_vol[vox].float()
+        tsdf_vals = tsdf_vol[vox].float()
+        w_new = w_old + obs_weight
+        tsdf_vol[vox] = ((w_old * tsdf_vals + obs_weight * dist) / w_new).to(tsdf_vol.dtype)
+        weight_vol[vox] = w_new.to(weight_vol.dtype)
+
+        # Integrate color
+        if self.compact:
+            color_vol = self._color_vol.view(-1, 3)
+            old_rgb = color_vol[vox].float()
+            new_rgb = color_im[pix_y, pix_x]
+            new_rgb = torch.round(
+                (w_old[:, None] * old_rgb + obs_weight * new_rgb) / w_new[:, None]
+            )
+            color_vol[vox] = torch.clamp(new_rgb, max=255.0).to(torch.uint8)
+        else:
+            color_vol = self._color_vol.view(-1)
+            old_b, old_g, old_r = self.unfold_color(color_vol[vox])
+            new_b, new_g, new_r = self.unfold_color(color_im[pix_y, pix_x])
+            new_b = torch.clamp(torch.round((w_old * old_b + obs_weight * new_b) / w_new), max=255.0)
+            new_g = torch.clamp(torch.round((w_old * old_g + obs_weight * new_g) / w_new), max=255.0)
+            new_r = torch.clamp(torch.round((w_old * old_r + obs_weight * new_r) / w_new), max=255.0)
+            color_vol[vox] = new_b * self._color_const + new_g * 256 + new_r
+
+    def unfold_color(self, color):
+        """Split folded colors into b, g, r channels"""
+        b = torch.floor(color / self._color_const)
+        g = torch.floor((color - b * self._color_const) / 256)
+        r = color - b * self._color_const - g * 256
+        return b, g, r
+
+    def decode_colors(self, vals):
+        """Colors of voxels
+
+        Args:
+            vals (np.array): (N,) Folded colors, or (N,3) RGB colors if compact
+        Returns:
+            colors (np.array): (N,3) RGB colors, uint8
+        """
+        if self.compact:
+            return vals.astype(np.uint8)
+        colors_b = np.floor(vals / self._color_const)
+        colors_g = np.floor((vals - colors_b * self._color_const) / 256)
+        colors_r = vals - colors_b * self._color_const - colors_g * 256
+        colors = np.floor(np.asarray([colors_r, colors_g, colors_b])).T
+        return colors.astype(np.uint8)
+
+    def get_volume(self):
+        dim_x, dim_y, dim_z = self._vol_dim
+        tsdf_vol = self._tsdf_vol[:dim_x, :dim_y, :dim_z]
+        color_vol = self._color_vol[:dim_x, :dim_y, :dim_z]
+        return tsdf_vol.float().cpu().numpy(), color_vol.cpu().numpy()
+
+    def get_mesh(self):
+        """Compute a mesh from the voxel volume using marching cubes."""
+        tsdf_vol, color_vol = self.get_volume()
+
+        # Marching cubes
+        verts, faces, norms, vals = measure.marching_cubes(tsdf_vol, level=0)
+        verts_ind = np.round(verts).astype(int)
+        verts = (
+            verts * self._voxel_size + self._vol_origin
+        )  # voxel grid coordinates to world coordinates
+
+        # Get vertex colors
+        rgb_vals = color_vol[verts_ind[:, 0], verts_ind[:, 1], verts_ind[:, 2]]
+        colors = self.decode_colors(rgb_vals)
+        return verts, faces, norms, colors
+
+
+class SparseTSDFVolume(TorchTSDFVolume):
+    """TSDF volume that only stores the blocks of voxels around observed
+    depth, so that memory scales with the observed surface area instead of
+    the bounding volume. Blocks are allocated when depth observations of a
+    frame land in their truncation band, and are found through a sorted
+    table of block keys. Same `integrate` and `get_mesh` API as
+    `TorchTSDFVolume`.
+
+    Voxels in front of a surface are only updated once their block is
+    allocated, so free space observed before that is not averaged in, unless
+    blocks are allocated up front with `allocate`.
+
+    Args:
+        vol_bnds (np.array or None): (3, 2) xyz bounds (min/max) of the
+            volume. Blocks outside of the bounds are not allocated, and the
+            mesh is cropped to the bounds. If None, the volume is unbounded
+        voxel_size (float): Side length of a voxel
+        device (str or torch.device): Device holding the volume
+        brick_size (int): Side length of a block, in voxels
+        chunk_size (int): Maximum number of voxels processed at once
+        capacity (int): Initial number of blocks, doubled when full. Capped
+            by the number of blocks within the bounds
+        compact (bool): Store voxels as float16 TSDF/weight and uint8 color
+    """
+
+    # block coordinates are packed into int64 keys, with 21 bits per axis
+    KEY_BITS = 21
+
+    def __init__(
+        self,
+        vol_bnds,
+        voxel_size,
+        device="cpu",
+        brick_size=8,
+        chunk_size=1 << 20,
+        capacity=64,
+        compact=False,
+    ):
+        self._voxel_size = float(voxel_size)
+        self._trunc_margin = 5 * self._voxel_size  # truncation on SDF
+        self._color_const = 256 * 256
+        self.device = torch.device(device)
+        self.brick_size = brick_size
+        self.chunk_size = chunk_size
+        self.compact = compact
+
+        if vol_bnds is None:
+            self._vol_origin = np.zeros(3, dtype=np.float32)
+            self._vol_dim = None
+            self._num_blocks = None
+        else:
+            vol_bnds = np.array(vol_bnds, dtype=np.float64)
+            assert vol_bnds.shape == (3, 2), "[!] `vol_bnds` should be of shape (3, 2)."
+            self._vol_dim = np.ceil(
+                (vol_bnds[:, 1] - vol_bnds[:, 0]) / self._voxel_size
+            ).astype(int)
+            self._vol_origin = vol_bnds[:, 0].astype(np.float32)
+            self._num_blocks = torch.as_tensor(
+                -(-self._vol_dim // brick_size), device=self.device
+            )
+            capacity = min(capacity, int(np.prod(-(-self._vol_dim // brick_size))))
+
+        # block pool, indexed by slot
+        self._num_bricks = 0
+        self._tsdf_vol, self._weight_vol, self._color_vol = self.new_voxels(
+            (0, brick_size, brick_size, brick_size)
+        )
+        self._brick_coords = torch.zeros(0, 3, dtype=torch.long, device=self.device)
+        self._brick_lin = torch.zeros(0, dtype=torch.long, device=self.device)
+        self.grow(capacity)
+
+        # sorted keys of the allocated blocks, and their slots
+        self._keys = torch.zeros(0, dtype=torch.long, device=self.device)
+        self._key_slots = torch.zeros(0, dtype=torch.long, device=self.device)
+
+        strides = torch.tensor(self._tsdf_vol.stride()[1:], device=self.device)
+        self._local_coords = grid_coords([brick_size] * 3, self.device)
+        self._local_lin = self._local_coords @ strides
+
+    def grow(self, capacity):
+        """Resize the block pool to hold `capacity` blocks"""
+        num_new = capacity - len(self._tsdf_vol)
+        tsdf_vol, weight_vol, color_vol = self.new_voxels(
+            (num_new,) + self._tsdf_vol.shape[1:]
+        )
+        self._tsdf_vol = torch.cat([self._tsdf_vol, tsdf_vol])
+        self._weight_vol = torch.cat([self._weight_vol, weight_vol])
+        self._color_vol = torch.cat([self._color_vol, color_vol])
+        self._brick_coords = torch.cat(
+            [self._brick_coords, torch.zeros(num_new, 3, dtype=torch.long, device=self.device)]
+        )
+        self._brick_lin = torch.arange(capacity, device=self.device) * self.brick_size**3
+
+    def block_keys(self, blocks):
+        """Pack (N,3) block coordinates into (N,) int64 keys"""
+        offset = 1 << (self.KEY_BITS - 1)
+        blocks = blocks + offset
+        return (blocks[:, 0] << (2 * self.KEY_BITS)) | (blocks[:, 1] << self.KEY_BITS) | blocks[:, 2]
+
+    def unpack_keys(self, keys):
+        """Unpack (N,) int64 keys into (N,3) block coordinates"""
+        offset = 1 << (self.KEY_BITS - 1)
+        mask = (1 << self.KEY_BITS) - 1
+        blocks = torch.stack(
+            [keys >> (2 * self.KEY_BITS), (keys >> self.KEY_BITS) & mask, keys & mask], -1
+        )
+        return blocks - offset
+
+    def lookup(self, blocks):
+        """Find the slots of blocks
+
+        Args:
+            blocks (torch.Tensor): (N,3) Block coordinates
+        Returns:
+            slots (torch.Tensor): (N,) Slot of each block, -1 if not allocated
+        """
+        keys = self.block_keys(blocks)
+        if len(self._keys) == 0:
+            return torch.full_like(keys, -1)
+        pos = torch.searchsorted(self._keys, keys).clamp(max=len(self._keys) - 1)
+        found = self._keys[pos] == keys
+        return torch.where(found, self._key_slots[pos], -1)
+
+    @record_function("SparseTSDFVolume.allocate_bricks")
+    def allocate_bricks(self, depth_im, rot, trans, intr):
+        """Allocate the blocks crossed by the truncation band around the
+        depth of a frame
+
+        Args:
+            depth_im (torch.Tensor): (H,W) Depth image
+            rot (torch.Tensor): (3,3) Voxel index to camera rotation
+            trans (torch.Tensor): (3,) Camera coordinates of voxel (0,0,0)
+            intr (torch.Tensor): (4,) fx, fy, cx, cy
+        """
+        fx, fy, cx, cy = intr.tolist()
+        pix_y, pix_x = torch.nonzero(depth_im > 0, as_tuple=True)
+        depth = depth_im[pix_y, pix_x]
+
+        # sample the band at half the block size, so no block is skipped
+        step = self._voxel_size * self.brick_size / 2
+        num_steps = int(np.ceil(2 * self._trunc_margin / step)) + 1
+        band = torch.linspace(
+            -self._trunc_margin, self._trunc_margin, num_steps, device=self.device
+        )
+        pix_z = (depth[:, None] + band).reshape(-1)
+        pix_x = pix_x.float().repeat_interleave(num_steps)
+        pix_y = pix_y.float().repeat_interleave(num_steps)
+        cam = torch.stack(
+            [(pix_x - cx) * pix_z / fx, (pix_y - cy) * pix_z / fy, pix_z], -1
+        )
+        cam = cam[pix_z > 0]
+
+        # camera to voxel index, the rotation is orthogonal up to scale
+        vox = (cam - trans) @ rot / self._voxel_size**2
+        blocks = torch.floor(vox / self.brick_size).long()
+        if self._num_blocks is not None:
+            inside = ((blocks >= 0) & (blocks < self._num_blocks)).all(-1)
+            blocks = blocks[inside]
+        # unique over packed keys is much faster than over rows
+        keys = torch.unique(self.block_keys(blocks))
+        if len(self._keys) > 0:
+            pos = torch.searchsorted(self._keys, keys).clamp(max=len(self._keys) - 1)
+            keys = keys[self._keys[pos] != keys]
+        if len(keys) == 0:
+            return
+        blocks = self.unpack_keys(keys)
+
+        num_new = len(blocks)
+        if self._num_bricks + num_new > len(self._tsdf_vol):
+            capacity = max(len(self._tsdf_vol), 1)
+            while capacity < self._num_bricks + num_new:
+                capacity *= 2
+            if self._num_blocks is not None:
+                # blocks outside of the bounds are never allocated
+                max_blocks = int(torch.prod(self._num_blocks))
+                capacity = max(min(capacity, max_blocks), self._num_bricks + num_new)
+            self.grow(capacity)
+        slots = torch.arange(self._num_bricks, self._num_bricks + num_new, device=self.device)
+        self._brick_coords[slots] = blocks * self.brick_size
+        self._num_bricks += num_new
+
+        keys = torch.cat([self._keys, keys])
+        self._keys, order = torch.sort(keys)
+        self._key_slots = torch.cat([self._key_slots, slots])[order]
+
+    def allocate(self, depth_ims, cam_intrs, cam_poses):
+        """Allocate the blocks around the depth of a batch of frames, without
+        integrating them. Allocating the blocks of all frames before
+        integration lets any frame carve free space in them, as in a dense
+        volume
+
+        Args:
+            depth_ims (np.array): (B,H,W) Depth images, 0 where invalid
+            cam_intrs (np.array): (B,3,3) Camera intrinsics
+            cam_poses (np.array): (B,4,4) Camera to world transforms
+        """
+        depth_ims = torch.as_tensor(
+            np.asarray(depth_ims, dtype=np.float32), device=self.device
+        )
+        rot, trans, intr = self.frame_params(cam_intrs, cam_poses)
+        for it in range(len(depth_ims)):
+            self.allocate_bricks(depth_ims[it], rot[it], trans[it], intr[it])
+
+    def get_volume(self):
+        """Allocated blocks
+
+        Returns:
+            brick_coords (np.array): (N,3) Voxel index of the first voxel of
+                each block
+            tsdf_vol (np.array): (N,B,B,B) TSDF of each block
+            color_vol (np.array): (N,B,B,B) Folded color of each block, or
+                (N,B,B,B,3) RGB color if compact
+        """
+        num = self._num_bricks
+        return (
+            self._brick_coords[:num].cpu().numpy(),
+            self._tsdf_vol[:num].float().cpu().numpy(),
+            self._color_vol[:num].cpu().numpy(),
+        )
+
+    def padded_blocks(self, vol, fill):
+        """Blocks extended by one voxel along +x, +y and +z with the voxels of
+        their neighbors, such that marching cubes over each block covers the
+        cubes between blocks
+
+        Args:
+            vol (torch.Tensor): (N,B,B,B,...) Voxel values of the allocated
+                blocks
+            fill (float): Value of the voxels of missing neighbors
+        Returns:
+            padded (torch.Tensor): (N,B+1,B+1,B+1,...) Padded blocks
+        """
+        size = self.brick_size
+        num = self._num_bricks
+        padded = torch.full(
+            (num,) + (size + 1,) * 3 + vol.shape[4:], fill, dtype=vol.dtype, device=self.device
+        )
+        padded[:, :size, :size, :size] = vol[:num]
+        blocks = self._brick_coords[:num] // size
+        for offset in grid_coords([2, 2, 2], self.device)[1:]:
+            slots = self.lookup(blocks + offset)
+            rows = torch.nonzero(slots >= 0)[:, 0]
+            dst = tuple(size if o else slice(0, size) for o in offset.tolist())
+            src = tuple(0 if o else slice(0, size) for o in offset.tolist())
+            padded[(rows,) + dst] = vol[slots[rows]][(slice(None),) + src]
+        return padded
+
+    @record_function("SparseTSDFVolume.get_mesh")
+    def get_mesh(self):
+        """Compute a mesh with marching cubes over the blocks that contain a
+        surface. Vertices shared by neighboring blocks are merged
+        """
+        tsdf_vol = self.padded_blocks(self._tsdf_vol, 1.0)
+        color_vol = self.padded_blocks(self._color_vol, 0.0)
+        flat = tsdf_vol.reshape(len(tsdf_vol), -1)
+        surface = torch.nonzero((flat.min(1).values < 0) & (flat.max(1).values > 0))[:, 0]
+        if len(surface) == 0:
+            raise RuntimeError("No surface found at the given iso value.")
+        tsdf_vol = tsdf_vol[surface].float().cpu().numpy()
+        color_vol = color_vol[surface].cpu().numpy()
+        brick_coords = self._brick_coords[surface].cpu().numpy()
+
+        # Marching cubes
+        verts, faces, norms, rgb_vals = [], [], [], []
+        num_verts = 0
+        for block_tsdf, block_color, brick_coord in zip(tsdf_vol, color_vol, brick_coords):
+            if self._vol_dim is not None:
+                # crop blocks on the border to the volume bounds
+                crop = tuple(slice(0, d) for d in self._vol_dim - brick_coord)
+                block_tsdf = block_tsdf[crop]
+                block_color = block_color[crop]
+                if min(block_tsdf.shape) < 2 or not (
+                    block_tsdf.min() < 0 < block_tsdf.max()
+                ):
+                    continue
+            block_verts, block_faces, block_norms, _ = measure.marching_cubes(
+                block_tsdf, level=0
+            )
+            verts_ind = np.round(block_verts).astype(int)
+            rgb_vals.append(block_color[verts_ind[:, 0], verts_ind[:, 1], verts_ind[:, 2]])
+            verts.append(block_verts + brick_coord)
+            faces.append(block_faces + num_verts)
+            norms.append(block_norms)
+            num_verts += len(block_verts)
+        if len(verts) == 0:
+            raise RuntimeError("No surface found at the given iso value.")
+        verts = np.concatenate(verts)
+        verts, index, inverse = np.unique(
+            verts, axis=0, return_index=True, return_inverse=True
+        )
+        faces = inverse.reshape(-1)[np.concatenate(faces)]
+        norms = np.concatenate(norms)[index]
+        rgb_vals = np.concatenate(rgb_vals)[index]
+        verts = (
+            verts * self._voxel_size + self._vol_origin
+        )  # voxel grid coordinates to world coordinates
+        colors = self.decode_colors(rgb_vals)
+        return verts, faces, norms, colors
+
+
+def grid_coords(shape, device="cpu"):
+    """Integer coordinates of a 3D grid, in C order
+
+    Args:
+        shape (List(int)): Size of the grid along each axis
+        device (str or torch.device): Device of the output
+    Returns:
+        coords (torch.Tensor): (X*Y*Z, 3) Coordinates
+    """
+    axes = [torch.arange(int(n), device=device) for n in shape]
+    return torch.stack(torch.meshgrid(*axes, indexing="ij"), -1).reshape(-1, 3)
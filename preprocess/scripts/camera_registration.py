@@ -1,10 +1,11 @@
 # Modified from https://github.com/lab4d-org/lab4d
 
 import glob
+import itertools
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
-import cv2
 import numpy as np
 import trimesh
 
@@ -19,64 +20,138 @@ sys.path.insert(
 )
 
 from libs.geometry import two_frame_registration
-from libs.io import flow_process, read_raw
+from libs.io import default_workers, flow_path, flow_process, frame_cache, read_raw
+from libs.pose_graph import optimize_pose_graph
 from libs.utils import reduce_component
 
 from utils.geom_utils import K2inv, K2mat
 from utils.vis_utils import draw_cams
 
+def register_pair(
+    img_path0, img_path1, delta, crop_size, use_full, obj_idx, num_obj, Kraw, registration_type
+):
+    """Compute the relative camera of two frames from their depth and flow
+
+    Returns:
+        cam_0_to_1 (np.array): (4,4) Transform from the camera of the first
+            frame to the camera of the second frame
+    """
+    # frames are cropped once per process, and shared by consecutive pairs
+    data_dict0 = read_raw(img_path0, delta, crop_size, use_full, obj_idx, num_obj)
+    data_dict1 = read_raw(img_path1, -delta, crop_size, use_full, obj_idx, num_obj)
+    flow_process(data_dict0, data_dict1)
+
+    # compute intrincs for the cropped images
+    K0 = K2inv(data_dict0["crop2raw"]) @ Kraw
+    K1 = K2inv(data_dict1["crop2raw"]) @ Kraw
+
+    # get mask
+    # mask = data_dict0["mask"][..., 0].astype(int) == 1 if obj_idx is not None else 0
+    if obj_idx is not None:#component_id > 0:
+        mask = data_dict0["mask"][..., 0].astype(int) == 1
+        # reduce the mask to the largest connected component
+        mask = reduce_component(mask)
+    else:
+        mask = data_dict0["mask"][..., 0].astype(int) == 0
+        # for background, additionally remove flow with low confidence
+        mask = np.logical_and(mask, data_dict0["flow"][..., 2] > 0).flatten()
+    cam_0_to_1 = two_frame_registration(
+        data_dict0["depth"],
+        data_dict1["depth"],
+        data_dict0["flow"],
+        K0,
+        K1,
+        mask,
+        registration_type,
+    )
+    return cam_0_to_1
+
+
 ### rewrite here, if bg, do not input obj_idx
-def camera_registration(seqname, crop_size, vidname, obj_idx=None, num_obj=None):
+def camera_registration(
+    seqname, crop_size, vidname, obj_idx=None, num_obj=None, workers=None
+):
+    """Register the cameras of a sequence by chaining two-frame registrations
+    of consecutive frames, then refining them with a pose graph that also
+    contains the registrations of frames 2, 4 and 8 apart, where flow was
+    computed. Pairs are registered independently by a pool of processes.
+
+    Args:
+        workers (int or None): Number of processes. Defaults to the
+            REACTO_WORKERS environment variable, or the number of CPUs capped
+            by the number of pairs
+    """
     imgdir = "database/processed_%s/JPEGImages/Full-Resolution/%s" % (vidname, seqname)
     imglist = sorted(glob.glob("%s/*.jpg" % imgdir))
-    delta = 1
+    delta_list = [1, 2, 4, 8]
     use_full = True
-    registration_type = "procrustes"
+    registration_type = "procrustes_robust"
 
     # get camera intrinsics
-    raw_shape = cv2.imread(imglist[0]).shape[:2]
+    raw_shape = frame_cache.imread(imglist[0]).shape[:2]
     max_l = max(raw_shape)
     Kraw = np.array([max_l, max_l, raw_shape[1] / 2, raw_shape[0] / 2])
     Kraw = K2mat(Kraw)
 
-    cam_current = np.eye(4)  # scene to camera: I, R01 I, R12 R01 I, ...
-    cams = [cam_current]
-    for im0idx in range(len(imglist)):
-        if im0idx + delta >= len(imglist):
-            continue
+    # flow of delta > 1 is computed between frames divisible by delta. Pairs
+    # are sorted by their first frame, so that the pairs of a chunk share
+    # cropped frames
+    pairs = []
+    for delta in delta_list:
+        for im0idx in range(0, len(imglist) - delta, delta):
+            img_path0 = imglist[im0idx]
+            img_path1 = imglist[im0idx + delta]
+            if delta > 1 and not (
+                os.path.exists(flow_path(img_path0, delta))
+                and os.path.exists(flow_path(img_path1, -delta))
+            ):
+                continue
+            pairs.append((im0idx, im0idx + delta))
+    pairs.sort()
+    pair_args = []
+    for im0idx, im1idx in pairs:
         # TODO: load croped images directly
-        frameid0 = int(imglist[im0idx].split("/")[-1].split(".")[0])
-        frameid1 = int(imglist[im0idx + delta].split("/")[-1].split(".")[0])
         # print("%s %d %d" % (seqname, frameid0, frameid1))
-        data_dict0 = read_raw(imglist[im0idx], delta, crop_size, use_full, obj_idx, num_obj)
-        data_dict1 = read_raw(imglist[im0idx + delta], -delta, crop_size, use_full, obj_idx, num_obj)
-        flow_process(data_dict0, data_dict1)
-
-        # compute intrincs for the cropped images
-        K0 = K2inv(data_dict0["crop2raw"]) @ Kraw
-        K1 = K2inv(data_dict1["crop2raw"]) @ Kraw
-
-        # get mask
-        # mask = data_dict0["mask"][..., 0].astype(int) == 1 if obj_idx is not None else 0
-        if obj_idx is not None:#component_id > 0:
-            mask = data_dict0["mask"][..., 0].astype(int) == 1
-            # reduce the mask to the largest connected component
-            mask = reduce_component(mask)
-        else:
-            mask = data_dict0["mask"][..., 0].astype(int) == 0
-            # for background, additionally remove flow with low confidence
-            mask = np.logical_and(mask, data_dict0["flow"][..., 2] > 0).flatten()
-        cam_0_to_1 = two_frame_registration(
-            data_dict0["depth"],
-            data_dict1["depth"],
-            data_dict0["flow"],
-            K0,
-            K1,
-            mask,
-            registration_type,
+        pair_args.append(
+            (
+                imglist[im0idx],
+                imglist[im1idx],
+                im1idx - im0idx,
+                crop_size,
+                use_full,
+                obj_idx,
+                num_obj,
+                Kraw,
+                registration_type,
+            )
+        )
+    workers = default_workers(len(pair_args), workers)
+    if workers > 1 and len(pair_args) > 1:
+        # consecutive pairs go to the same process, which crops their shared
+        # frames once
+        chunksize = -(-len(pair_args) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            cams_0_to_1 = list(
+                pool.map(register_pair, *zip(*pair_args), chunksize=chunksize)
+            )
+    else:
+        cams_0_to_1 = [register_pair(*args) for args in pair_args]
+
+    # initialize with the chained registrations of consecutive frames
+    # scene to camera: I, R01 I, R12 R01 I, ...
+    cams_odometry = [
+        cam for (im0idx, im1idx), cam in zip(pairs, cams_0_to_1) if im1idx == im0idx + 1
+    ]
+    cams = list(
+        itertools.accumulate(
+            cams_odometry,
+            lambda cam_current, cam_0_to_1: cam_0_to_1 @ cam_current,
+            initial=np.eye(4),
         )
-        cam_current = cam_0_to_1 @ cam_current
-        cams.append(cam_current)
+    )
+    if len(pairs) > len(cams) - 1:
+        idx0, idx1 = np.array(pairs).T
+        cams = optimize_pose_graph(np.stack(cams), idx0, idx1, np.stack(cams_0_to_1))
 
     os.makedirs(imgdir.replace("JPEGImages", "Cameras"), exist_ok=True)
     save_path = imgdir.replace("JPEGImages", "Cameras")
@@ -96,6 +171,7 @@ def camera_registration(seqname, crop_size, vidname, obj_idx=None, num_obj=None)
         mesh_cam.export("%s/cameras-bg.obj" % (save_path))
 
         print("camera registration done: %s, bg" % (seqname))
+    print("frame cache: %s" % frame_cache.stats())
 
 if __name__ == "__main__":
     seqname = sys.argv[1]
@@ -4,7 +4,6 @@ import glob
 import os
 import sys
 
-import cv2
 import numpy as np
 import torch
 import torch.nn as nn
@@ -26,12 +25,13 @@ sys.path.insert(
     "%s/../../" % os.path.join(os.path.dirname(__file__)),
 )
 
-from libs.io import get_bbox, read_images_densepose
+from libs.io import frame_cache, get_bbox, read_images_densepose
 from libs.torch_models import CanonicalRegistration, get_class
 from libs.utils import robust_rot_align
 from viewpoint.dp_viewpoint import ViewponitNet
 
 from utils.geom_utils import K2inv, K2mat, Kmatinv
+from utils.gpu_utils import cached_model
 from utils.quat_transform import quaternion_translation_to_se3
 from utils.vis_utils import draw_cams
 
@@ -63,6 +63,13 @@ def save_resampled_feat(imglist, feats, dp2raws, prefix, crop_size, obj_idx):
     return feats
 
 
+def load_viewpoint_net(is_human):
+    viewpoint_net = ViewponitNet(is_human=is_human)
+    viewpoint_net.cuda()
+    viewpoint_net.eval()
+    return viewpoint_net
+
+
 def canonical_registration(seqname, crop_size, vidname, obj_idx, obj_class):
     # load rgb/depth
     imgdir = "database/processed_%s/JPEGImages/Full-Resolution/%s" % (vidname, seqname)
@@ -90,9 +97,9 @@ def canonical_registration(seqname, crop_size, vidname, obj_idx, obj_class):
             is_human = False
         else:
             raise ValueError("Unknown object class: %s" % obj_class)
-        viewpoint_net = ViewponitNet(is_human=is_human)
-        viewpoint_net.cuda()
-        viewpoint_net.eval()
+        viewpoint_net = cached_model(
+            "viewpoint-%s" % obj_class, lambda: load_viewpoint_net(is_human)
+        )
 
         # densepose inference
         rgbs, masks = read_images_densepose(imglist, obj_idx)
@@ -139,7 +146,7 @@ def canonical_registration(seqname, crop_size, vidname, obj_idx, obj_class):
         bbox = get_bbox(imgpath, obj_idx=obj_idx)
         if bbox is None:
             continue
-        shape = cv2.imread(imgpath).shape[:2]
+        shape = frame_cache.imread(imgpath).shape[:2]
 
         focal = max(shape)
         depth = focal / np.sqrt(bbox[2] * bbox[3])
@@ -3,6 +3,8 @@
 import glob
 import os
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from tqdm import tqdm
@@ -12,132 +14,352 @@ sys.path.insert(
     "%s/../" % os.path.join(os.path.dirname(__file__)),
 )
 
-from libs.io import flow_process, read_raw
+sys.path.insert(
+    0,
+    "%s/../../" % os.path.join(os.path.dirname(__file__)),
+)
 
+from libs.io import (
+    NpyWriter,
+    crop_flow,
+    default_workers,
+    crop_image,
+    crop_mask,
+    flow_path,
+    flow_process_batch,
+    frame_cache,
+    read_depth,
+    read_flow,
+    read_mask,
+)
+from utils.geom_utils import compute_crop_params
+from utils.pack_utils import write_pack
 
-def extract_crop(seqname, crop_size, vidname, use_full, obj_idx):
-    if use_full:
-        save_prefix = "full"
-    else:
-        save_prefix = "crop"
-    save_prefix = "%s-%d" % (save_prefix, crop_size)
+DELTA_LIST = [1, 2, 4, 8]
 
-    delta_list = [1, 2, 4, 8]
 
-    flowfw_list = {delta: [] for delta in delta_list}
-    flowbw_list = {delta: [] for delta in delta_list}
-    rgb_list = []
-    mask_list = []
-    depth_list = []
-    crop2raw_list = []
-    is_detected_list = []
+def extract_crop(seqname, crop_size, vidname, use_full, obj_idx, workers=None):
+    """Crop frames around one object, or keep full frames. The full-frame
+    rgb/depth/flow are shared by all objects and only saved for object 0
+    """
+    extract_crop_targets(
+        seqname,
+        crop_size,
+        vidname,
+        [(use_full, obj_idx)],
+        save_shared=obj_idx == 0,
+        workers=workers,
+    )
 
-    imglist = sorted(
-        glob.glob("database/processed_%s/JPEGImages/Full-Resolution/%s/*.jpg" % (vidname, seqname))
+
+def extract_crop_multi(seqname, crop_size, vidname, obj_indices, workers=None):
+    """Crop frames around several objects and save full frames in one pass.
+    Each frame, depth and flow is read once, and crops that coincide, e.g. full
+    frames or objects without detection, are only computed once.
+    """
+    targets = [(use_full, obj_idx) for obj_idx in obj_indices for use_full in [0, 1]]
+    extract_crop_targets(
+        seqname, crop_size, vidname, targets, save_shared=True, workers=workers
     )
-    for im0idx in tqdm(range(len(imglist))):
-        for delta in delta_list:
-            if im0idx % delta != 0:
-                continue
-            if im0idx + delta >= len(imglist):
-                continue
-            # print("%s %d %d" % (seqname, frameid0, frameid1))
-            data_dict0 = read_raw(imglist[im0idx], delta, crop_size, use_full, obj_idx)
-            data_dict1 = read_raw(imglist[im0idx + delta], -delta, crop_size, use_full, obj_idx)
-            flow_process(data_dict0, data_dict1)
-
-            # save img, mask, vis2d
-            if delta == 1:
-                rgb_list.append(data_dict0["img"])
-                mask_list.append(data_dict0["mask"])
-                depth_list.append(data_dict0["depth"])
-                crop2raw_list.append(data_dict0["crop2raw"])
-                is_detected_list.append(data_dict0["is_detected"])
-
-                if im0idx == len(imglist) - 2:
-                    rgb_list.append(data_dict1["img"])
-                    mask_list.append(data_dict1["mask"])
-                    depth_list.append(data_dict1["depth"])
-                    crop2raw_list.append(data_dict1["crop2raw"])
-                    is_detected_list.append(data_dict1["is_detected"])
-
-            flowfw_list[delta].append(data_dict0["flow"])
-            flowbw_list[delta].append(data_dict1["flow"])
 
-    # save cropped data
-    
-    if use_full: ## use_full, only save once for flow/rgb/depth
-        if obj_idx == 0:  ## only save once, remove obj_idx in name
-            for delta in delta_list:
-                if len(flowfw_list[delta]) == 0:
-                    continue
-                np.save(
-                    "database/processed_%s/FlowFW_%d/Full-Resolution/%s/%s.npy"
-                    % (vidname, delta, seqname, save_prefix),
-                    np.stack(flowfw_list[delta], 0),
-                )
-                np.save(
-                    "database/processed_%s/FlowBW_%d/Full-Resolution/%s/%s.npy"
-                    % (vidname, delta, seqname, save_prefix),
-                    np.stack(flowbw_list[delta], 0),
-                )
-            
-            np.save(
-                "database/processed_%s/JPEGImages/Full-Resolution/%s/%s.npy"
-                % (vidname, seqname, save_prefix),
-                np.stack(rgb_list, 0),
-            )
-            
-            np.save(
-                "database/processed_%s/Depth/Full-Resolution/%s/%s.npy" 
-                % (vidname, seqname, save_prefix),
-                np.stack(depth_list, 0),
-            )
-    else:
-        for delta in delta_list:
-            if len(flowfw_list[delta]) == 0:
-                continue
-            np.save(
-                "database/processed_%s/FlowFW_%d/Full-Resolution/%s/%s-%02d.npy"
-                % (vidname, delta, seqname, save_prefix, obj_idx),
-                np.stack(flowfw_list[delta], 0),
+
+def crop_writers(seqdir, num_frames, crop_size, use_full, obj_idx, save_shared):
+    """Create the writers of the outputs of a crop target, see `extract_crop`
+
+    Args:
+        seqdir (str): Sequence directory, with %s in place of the data type
+        num_frames (int): Number of frames of the sequence
+        crop_size (int): Side length of the crop, in pixels
+        use_full (bool): If True, full frames are kept instead of crops
+        obj_idx (int): Object index
+        save_shared (bool): If True, also write rgb, depth and flow. Those of
+            full frames are shared by all objects and saved without obj_idx
+    Returns:
+        writers (Dict(str, NpyWriter)): Maps data_dict keys, and
+            "flowfw_%d"/"flowbw_%d" for each delta, to writers
+    """
+    save_prefix = "%s-%d" % ("full" if use_full else "crop", crop_size)
+    obj_name = "%s-%02d.npy" % (save_prefix, obj_idx)
+    shared_name = "%s.npy" % save_prefix if use_full else obj_name
+
+    writers = {
+        "mask": NpyWriter("%s/%s" % (seqdir % "Annotations", obj_name), num_frames),
+        "crop2raw": NpyWriter(
+            "%s/%s-crop2raw-%02d.npy" % (seqdir % "Annotations", save_prefix, obj_idx),
+            num_frames,
+        ),
+        "is_detected": NpyWriter(
+            "%s/%s-is_detected-%02d.npy" % (seqdir % "Annotations", save_prefix, obj_idx),
+            num_frames,
+        ),
+    }
+    if save_shared or not use_full:
+        writers["img"] = NpyWriter("%s/%s" % (seqdir % "JPEGImages", shared_name), num_frames)
+        writers["depth"] = NpyWriter("%s/%s" % (seqdir % "Depth", shared_name), num_frames)
+        # one flow pair per frame im0idx divisible by delta with
+        # im0idx + delta < num_frames
+        for delta in DELTA_LIST:
+            num_pairs = len(range(0, num_frames - delta, delta))
+            writers["flowfw_%d" % delta] = NpyWriter(
+                "%s/%s" % (seqdir % ("FlowFW_%d" % delta), shared_name), num_pairs
             )
-            np.save(
-                "database/processed_%s/FlowBW_%d/Full-Resolution/%s/%s-%02d.npy"
-                % (vidname, delta, seqname, save_prefix, obj_idx),
-                np.stack(flowbw_list[delta], 0),
+            writers["flowbw_%d" % delta] = NpyWriter(
+                "%s/%s" % (seqdir % ("FlowBW_%d" % delta), shared_name), num_pairs
             )
-        
-        np.save(
-            "database/processed_%s/JPEGImages/Full-Resolution/%s/%s-%02d.npy"
-            % (vidname, seqname, save_prefix, obj_idx),
-            np.stack(rgb_list, 0),
-        )
-        
-        np.save(
-            "database/processed_%s/Depth/Full-Resolution/%s/%s-%02d.npy" 
-            % (vidname, seqname, save_prefix, obj_idx),
-            np.stack(depth_list, 0),
+    return writers
+
+
+def read_crop_frame(img_path, crop_size, targets):
+    """Read a raw frame once and crop it for each target. Targets with the same
+    crop parameters share the cropped image and depth
+
+    Args:
+        img_path (str): Path to a jpg frame
+        crop_size (int): Side length of the crop, in pixels
+        targets (List(Tuple(bool, int))): (use_full, obj_idx) of each crop
+    Returns:
+        frame (Dict): Maps "shape" to the raw shape and each target to its
+            cropped data_dict, see `read_raw`
+    """
+    img = frame_cache.imread(img_path)[..., ::-1] / 255.0
+    shape = img.shape
+    depth = read_depth(img_path.replace("JPEGImages", "Depth").replace(".jpg", ".npy"), shape)
+
+    frame = {"shape": shape}
+    masks = {}
+    crops = {}  # crop2raw bytes -> cropped image and depth
+    for use_full, obj_idx in targets:
+        if obj_idx not in masks:
+            masks[obj_idx] = read_mask(img_path, shape, obj_idx)
+        mask, vis2d, is_detected = masks[obj_idx]
+        # force using full if there is no detection
+        crop2raw = compute_crop_params(
+            mask, crop_size=crop_size, use_full=use_full or not is_detected
         )
-    np.save(
-        "database/processed_%s/Annotations/Full-Resolution/%s/%s-%02d.npy"
-        % (vidname, seqname, save_prefix, obj_idx),
-        np.stack(mask_list, 0),
-    )
+        key = crop2raw.tobytes()
+        if key not in crops:
+            crops[key] = crop_image(img, depth, crop2raw, crop_size)
+        data_dict = dict(crops[key])
+        data_dict["mask"] = crop_mask(mask, vis2d, data_dict["hp_raw"])
+        data_dict["is_detected"] = is_detected
+        frame[(use_full, obj_idx)] = data_dict
+    return frame
 
-    np.save(
-        "database/processed_%s/Annotations/Full-Resolution/%s/%s-crop2raw-%02d.npy"
-        % (vidname, seqname, save_prefix, obj_idx),
-        np.stack(crop2raw_list, 0),
-    )
 
-    np.save(
-        "database/processed_%s/Annotations/Full-Resolution/%s/%s-is_detected-%02d.npy"
-        % (vidname, seqname, save_prefix, obj_idx),
-        np.stack(is_detected_list, 0),
+def crop_pair_flows(img_path0, img_path1, delta, frame0, frame1, targets):
+    """Crop and process the forward and backward flow between two frames for
+    each target. Targets with the same crop parameters in both frames share
+    the result
+
+    Args:
+        img_path0 (str): Path to the first jpg frame
+        img_path1 (str): Path to the jpg frame `delta` frames later
+        delta (int): Frame offset of the flow
+        frame0 (Future): Result of `read_crop_frame` for the first frame
+        frame1 (Future): Result of `read_crop_frame` for the second frame
+        targets (List(Tuple(bool, int))): (use_full, obj_idx) of each crop
+    Returns:
+        flows (Dict): Maps each target to its (S,S,3) forward and backward
+            flow, float16
+    """
+    frame0 = frame0.result()
+    frame1 = frame1.result()
+    flow0, occ0 = read_flow(flow_path(img_path0, delta), frame0["shape"])
+    flow1, occ1 = read_flow(flow_path(img_path1, -delta), frame1["shape"])
+
+    # targets with the same crop parameters in both frames share the flows
+    keys = {}  # crop2raw bytes of both frames -> first target
+    for target in targets:
+        key = (frame0[target]["crop2raw"].tobytes(), frame1[target]["crop2raw"].tobytes())
+        keys.setdefault(key, target)
+
+    batch = {"flow0": [], "flow1": [], "occ0": [], "occ1": [], "crop2raw0": [], "crop2raw1": []}
+    for target in keys.values():
+        data_dict0 = frame0[target]
+        data_dict1 = frame1[target]
+        flow, occ = crop_flow(flow0, occ0, data_dict0["hp_raw"])
+        batch["flow0"].append(flow)
+        batch["occ0"].append(occ)
+        flow, occ = crop_flow(flow1, occ1, data_dict1["hp_raw"])
+        batch["flow1"].append(flow)
+        batch["occ1"].append(occ)
+        batch["crop2raw0"].append(data_dict0["crop2raw"])
+        batch["crop2raw1"].append(data_dict1["crop2raw"])
+    batch = {k: np.stack(v, 0) for k, v in batch.items()}
+    flowfw, flowbw = flow_process_batch(**batch)
+
+    shared = {key: (flowfw[i], flowbw[i]) for i, key in enumerate(keys.keys())}
+    flows = {}
+    for target in targets:
+        key = (frame0[target]["crop2raw"].tobytes(), frame1[target]["crop2raw"].tobytes())
+        flows[target] = shared[key]
+    return flows
+
+
+def extract_crop_targets(seqname, crop_size, vidname, targets, save_shared, workers=None):
+    """Crop a sequence for several (use_full, obj_idx) targets in one pass over
+    the frames and flows, see `extract_crop`.
+
+    Frames and frame pairs are processed by a pool of threads, since cv2 and
+    numpy release the GIL, and results are written in order as they complete.
+
+    Args:
+        workers (int or None): Number of threads. Defaults to the
+            REACTO_WORKERS environment variable, or the number of CPUs capped
+            by the number of frames
+    """
+    imglist = sorted(
+        glob.glob("database/processed_%s/JPEGImages/Full-Resolution/%s/*.jpg" % (vidname, seqname))
     )
+    num_frames = len(imglist)
+    workers = default_workers(num_frames, workers)
+    seqdir = "database/processed_%s/%%s/Full-Resolution/%s" % (vidname, seqname)
+
+    # outputs are written frame by frame
+    writers = {}
+    for use_full, obj_idx in targets:
+        writers[(use_full, obj_idx)] = crop_writers(
+            seqdir, num_frames, crop_size, use_full, obj_idx, save_shared
+        )
+        if use_full:  # full-frame rgb/depth/flow are only saved once
+            save_shared = False
+    flow_targets = [t for t in targets if "flowfw_1" in writers[t]]
+
+    def write_frame(frameid, frame):
+        for target, target_writers in writers.items():
+            for k in ["img", "mask", "depth", "crop2raw", "is_detected"]:
+                if k in target_writers:
+                    target_writers[k].write(frameid, frame[target][k])
+
+    def write_flows(im0idx, delta, flows):
+        for target, (flowfw, flowbw) in flows.items():
+            writers[target]["flowfw_%d" % delta].write(im0idx // delta, flowfw)
+            writers[target]["flowbw_%d" % delta].write(im0idx // delta, flowbw)
+
+    # frames are read ahead of the pairs that use them. A task only waits for
+    # tasks submitted before it, so the pool cannot deadlock
+    max_delta = max(DELTA_LIST)
+    frames = {}  # frame id -> future of the cropped frame
+    pending = deque()  # (im0idx, delta, future of the cropped flows)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for im0idx in tqdm(range(num_frames)):
+            for frameid in [i for i in frames.keys() if i < im0idx]:
+                del frames[frameid]
+            for frameid in range(im0idx, min(im0idx + max_delta + workers, num_frames)):
+                if frameid not in frames:
+                    frames[frameid] = pool.submit(
+                        read_crop_frame, imglist[frameid], crop_size, targets
+                    )
+
+            for delta in DELTA_LIST:
+                if im0idx % delta != 0:
+                    continue
+                if im0idx + delta >= num_frames:
+                    continue
+                # print("%s %d %d" % (seqname, frameid0, frameid1))
+                frame0 = frames[im0idx]
+                frame1 = frames[im0idx + delta]
+
+                # save img, mask, vis2d
+                if delta == 1:
+                    write_frame(im0idx, frame0.result())
+                    if im0idx == num_frames - 2:
+                        write_frame(im0idx + 1, frame1.result())
+
+                if len(flow_targets) > 0:
+                    future = pool.submit(
+                        crop_pair_flows,
+                        imglist[im0idx],
+                        imglist[im0idx + delta],
+                        delta,
+                        frame0,
+                        frame1,
+                        flow_targets,
+                    )
+                    pending.append((im0idx, delta, future))
+
+            # bound the number of results kept in memory
+            while len(pending) > 0 and (
+                len(pending) > 2 * workers or pending[0][2].done()
+            ):
+                im0idx_done, delta, future = pending.popleft()
+                write_flows(im0idx_done, delta, future.result())
+        while len(pending) > 0:
+            im0idx_done, delta, future = pending.popleft()
+            write_flows(im0idx_done, delta, future.result())
+
+    # save cropped data
+    for target_writers in writers.values():
+        for writer in target_writers.values():
+            writer.close()
+
+    for use_full, obj_idx in targets:
+        print("crop (size: %d, full: %d, obj: %d) done: %s" % (crop_size, use_full, obj_idx, seqname))
+    print("frame cache: %s" % frame_cache.stats())
+
+
+def pack_crop(
+    seqname, crop_size, vidname, use_full, obj_idx, feature_type="dinov2", tile_size=16
+):
+    """Pack the per-frame outputs of `extract_crop` (and features/normals, if
+    they exist) into a single frame-major file read by VidDataset. Pixel-aligned
+    modalities are interleaved in tile_size x tile_size tiles, unless tile_size
+    is None. The feature type and the modification time of each source file
+    are stored in the header, such that VidDataset can detect stale entries
+    """
+    if use_full:
+        save_prefix = "full"
+    else:
+        save_prefix = "crop"
+    save_prefix = "%s-%d" % (save_prefix, crop_size)
+    seqdir = "database/processed_%s/%%s/Full-Resolution/%s" % (vidname, seqname)
+    if use_full:  # rgb/depth/flow of full frames are shared by all objects
+        shared_name = "%s.npy" % save_prefix
+    else:
+        shared_name = "%s-%02d.npy" % (save_prefix, obj_idx)
+    obj_name = "%s-%02d.npy" % (save_prefix, obj_idx)
+
+    paths = {
+        "rgb": "%s/%s" % (seqdir % "JPEGImages", shared_name),
+        "mask": "%s/%s" % (seqdir % "Annotations", obj_name),
+        "depth": "%s/%s" % (seqdir % "Depth", shared_name),
+        "normal": "%s/%s" % (seqdir % "Normal", shared_name),
+        "feature": "%s/%s-%s-%02d.npy"
+        % (seqdir % "Features", save_prefix, feature_type, obj_idx),
+    }
+    for delta in DELTA_LIST:
+        flowfw_dir = seqdir % ("FlowFW_%d" % delta)
+        flowbw_dir = seqdir % ("FlowBW_%d" % delta)
+        paths["flowfw_%d" % delta] = "%s/%s" % (flowfw_dir, shared_name)
+        paths["flowbw_%d" % delta] = "%s/%s" % (flowbw_dir, shared_name)
+
+    arrays = {}
+    frame_ids = {}
+    for k, path in paths.items():
+        if not os.path.exists(path):
+            continue
+        arrays[k] = np.load(path, mmap_mode="r")
+        entry_ids = np.arange(len(arrays[k]))
+        if k.startswith("flowfw_"):
+            # forward flow from frame i*delta
+            frame_ids[k] = entry_ids * int(k.split("_")[1])
+        elif k.startswith("flowbw_"):
+            # backward flow from frame (i+1)*delta
+            frame_ids[k] = (entry_ids + 1) * int(k.split("_")[1])
+        else:
+            frame_ids[k] = entry_ids
 
-    print("crop (size: %d, full: %d) done: %s" % (crop_size, use_full, seqname))
+    num_frames = len(arrays["rgb"])
+    save_dir = seqdir % "Packed"
+    os.makedirs(save_dir, exist_ok=True)
+    save_path = "%s/%s" % (save_dir, obj_name.replace(".npy", ".npk"))
+    tile_keys = [k for k in arrays.keys() if k != "feature"]
+    meta = {
+        "feature_type": feature_type,
+        "mtimes": {k: os.path.getmtime(paths[k]) for k in arrays.keys()},
+    }
+    write_pack(save_path, arrays, frame_ids, num_frames, tile_size, tile_keys, meta)
+    print("pack (size: %d, full: %d) done: %s" % (crop_size, use_full, seqname))
 
 
 if __name__ == "__main__":
@@ -3,19 +3,26 @@
 import glob
 import os
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 import trimesh
-from PIL import Image
 
 sys.path.insert(
     0,
     "%s/../" % os.path.join(os.path.dirname(__file__)),
 )
+sys.path.insert(
+    0,
+    "%s/../../" % os.path.join(os.path.dirname(__file__)),
+)
 
 
+from libs.io import frame_cache
 from libs.utils import resize_to_target
+from utils.gpu_utils import cached_model
 
 
 def depth2pts(depth):
@@ -34,30 +41,108 @@ def depth2pts(depth):
     return xyz.T
 
 
-def extract_depth(seqname, vidname):
+def load_zoe_model(device="cuda"):
+    model_zoe_nk = torch.hub.load("isl-org/ZoeDepth", "ZoeD_NK", pretrained=True)
+    zoe = model_zoe_nk.to(device).eval()
+    return zoe
+
+
+def zoe_depth_model(device):
+    """Batched ZoeDepth inference. The model is loaded once per process and
+    device
+
+    Args:
+        device (str): Device of the model
+    Returns:
+        model (Function): Maps (B,3,H,W) RGB images in [0,1] to (B,H,W) metric
+            depth, with the padding and flip augmentation of `zoe.infer_pil`
+    """
+    zoe = cached_model("ZoeD_NK", lambda: load_zoe_model(device), device=device)
+    return lambda images: zoe.infer(images)[:, 0]
+
+
+def read_depth_input(img_path):
+    """Decode a frame and resize it to the resolution of the saved depth
+
+    Returns:
+        image (np.array): (H,W,3) RGB image, uint8
+        raw_shape (Tuple(int)): Shape of the frame before resizing
+    """
+    image = frame_cache.imread(img_path)
+    raw_shape = image.shape[:2]
+    image = resize_to_target(image)[..., ::-1]  # BGR to RGB
+    return image, raw_shape
+
+
+def write_depth(out_path, depth, raw_shape):
+    """Resize a depth map to the target resolution of a frame and save it"""
+    depth = resize_to_target(depth, aspect_ratio=raw_shape, is_flow=False)
+    np.save(out_path, depth.astype(np.float16))
+
+
+def extract_depth(
+    seqname, vidname, batch_size=8, device=None, model=None, queue_size=16
+):
+    """Predict the metric depth of all frames of a video. A reader thread
+    decodes and resizes frames ahead of the batches that use them, and a writer
+    thread resizes and saves depth, while batches of frames run through the
+    model.
+
+    Args:
+        seqname (str): Name of the video
+        vidname (str): Name of the video collection
+        batch_size (int): Number of frames per forward pass
+        device (str or None): Device of the model. Defaults to cuda if
+            available, else cpu
+        model (Function or None): Maps (B,3,H,W) RGB images in [0,1] on
+            `device` to (B,H,W) depth. Defaults to ZoeD_NK
+        queue_size (int): Maximum number of frames read ahead, and of depth
+            maps waiting to be saved
+    """
     image_dir = "database/processed_%s/JPEGImages/Full-Resolution/%s/" % (vidname, seqname)
     output_dir = image_dir.replace("JPEGImages", "Depth")
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
 
     # torch.hub.help(
     #     "intel-isl/MiDaS", "DPT_BEiT_L_384", force_reload=True
     # )  # Triggers fresh download of MiDaS repo
 
-    model_zoe_nk = torch.hub.load("isl-org/ZoeDepth", "ZoeD_NK", pretrained=True)
-    zoe = model_zoe_nk.to("cuda")
+    # loaded once per process
+    if model is None:
+        model = zoe_depth_model(device)
 
+    img_paths = sorted(glob.glob(f"{image_dir}/*.jpg"))
     os.makedirs(output_dir, exist_ok=True)
-    for img_path in sorted(glob.glob(f"{image_dir}/*.jpg")):
-        # print(img_path)
-        image = Image.open(img_path)
-        depth = zoe.infer_pil(image)
-        depth = resize_to_target(depth, is_flow=False).astype(np.float16)
-        out_path = f"{output_dir}/{os.path.basename(img_path).replace('.jpg', '.npy')}"
-        np.save(out_path, depth)
-        # pts = depth2pts(depth)
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(
+        max_workers=1
+    ) as writer:
+        frames = deque()  # futures of frames read ahead
+        saved = deque()  # futures of depth maps being saved
+        for img_path in img_paths[: queue_size + batch_size]:
+            frames.append(reader.submit(read_depth_input, img_path))
+        for start in range(0, len(img_paths), batch_size):
+            batch_paths = img_paths[start : start + batch_size]
+            images, raw_shapes = zip(*[frames.popleft().result() for _ in batch_paths])
+            next_paths = img_paths[start + queue_size + batch_size :][: len(batch_paths)]
+            for img_path in next_paths:
+                frames.append(reader.submit(read_depth_input, img_path))
+
+            images = torch.as_tensor(np.stack(images), device=device)
+            images = images.permute(0, 3, 1, 2).float() / 255
+            with torch.no_grad():
+                depths = model(images).float().cpu().numpy()
+
+            for img_path, depth, raw_shape in zip(batch_paths, depths, raw_shapes):
+                out_path = f"{output_dir}/{os.path.basename(img_path).replace('.jpg', '.npy')}"
+                saved.append(writer.submit(write_depth, out_path, depth, raw_shape))
+            while len(saved) > queue_size:
+                saved.popleft().result()
+        for future in saved:
+            future.result()
 
     print("zoe depth done: ", seqname)
 
-
 if __name__ == "__main__":
     seqname = sys.argv[1]
 
@@ -23,7 +23,7 @@ sys.path.insert(
 
 from libs.io import read_frame_data
 
-from utils.gpu_utils import gpu_map
+from utils.gpu_utils import cached_model, gpu_map
 
 
 def extract_dino_feat(dinov2_model, rgb, size=None):
@@ -63,8 +63,17 @@ def load_dino_model(gpu_id=0):
     return dinov2_model
 
 
-def extract_dinov2_seq(seqname, crop_size, vidname, use_full, obj_idx, pca_save):
-    dinov2_model = load_dino_model()
+def get_dino_model(gpu_id=0):
+    """DINOv2 model, loaded once per process and device"""
+    return cached_model(
+        "dinov2_vits14", lambda: load_dino_model(gpu_id), device="cuda:%d" % gpu_id
+    )
+
+
+def extract_dinov2_seq(
+    seqname, crop_size, vidname, use_full, obj_idx, pca_save, gpu_id=0
+):
+    dinov2_model = get_dino_model(gpu_id)
     # rgb path
     imgdir = "database/processed_%s/JPEGImages/Full-Resolution/%s" % (vidname,seqname)
     save_path = imgdir.replace("JPEGImages", "Cameras")
@@ -117,7 +126,7 @@ def extract_dinov2_seq(seqname, crop_size, vidname, use_full, obj_idx, pca_save)
 
 
 def extract_dinov2(seqname, crop_size, vidname, obj_idx=None, gpulist=[0]):
-    dinov2_model = load_dino_model(gpu_id=gpulist[0])
+    dinov2_model = get_dino_model(gpu_id=gpulist[0])
     # compute pca matrix over all frames
     # load image path
     config = configparser.RawConfigParser()
@@ -163,7 +172,12 @@ def extract_dinov2(seqname, crop_size, vidname, obj_idx=None, gpulist=[0]):
         args.append((seqname, crop_size, vidname, True, obj_idx, pca_save))
         args.append((seqname, crop_size, vidname, False, obj_idx, pca_save))
 
-    gpu_map(extract_dinov2_seq, args, gpus=gpulist)
+    if len(gpulist) == 1:
+        # reuse the model loaded above, instead of loading it again in a worker
+        for arg in args:
+            extract_dinov2_seq(*arg, gpu_id=gpulist[0])
+    else:
+        gpu_map(extract_dinov2_seq, args, gpus=gpulist)
 
 
 if __name__ == "__main__":
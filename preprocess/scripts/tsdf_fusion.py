@@ -3,8 +3,8 @@ import glob
 import os
 import sys
 
-import cv2
 import numpy as np
+import torch
 import trimesh
 
 sys.path.insert(
@@ -24,7 +24,8 @@ sys.path.insert(
 )
 
 import fusion
-from libs.io import read_frame_data
+from libs.io import frame_cache, read_frame_data, read_frame_depth
+from libs.tsdf import SparseTSDFVolume, TorchTSDFVolume
 
 from utils.geom_utils import K2inv, K2mat
 from utils.vis_utils import draw_cams
@@ -38,7 +39,36 @@ from utils.vis_utils import draw_cams
 #     return cam2scene
 
 
-def tsdf_fusion(seqname, vidname, obj_idx=None, num_obj=None, crop_size=256, use_full=True):
+def tsdf_fusion(
+    seqname,
+    vidname,
+    obj_idx=None,
+    num_obj=None,
+    crop_size=256,
+    use_full=True,
+    voxel_size=0.2,
+    device=None,
+    batch_size=8,
+    sparse=False,
+    compact=True,
+):
+    """Fuse the depth of a sequence into a TSDF volume, and center the mesh
+    and cameras of the sequence at the mesh bounds
+
+    Args:
+        voxel_size (float): Side length of a voxel
+        device (str or None): Device holding the volume. Defaults to cuda if
+            available, else cpu
+        batch_size (int): Number of frames integrated at once
+        sparse (bool): If True, only allocate voxels near the observed depth,
+            otherwise allocate the whole bounding volume. Sparse volumes only
+            pay off for fine voxels in large bounds, at the default voxel size
+            the dense volume is smaller and faster
+        compact (bool): If True, store voxels as float16 TSDF/weight and uint8
+            color instead of float32
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
     # load rgb/depth
     imgdir = "database/processed_%s/JPEGImages/Full-Resolution/%s" % (vidname, seqname)
     imglist = sorted(glob.glob("%s/*.jpg" % imgdir))
@@ -52,38 +82,62 @@ def tsdf_fusion(seqname, vidname, obj_idx=None, num_obj=None, crop_size=256, use
     cams_prev = np.load(save_path)
 
     # get camera intrinsics
-    raw_shape = cv2.imread(imglist[0]).shape[:2]
+    raw_shape = frame_cache.imread(imglist[0]).shape[:2]
     max_l = max(raw_shape)
     Kraw = np.array([max_l, max_l, raw_shape[1] / 2, raw_shape[0] / 2])
     Kraw = K2mat(Kraw)
 
-    # initialize volume
+    # initialize volume. View frustums only need the depth of each frame,
+    # which is read without decoding the image. The masked crop-sized depth
+    # is kept to allocate the blocks of a sparse volume
     vol_bnds = np.zeros((3, 2))
+    frames = []  # (depth, K0, cam2scene) of each frame
     for it, imgpath in enumerate(imglist[:-1]):
-        rgb, depth, mask, crop2raw = read_frame_data(
-            imgpath, crop_size, use_full, obj_idx, num_obj
+        depth, mask, crop2raw = read_frame_depth(
+            imgpath, raw_shape, crop_size, use_full, obj_idx, num_obj
         )
         K0 = K2inv(crop2raw) @ Kraw
         # cam2scene = read_cam(imgpath, component_id)
         cam2scene = np.linalg.inv(cams_prev[it])
         depth[~mask] = 0
+        if sparse:
+            frames.append((depth.astype(np.float16), K0, cam2scene))
         depth[depth > 10] = 0
         view_frust_pts = fusion.get_view_frustum(depth, K0, cam2scene)
         vol_bnds[:, 0] = np.minimum(vol_bnds[:, 0], np.amin(view_frust_pts, axis=1))
         vol_bnds[:, 1] = np.maximum(vol_bnds[:, 1], np.amax(view_frust_pts, axis=1))
-    tsdf_vol = fusion.TSDFVolume(vol_bnds, voxel_size=0.2, use_gpu=False)
+    if sparse:
+        tsdf_vol = SparseTSDFVolume(
+            vol_bnds, voxel_size=voxel_size, device=device, compact=compact
+        )
+        # allocate the blocks of all frames first, such that each frame
+        # carves free space in the blocks observed by the others
+        for it in range(0, len(frames), batch_size):
+            batch = frames[it : it + batch_size]
+            depths, Ks, cam2scenes = [np.stack(x) for x in zip(*batch)]
+            tsdf_vol.allocate(depths, Ks, cam2scenes)
+        del frames
+    else:
+        tsdf_vol = TorchTSDFVolume(
+            vol_bnds, voxel_size=voxel_size, device=device, compact=compact
+        )
 
-    # fusion
+    # fusion, in batches of frames
+    batch = []
     for it, imgpath in enumerate(imglist[:-1]):
         # print(imgpath)
         rgb, depth, mask, crop2raw = read_frame_data(
-            imgpath, crop_size, use_full, obj_idx, num_obj
+            imgpath, crop_size, use_full, obj_idx, num_obj, with_flow=False
         )
         K0 = K2inv(crop2raw) @ Kraw
         depth[~mask] = 0
         # cam2scene = read_cam(imgpath, component_id)
         cam2scene = np.linalg.inv(cams_prev[it])
-        tsdf_vol.integrate(rgb, depth, K0, cam2scene, obs_weight=1.0)
+        batch.append((rgb, depth, K0, cam2scene))
+        if len(batch) == batch_size or it == len(imglist) - 2:
+            rgbs, depths, Ks, cam2scenes = [np.stack(x) for x in zip(*batch)]
+            tsdf_vol.integrate_batch(rgbs, depths, Ks, cam2scenes, obs_weight=1.0)
+            batch = []
 
     save_path = imgdir.replace("JPEGImages", "Cameras")
     # get mesh, compute center
@@ -120,6 +174,7 @@ def tsdf_fusion(seqname, vidname, obj_idx=None, num_obj=None, crop_size=256, use
         mesh_cam.export("%s/cameras-bg-centered.obj" % (save_path))
 
         print("tsdf fusion done: %s, bg" % (seqname))
+    print("frame cache: %s" % frame_cache.stats())
 
 
 if __name__ == "__main__":
@@ -3,6 +3,7 @@ import sys
 import os
 import pdb
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__)) + "/../../../")
 sys.path.insert(0, os.path.join(os.path.dirname(__file__)) + "/")
 sys.path.insert(0, os.path.join(os.path.dirname(__file__)) + "/tracker")
 sys.path.insert(0, os.path.join(os.path.dirname(__file__)) + "/tracker/model")
@@ -21,6 +22,7 @@ from groundingdino.util.inference import load_model, load_image, predict, annota
 from segment_anything import SamPredictor, sam_model_registry
 from tracker.base_tracker import BaseTracker
 from app import download_checkpoint, wget_checkpoint
+from utils.gpu_utils import cached_model
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -193,11 +195,25 @@ def track_anything_cli(
         image_paths.append(img_path)
         image_exts.append(img_ext)
 
-    dino_model = load_model(model_config["DINO"], model_weights["DINO"]).to(DEVICE)
-    sam_model = SamPredictor(
-        sam_model_registry["vit_h"](checkpoint=model_weights["SAM"]).to(DEVICE)
+    # loaded once per process. The tracker keeps the memory of the last video
+    dino_model = cached_model(
+        model_weights["DINO"],
+        lambda: load_model(model_config["DINO"], model_weights["DINO"]).to(DEVICE),
+        device=DEVICE,
     )
-    xmem_model = BaseTracker(model_weights["XMEM"], device=DEVICE)
+    sam_model = cached_model(
+        model_weights["SAM"],
+        lambda: SamPredictor(
+            sam_model_registry["vit_h"](checkpoint=model_weights["SAM"]).to(DEVICE)
+        ),
+        device=DEVICE,
+    )
+    xmem_model = cached_model(
+        model_weights["XMEM"],
+        lambda: BaseTracker(model_weights["XMEM"], device=DEVICE),
+        device=DEVICE,
+    )
+    xmem_model.clear_memory()
 
     boxes, annotated_frame = extract_bbox(
         dino_model, image_paths[0], text_prompt, BOX_THRESHOLD, TEXT_THRESHOLD
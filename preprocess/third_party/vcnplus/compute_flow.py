@@ -2,6 +2,10 @@
 import sys
 import os
 
+sys.path.insert(
+    0,
+    "%s/../../../" % os.path.join(os.path.dirname(__file__)),
+)
 # insert path of current file
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(
@@ -29,6 +33,7 @@ from models.inference import (
 from flowutils.flowlib import point_vec, warp_flow
 
 from libs.utils import resize_to_target
+from utils.gpu_utils import cached_model
 
 cudnn.benchmark = True
 
@@ -40,8 +45,12 @@ def compute_flow(seqname, outdir, dframe):
         1  # controls the shape of search grid. Only affect the coarse cost volume size
     )
 
-    # construct model
-    model = load_eval_checkpoint(model_path, maxdisp=maxdisp, fac=fac)
+    # construct model, once per process. The flow modules are resized to the
+    # input below, so the model can be shared by videos of any size
+    model = cached_model(
+        "%s-%d-%d" % (model_path, maxdisp, fac),
+        lambda: load_eval_checkpoint(model_path, maxdisp=maxdisp, fac=fac),
+    )
 
     fw_path = "%s/FlowFW_%d/Full-Resolution/%s/" % (outdir, dframe, seqname)
     bw_path = "%s/FlowBW_%d/Full-Resolution/%s/" % (outdir, dframe, seqname)
@@ -2,6 +2,10 @@
 import sys
 import os
 
+sys.path.insert(
+    0,
+    "%s/../../../" % os.path.join(os.path.dirname(__file__)),
+)
 # insert path of current file
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
@@ -24,6 +28,7 @@ from models.inference import (
     process_flow_input,
     make_disc_aux,
 )
+from utils.gpu_utils import cached_model
 
 cudnn.benchmark = True
 
@@ -38,8 +43,12 @@ def frame_filter(seqname, outdir):
     flow_threshold = 0.05  # flow threshold that controls frame skipping
     max_frames = 500  # maximum number of frames to keep (to avoid oom in tracking etc.)
 
-    # construct model
-    model = load_eval_checkpoint(model_path, maxdisp=maxdisp, fac=fac)
+    # construct model, once per process. The flow modules are resized to the
+    # input below, so the model can be shared by videos of any size
+    model = cached_model(
+        "%s-%d-%d" % (model_path, maxdisp, fac),
+        lambda: load_eval_checkpoint(model_path, maxdisp=maxdisp, fac=fac),
+    )
 
     # input and output images
     img_paths = sorted(
@@ -0,0 +1,83 @@
+# Benchmark extract_crop_multi with different numbers of worker threads on a
+# synthetic sequence, and check that all runs write identical outputs.
+# python scripts/benchmark_crop.py --num_frames 500 --workers 1,2,4,8
+import argparse
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from preprocess.scripts.crop import extract_crop_multi
+
+DELTA_LIST = [1, 2, 4, 8]
+
+
+def make_sequence(seqdir, num_frames, height, width, num_obj):
+    """Synthetic frames, masks of moving boxes, depth and flow at the
+    resolutions written by the preprocessing scripts"""
+    rng = np.random.default_rng(0)
+    for datatype in ["JPEGImages", "Annotations", "Depth"] + [
+        "Flow%s_%d" % (k, delta) for k in ["FW", "BW"] for delta in DELTA_LIST
+    ]:
+        os.makedirs(seqdir % datatype, exist_ok=True)
+    for it in range(num_frames):
+        name = "%05d" % it
+        img = (rng.random((height, width, 3)) * 255).astype(np.uint8)
+        cv2.imwrite("%s/%s.jpg" % (seqdir % "JPEGImages", name), img)
+        for obj_idx in range(num_obj):
+            mask = np.zeros((height, width), dtype=np.int8)
+            x0 = (it * 2 + obj_idx * width // 3) % (width // 2)
+            mask[height // 4 : height // 2, x0 : x0 + width // 4] = 1
+            np.save("%s/%s-%02d.npy" % (seqdir % "Annotations", name, obj_idx), mask)
+        depth = rng.random((height // 2, width // 2)).astype(np.float16)
+        np.save("%s/%s.npy" % (seqdir % "Depth", name), depth)
+        for k in ["FW", "BW"]:
+            for delta in DELTA_LIST:
+                flow = (rng.random((height // 2, width // 2, 3)) * 4).astype(np.float16)
+                np.save("%s/%s.npy" % (seqdir % ("Flow%s_%d" % (k, delta)), name), flow)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_frames", type=int, default=500)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--crop_size", type=int, default=256)
+    parser.add_argument("--num_obj", type=int, default=1)
+    parser.add_argument("--workers", type=str, default="1,2,4,8")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.chdir(tmpdir)
+    vidname = seqname = "synthetic"
+    seqdir = "database/processed_%s/%%s/Full-Resolution/%s" % (vidname, seqname)
+    make_sequence(seqdir, args.num_frames, args.height, args.width, args.num_obj)
+    inputs = set(glob.glob("database/**/*.npy", recursive=True))
+
+    print("%-10s %10s %15s" % ("workers", "time (s)", "frames/sec"))
+    reference = None
+    for workers in [int(n) for n in args.workers.split(",")]:
+        start = time.time()
+        extract_crop_multi(
+            seqname, args.crop_size, vidname, list(range(args.num_obj)), workers
+        )
+        total_time = time.time() - start
+        print("%-10d %10.1f %15.1f" % (workers, total_time, args.num_frames / total_time))
+
+        outputs = set(glob.glob("database/**/*.npy", recursive=True)) - inputs
+        outputs = {path: open(path, "rb").read() for path in sorted(outputs)}
+        if reference is None:
+            reference = outputs
+        assert outputs == reference, "outputs differ with %d workers" % workers
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
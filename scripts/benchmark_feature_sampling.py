@@ -0,0 +1,85 @@
+# Benchmark reading sampled features: per-frame interpolation at float16 as
+# before, and batched interpolation of float32 gathered pixels.
+# python scripts/benchmark_feature_sampling.py
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.numpy_utils import bilinear_interp, normalize_feature
+
+
+def bilinear_interp_ref(feat, xy_loc):
+    """Per-frame interpolation at the stored precision, as used before"""
+    dtype = feat.dtype
+    ul_loc = np.floor(xy_loc).astype(int)  # x,y
+    x = (xy_loc[:, 0] - ul_loc[:, 0])[:, None]  # (N, 1)
+    y = (xy_loc[:, 1] - ul_loc[:, 1])[:, None]  # (N, 1)
+    ul_loc = np.clip(ul_loc, 0, 110)  # clip
+    q11 = feat[ul_loc[:, 1], ul_loc[:, 0]]  # (N, 16)
+    q12 = feat[ul_loc[:, 1], ul_loc[:, 0] + 1]
+    q21 = feat[ul_loc[:, 1] + 1, ul_loc[:, 0]]
+    q22 = feat[ul_loc[:, 1] + 1, ul_loc[:, 0] + 1]
+    feat_samp = (
+        q11 * (1 - x) * (1 - y)
+        + q21 * (1 - x) * (y - 0)
+        + q12 * (x - 0) * (1 - y)
+        + q22 * (x - 0) * (y - 0)
+    )
+    feat_samp = feat_samp.astype(dtype)
+    return feat_samp
+
+
+def read_ref(feats, frameids, rand_xy, img_size):
+    feat_list = []
+    for frameid, xy in zip(frameids, rand_xy):
+        feat = bilinear_interp_ref(feats[frameid], xy / img_size * 112)
+        feat = feat / (np.linalg.norm(feat, axis=-1, keepdims=True) + 1e-6)
+        feat_list.append(feat.astype(np.float32))
+    return np.stack(feat_list, 0)
+
+
+def read_batch(feats, frameids, rand_xy, img_size):
+    feat = bilinear_interp(feats, rand_xy / img_size * 112, frameid=frameids)
+    return normalize_feature(feat)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_frames", type=int, default=64)
+    parser.add_argument("--img_size", type=int, default=256)
+    parser.add_argument("--imgs_per_batch", type=int, default=32)
+    parser.add_argument("--pixels_per_image", type=int, default=4096)
+    parser.add_argument("--num_iters", type=int, default=50)
+    args = parser.parse_args()
+
+    feats = np.random.randn(args.num_frames, 112, 112, 16).astype(np.float16)
+    batches = []
+    for _ in range(args.num_iters):
+        frameids = np.random.randint(args.num_frames, size=args.imgs_per_batch)
+        rand_xy = np.random.randint(
+            args.img_size, size=(args.imgs_per_batch, args.pixels_per_image, 2)
+        )
+        batches.append((frameids, rand_xy))
+
+    num_samples = args.num_iters * args.imgs_per_batch * args.pixels_per_image
+    print("%-30s %20s" % ("method", "time/sample (ns)"))
+    results = {}
+    for name, fn in [("per-frame, float16", read_ref), ("batched, float32", read_batch)]:
+        start = time.time()
+        results[name] = [fn(feats, f, xy, args.img_size) for f, xy in batches]
+        total_time = time.time() - start
+        print("%-30s %20.1f" % (name, total_time / num_samples * 1e9))
+
+    max_diff = max(
+        np.abs(a - b).max() for a, b in zip(*[results[k] for k in results.keys()])
+    )
+    print("max abs difference: %.2e" % max_diff)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+# Benchmark random pixel sampling from per-modality .npy files, a packed
+# row-major file, and a packed tiled file, on a synthetic video.
+# python scripts/benchmark_pixel_sampling.py
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from dataloader.data_utils import MmapArray, load_packed, mmap_pool
+from utils.pack_utils import PAGE_SIZE, write_pack
+
+
+def make_video(num_frames, img_size):
+    """Synthetic per-frame data with the dtypes written by extract_crop"""
+    shape = (num_frames, img_size, img_size)
+    arrays = {
+        "rgb": np.random.rand(*shape, 3).astype(np.float16),
+        "mask": np.random.rand(*shape, 2) > 0.5,
+        "depth": np.random.rand(*shape).astype(np.float16),
+        "flowfw_1": np.random.rand(num_frames - 1, img_size, img_size, 3).astype(
+            np.float16
+        ),
+    }
+    frame_ids = {k: np.arange(len(v)) for k, v in arrays.items()}
+    return arrays, frame_ids
+
+
+def page_faults():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_minflt + usage.ru_majflt
+
+
+def touched_pages(entry, xy):
+    """Set of 4KB pages read when gathering pixels from a frame entry"""
+    if isinstance(entry, np.ndarray):
+        array = entry
+        index = (xy[:, 1], xy[:, 0])
+    else:  # TiledView
+        array = entry.tiles
+        ty, iy = np.divmod(xy[:, 1], entry.tile_size)
+        tx, ix = np.divmod(xy[:, 0], entry.tile_size)
+        index = (ty, tx, iy, ix)
+    address = array.__array_interface__["data"][0]
+    offsets = sum(i * stride for i, stride in zip(index, array.strides))
+    first_page = (address + offsets) // PAGE_SIZE
+    last_page = (address + offsets + array.strides[len(index) - 1] - 1) // PAGE_SIZE
+    return set(first_page.tolist()) | set(last_page.tolist())
+
+
+def run(mmap_list, xy_fn, num_frames, num_iters):
+    """Gather all modalities at sampled pixels of random frames. The pool is
+    cleared before each batch, so touched pages are mapped again per batch.
+    """
+    faults = 0
+    pages = 0
+    start = time.time()
+    for _ in range(num_iters):
+        mmap_pool.clear()
+        frameid = np.random.randint(num_frames - 1)
+        xy = xy_fn()
+        faults_start = page_faults()
+        for k, array in mmap_list.items():
+            array[frameid][xy[:, 1], xy[:, 0]]
+        faults += page_faults() - faults_start
+    total_time = time.time() - start
+
+    # count pages outside of the timed loop
+    for _ in range(10):
+        frameid = np.random.randint(num_frames - 1)
+        xy = xy_fn()
+        for k, array in mmap_list.items():
+            pages += len(touched_pages(array[frameid], xy))
+    return pages / 10, faults / num_iters, num_iters * len(xy) / total_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_frames", type=int, default=32)
+    parser.add_argument("--img_size", type=int, default=512)
+    parser.add_argument("--tile_size", type=int, default=16)
+    parser.add_argument("--pixels_per_image", type=int, default=4096)
+    parser.add_argument("--tiles_per_image", type=int, default=64)
+    parser.add_argument("--num_iters", type=int, default=200)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    arrays, frame_ids = make_video(args.num_frames, args.img_size)
+
+    # current layout: one .npy per modality
+    npy_list = {}
+    for k, array in arrays.items():
+        np.save("%s/%s.npy" % (tmpdir, k), array)
+        npy_list[k] = MmapArray("%s/%s.npy" % (tmpdir, k))
+
+    # packed layouts
+    write_pack("%s/rowmajor.npk" % tmpdir, arrays, frame_ids, args.num_frames)
+    write_pack(
+        "%s/tiled.npk" % tmpdir,
+        arrays,
+        frame_ids,
+        args.num_frames,
+        tile_size=args.tile_size,
+        tile_keys=list(arrays.keys()),
+    )
+    rowmajor_list = load_packed("%s/rowmajor.npk" % tmpdir)
+    tiled_list = load_packed("%s/tiled.npk" % tmpdir)
+    rowmajor_list["flowfw_1"] = rowmajor_list.pop("flowfw")[1]
+    tiled_list["flowfw_1"] = tiled_list.pop("flowfw")[1]
+
+    def sample_uniform():
+        rand_idx = np.random.permutation(args.img_size**2)[: args.pixels_per_image]
+        return np.stack([rand_idx // args.img_size, rand_idx % args.img_size], -1)
+
+    def sample_tiled():
+        tile_size = args.tile_size
+        num_tiles_x = args.img_size // tile_size
+        tile_idx = np.random.permutation(num_tiles_x**2)[: args.tiles_per_image]
+        samples_per_tile = -(-args.pixels_per_image // args.tiles_per_image)
+        inner_idx = np.argsort(np.random.rand(len(tile_idx), tile_size**2), -1)
+        inner_idx = inner_idx[:, :samples_per_tile]
+        y0 = (tile_idx // num_tiles_x)[:, None] * tile_size + inner_idx // tile_size
+        x0 = (tile_idx % num_tiles_x)[:, None] * tile_size + inner_idx % tile_size
+        return np.stack([x0.reshape(-1), y0.reshape(-1)], -1)
+
+    configs = [
+        ("npy, uniform", npy_list, sample_uniform),
+        ("packed row-major, uniform", rowmajor_list, sample_uniform),
+        ("packed tiled, uniform", tiled_list, sample_uniform),
+        ("packed tiled, tile sampling", tiled_list, sample_tiled),
+    ]
+    # page faults depend on kernel fault-around and large folios, so the
+    # number of distinct 4KB pages read per batch is reported as well
+    print(
+        "%-30s %15s %15s %15s"
+        % ("layout", "pages/batch", "faults/batch", "samples/sec")
+    )
+    for name, mmap_list, xy_fn in configs:
+        pages, faults, samples_per_sec = run(
+            mmap_list, xy_fn, args.num_frames, args.num_iters
+        )
+        print("%-30s %15.1f %15.1f %15.0f" % (name, pages, faults, samples_per_sec))
+
+
+if __name__ == "__main__":
+    main()
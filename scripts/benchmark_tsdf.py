@@ -0,0 +1,180 @@
+# Benchmark TSDF integration with the numba CPU path of fusion.TSDFVolume, the
+# torch path of TorchTSDFVolume and the block-sparse SparseTSDFVolume, with
+# float32 or compact voxel storage, on depth maps rendered from a synthetic
+# scene, and compare the fused volumes.
+# python scripts/benchmark_tsdf.py --voxel_sizes 0.05,0.02 --devices cpu,cuda
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../preprocess"))
+)
+sys.path.insert(
+    0,
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "../preprocess/third_party")),
+)
+
+import fusion
+from libs.tsdf import SparseTSDFVolume, TorchTSDFVolume
+
+
+def render_frames(num_frames, img_size, radius=1.0, distance=3.0):
+    """Render depth and color of a sphere on a ground plane, seen by cameras
+    on a circle around it
+
+    Returns:
+        colors (np.array): (N,H,W,3) Colors, uint8
+        depths (np.array): (N,H,W) Depths, 0 where nothing is hit
+        intr (np.array): (3,3) Camera intrinsics
+        poses (np.array): (N,4,4) Camera to world transforms
+    """
+    intr = np.array(
+        [[img_size, 0, img_size / 2], [0, img_size, img_size / 2], [0, 0, 1]]
+    )
+    x0, y0 = np.meshgrid(np.arange(img_size), np.arange(img_size))
+    rays = np.stack([x0, y0, np.ones_like(x0)], -1) @ np.linalg.inv(intr).T
+
+    colors, depths, poses = [], [], []
+    for it in range(num_frames):
+        angle = 2 * np.pi * it / num_frames
+        center = np.array([distance * np.sin(angle), -0.5, -distance * np.cos(angle)])
+        # look at the origin, y down
+        forward = -center / np.linalg.norm(center)
+        right = np.cross([0, 1, 0], forward)
+        right /= np.linalg.norm(right)
+        down = np.cross(forward, right)
+        pose = np.eye(4)
+        pose[:3, :3] = np.stack([right, down, forward], 1)
+        pose[:3, 3] = center
+
+        # ray casting, depth is the ray parameter since rays have z=1
+        dirs = rays @ pose[:3, :3].T
+        b = dirs @ center
+        a = np.sum(dirs**2, -1)
+        disc = b**2 - a * (center @ center - radius**2)
+        depth_sphere = np.where(disc > 0, (-b - np.sqrt(np.maximum(disc, 0))) / a, np.inf)
+        depth_plane = (radius - center[1]) / np.where(dirs[..., 1] > 0, dirs[..., 1], np.nan)
+        depth_plane = np.where(depth_plane > 0, depth_plane, np.inf)
+        depth = np.minimum(depth_sphere, depth_plane)
+        depth[~np.isfinite(depth) | (depth > distance + radius)] = 0
+
+        pts = center + dirs * depth[..., None]
+        color = np.clip((np.sin(pts * 4) + 1) * 127.5, 0, 255).astype(np.uint8)
+        colors.append(color)
+        depths.append(depth)
+        poses.append(pose)
+    return np.stack(colors), np.stack(depths), intr, np.stack(poses)
+
+
+def sparse_to_dense(tsdf_vol, vol_dim):
+    """Scatter the blocks of a SparseTSDFVolume into a dense TSDF volume"""
+    brick_coords, blocks = tsdf_vol.get_volume()[:2]
+    size = tsdf_vol.brick_size
+    pad_dim = -(-vol_dim // size) * size
+    dense = np.ones(pad_dim, dtype=np.float32)
+    for brick_coord, block in zip(brick_coords, blocks):
+        i, j, k = brick_coord
+        dense[i : i + size, j : j + size, k : k + size] = block
+    return dense[: vol_dim[0], : vol_dim[1], : vol_dim[2]]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_frames", type=int, default=32)
+    parser.add_argument("--img_size", type=int, default=256)
+    parser.add_argument("--voxel_sizes", type=str, default="0.05,0.02")
+    parser.add_argument("--devices", type=str, default="cpu")
+    parser.add_argument("--batch_size", type=int, default=8)
+    args = parser.parse_args()
+
+    colors, depths, intr, poses = render_frames(args.num_frames, args.img_size)
+    vol_bnds = np.zeros((3, 2))
+    for depth, pose in zip(depths, poses):
+        view_frust_pts = fusion.get_view_frustum(depth, intr, pose)
+        vol_bnds[:, 0] = np.minimum(vol_bnds[:, 0], np.amin(view_frust_pts, axis=1))
+        vol_bnds[:, 1] = np.maximum(vol_bnds[:, 1], np.amax(view_frust_pts, axis=1))
+
+    print(
+        "%-8s %-24s %12s %15s %15s %12s"
+        % ("voxel", "method", "time (s)", "voxels/sec", "differ (%)", "memory (MB)")
+    )
+    for voxel_size in [float(v) for v in args.voxel_sizes.split(",")]:
+        # numba path, compiled on a first frame outside of the timed loop
+        fusion.TSDFVolume(vol_bnds, voxel_size, use_gpu=False).integrate(
+            colors[0], depths[0], intr, poses[0]
+        )
+        tsdf_vol = fusion.TSDFVolume(vol_bnds, voxel_size, use_gpu=False)
+        num_voxels = np.prod(tsdf_vol._vol_dim)
+        start = time.time()
+        for color, depth, pose in zip(colors, depths, poses):
+            tsdf_vol.integrate(color, depth, intr, pose)
+        total_time = time.time() - start
+        reference = tsdf_vol.get_volume()[0]
+        # tsdf, weight and color volumes
+        dense_mem = 3 * reference.nbytes / 1e6
+        print(
+            "%-8g %-24s %12.2f %15.3g %15s %12.1f"
+            % (
+                voxel_size,
+                "numba",
+                total_time,
+                num_voxels * args.num_frames / total_time,
+                "-",
+                dense_mem,
+            )
+        )
+
+        for device in args.devices.split(","):
+            runs = [
+                ("torch %s, batch 1" % device, TorchTSDFVolume, {}, 1),
+                ("torch %s, batch %d" % (device, args.batch_size), TorchTSDFVolume, {}, args.batch_size),
+                ("torch %s, compact" % device, TorchTSDFVolume, {"compact": True}, args.batch_size),
+                ("sparse %s" % device, SparseTSDFVolume, {}, args.batch_size),
+                ("sparse %s, compact" % device, SparseTSDFVolume, {"compact": True}, args.batch_size),
+            ]
+            for name, volume_cls, kwargs, batch_size in runs:
+                tsdf_vol = volume_cls(vol_bnds, voxel_size, device=device, **kwargs)
+                start = time.time()
+                if volume_cls is SparseTSDFVolume:
+                    # blocks of all frames are allocated before integration,
+                    # as in tsdf_fusion
+                    tsdf_vol.allocate(depths, np.repeat(intr[None], len(depths), 0), poses)
+                for it in range(0, args.num_frames, batch_size):
+                    tsdf_vol.integrate_batch(
+                        colors[it : it + batch_size],
+                        depths[it : it + batch_size],
+                        np.repeat(intr[None], len(depths[it : it + batch_size]), 0),
+                        poses[it : it + batch_size],
+                    )
+                if device.startswith("cuda"):
+                    torch.cuda.synchronize()
+                total_time = time.time() - start
+                if volume_cls is SparseTSDFVolume:
+                    volume = sparse_to_dense(tsdf_vol, tsdf_vol._vol_dim)
+                else:
+                    volume = tsdf_vol.get_volume()[0]
+                # projections are rounded to pixels in float32 instead of
+                # float64, which changes a few voxels at pixel boundaries.
+                # Compact volumes round the TSDF to float16
+                tol = 2e-3 if tsdf_vol.compact else 1e-4
+                diff = np.abs(volume - reference) > tol
+                print(
+                    "%-8g %-24s %12.2f %15.3g %15.3g %12.1f"
+                    % (
+                        voxel_size,
+                        name,
+                        total_time,
+                        num_voxels * args.num_frames / total_time,
+                        100 * diff.mean(),
+                        tsdf_vol.memory() / 1e6,
+                    )
+                )
+
+if __name__ == "__main__":
+    main()
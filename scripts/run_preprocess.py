@@ -8,12 +8,13 @@ import sys
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
+from utils.dag_utils import StageGraph
 from utils.gpu_utils import gpu_map
 from preprocess.libs.io import run_bash_command
 from preprocess.scripts.download import download_seq
 from preprocess.scripts.camera_registration import camera_registration
 from preprocess.scripts.canonical_registration import canonical_registration
-from preprocess.scripts.crop import extract_crop
+from preprocess.scripts.crop import extract_crop_multi, pack_crop
 from preprocess.scripts.depth import extract_depth
 from preprocess.scripts.extract_dinov2 import extract_dinov2
 from preprocess.scripts.extract_frames import extract_frames
@@ -66,37 +67,286 @@ def run_extract_frames(seqname, outdir, infile, use_filter_frames):
         os.makedirs(outpath, exist_ok=True)
         run_bash_command(f"cp {imgpath}/* {outpath}/")
 
-def run_extract_priors_single(seqname, outdir, num_obj, vidname):
-    print("extracting priors (flow/depth): ", seqname)
-    # flow
-    for dframe in [1, 2, 4, 8]:
-        compute_flow(seqname, outdir, dframe)
-    # depth
-    extract_depth(seqname, vidname) 
+def build_frame_stages(graph, vidname, outdir, viddir, num_obj, obj_class_cam, use_filter_frames):
+    """Add frame extraction and config stages, which determine the videos"""
+    seqdir = outdir + "/%s/Full-Resolution/%s"
+    frame_stages = []
+    for counter, infile in enumerate(sorted(glob.glob("%s/*" % viddir))):
+        seqname = "%s-%04d" % (vidname, counter)
+        frame_stages.append(
+            graph.add(
+                "frames-%s" % seqname,
+                run_extract_frames,
+                (seqname, outdir, infile, use_filter_frames),
+                inputs=[infile],
+                outputs=["%s/*.jpg" % (seqdir % ("JPEGImages", seqname))],
+                group="frames",
+            ).name
+        )
+
+    graph.add(
+        "config-%s" % vidname,
+        write_config,
+        (vidname, num_obj, obj_class_cam, vidname),
+        inputs=["%s/*.jpg" % (seqdir % ("JPEGImages", "%s-[0-9]*" % vidname))],
+        outputs=["database/configs/%s.config" % vidname],
+        deps=frame_stages,
+        local=True,
+    )
+
+
+def build_prior_stages(
+    graph, vidname, outdir, seqnames, num_obj, text_prompt_seg, obj_class_cam, gpulist
+):
+    """Add per-video stages that compute priors, masks, crops, cameras and
+    features. Each stage declares the files it reads and writes, so only the
+    stages affected by a change are run again.
+    """
+    seqdir = outdir + "/%s/Full-Resolution/%s"
+    frames = lambda seqname: "%s/*.jpg" % (seqdir % ("JPEGImages", seqname))
+    masks = lambda seqname, obj_idx: "%s/[0-9]*-%02d.npy" % (
+        seqdir % ("Annotations", seqname),
+        obj_idx,
+    )
+    depths = lambda seqname: "%s/[0-9]*.npy" % (seqdir % ("Depth", seqname))
+    flows = lambda seqname, delta: [
+        "%s/[0-9]*.npy" % (seqdir % ("FlowFW_%d" % delta, seqname)),
+        "%s/[0-9]*.npy" % (seqdir % ("FlowBW_%d" % delta, seqname)),
+    ]
+    cameras = outdir + "/Cameras/Full-Resolution/%s/%s"
+    config = "config-%s" % vidname
+    delta_list = [1, 2, 4, 8]
+
+    # flow/depth, only once per video
+    for seqname in seqnames:
+        for delta in delta_list:
+            graph.add(
+                "flow%d-%s" % (delta, seqname),
+                compute_flow,
+                (seqname, outdir, delta),
+                inputs=[frames(seqname)],
+                outputs=flows(seqname, delta),
+                deps=["frames-%s" % seqname, config],
+                group="flow",
+            )
+    for seqname in seqnames:
+        graph.add(
+            "depth-%s" % seqname,
+            extract_depth,
+            (seqname, vidname),
+            inputs=[frames(seqname)],
+            outputs=[depths(seqname)],
+            deps=["frames-%s" % seqname, config],
+            group="depth",
+        )
+
+    raw_inputs = lambda seqname, obj_idx: [
+        frames(seqname),
+        masks(seqname, obj_idx),
+        depths(seqname),
+    ] + sum([flows(seqname, delta) for delta in delta_list], [])
+    raw_deps = lambda seqname: [
+        "flow%d-%s" % (delta, seqname) for delta in delta_list
+    ] + ["depth-%s" % seqname]
+
+    seg_stages = {}  # (seqname, obj_idx) -> stage that writes the masks
+    manual_stages = {}  # obj_idx -> stage that writes manual cameras, or None
+    for obj_idx in range(num_obj):
+        # segmentation masks. Manual masks are only annotated if missing, and
+        # masks edited later are picked up as changed inputs downstream
+        seg_stage = "seg-%02d" % obj_idx
+        # True: manually annotate object masks | False: use detect object based on text prompt
+        use_manual_segment = True #if text_prompt_seg[obj_idx] == "other" else False
+        if use_manual_segment:
+            graph.add(
+                seg_stage,
+                track_anything_gui,
+                (vidname, obj_idx),
+                inputs=[frames(seqname) for seqname in seqnames],
+                outputs=[masks(seqname, obj_idx) for seqname in seqnames],
+                deps=[config],
+                local=True,
+            )
+            for seqname in seqnames:
+                seg_stages[(seqname, obj_idx)] = seg_stage
+        else:
+            for seqname in seqnames:
+                graph.add(
+                    "%s-%s" % (seg_stage, seqname),
+                    track_anything_lab4d,
+                    (seqname, outdir, obj_idx, text_prompt_seg[obj_idx]),
+                    inputs=[frames(seqname)],
+                    outputs=[masks(seqname, obj_idx)],
+                    deps=["frames-%s" % seqname, config],
+                    group=seg_stage,
+                )
+                seg_stages[(seqname, obj_idx)] = "%s-%s" % (seg_stage, seqname)
+
+        # Manually adjust camera positions
+        # True: manually annotate camera for key frames
+        use_manual_cameras = True if ((obj_class_cam[obj_idx] == "other") or (obj_class_cam[obj_idx] == "arti")) else False
+        manual_stage = "manualcam-%02d" % obj_idx
+        manual_stages[obj_idx] = manual_stage if use_manual_cameras else None
+        if use_manual_cameras:
+            graph.add(
+                manual_stage,
+                run_manual_cameras,
+                (vidname, obj_idx),
+                inputs=[masks(seqname, obj_idx) for seqname in seqnames],
+                outputs=[cameras % ("*", "%02d-manual.json" % obj_idx)],
+                deps=[seg_stages[(seqname, obj_idx)] for seqname in seqnames],
+                local=True,
+            )
+
+    # crop around all objects and process flow, in one pass over each video
+    for seqname in seqnames:
+        graph.add(
+            "crop-%s" % seqname,
+            extract_crop_multi,
+            (seqname, crop_size, vidname, list(range(num_obj))),
+            inputs=sum([raw_inputs(seqname, obj_idx) for obj_idx in range(num_obj)], []),
+            outputs=[
+                "%s/%s-%d-%02d.npy"
+                % (seqdir % ("Annotations", seqname), prefix, crop_size, obj_idx)
+                for obj_idx in range(num_obj)
+                for prefix in ["crop", "full"]
+            ],
+            deps=raw_deps(seqname)
+            + [seg_stages[(seqname, obj_idx)] for obj_idx in range(num_obj)],
+            group="crop",
+        )
 
-def run_extract_priors_bg(seqname, outdir, num_obj, vidname):
-    print("extracting priors (bg_camera): ", seqname)
+    for obj_idx in range(num_obj):
+        # compute fg cameras
+        for seqname in seqnames:
+            graph.add(
+                "camera-%s-%02d" % (seqname, obj_idx),
+                camera_registration,
+                (seqname, crop_size, vidname, obj_idx),
+                inputs=raw_inputs(seqname, obj_idx),
+                outputs=[cameras % (seqname, "%02d.npy" % obj_idx)],
+                deps=raw_deps(seqname) + [seg_stages[(seqname, obj_idx)]],
+                group="camera-%02d" % obj_idx,
+            )
+        for seqname in seqnames:
+            deps = ["camera-%s-%02d" % (seqname, obj_idx)]
+            if manual_stages[obj_idx] is not None:
+                deps.append(manual_stages[obj_idx])
+            graph.add(
+                "canonical-%s-%02d" % (seqname, obj_idx),
+                canonical_registration,
+                (seqname, crop_size, vidname, obj_idx, obj_class_cam[obj_idx]),
+                inputs=[
+                    frames(seqname),
+                    masks(seqname, obj_idx),
+                    cameras % (seqname, "%02d.npy" % obj_idx),
+                    cameras % (seqname, "%02d-manual.json" % obj_idx),
+                ],
+                outputs=[cameras % (seqname, "fg-%02d-canonical.npy" % obj_idx)],
+                deps=deps,
+                group="canonical-%02d" % obj_idx,
+            )
+
+        # extract dinov2 features. The PCA basis is fit over all videos, so
+        # the features of all videos are recomputed together
+        dino_stage = "dinov2-%02d" % obj_idx
+        graph.add(
+            dino_stage,
+            extract_dinov2,
+            (vidname, crop_size, vidname, obj_idx),
+            inputs=sum(
+                [[frames(seqname), masks(seqname, obj_idx)] for seqname in seqnames], []
+            ),
+            outputs=[
+                "%s/%s-%d-dinov2-%02d.npy"
+                % (seqdir % ("Features", seqname), prefix, crop_size, obj_idx)
+                for seqname in seqnames
+                for prefix in ["crop", "full"]
+            ],
+            deps=[seg_stages[(seqname, obj_idx)] for seqname in seqnames],
+            local=True,
+            kwargs={"gpulist": gpulist},
+        )
+
+        # pack per-frame data into a single file per video
+        for seqname in seqnames:
+            for use_full in [0, 1]:
+                prefix = "%s-%d" % ("full" if use_full else "crop", crop_size)
+                graph.add(
+                    "pack%d-%s-%02d" % (use_full, seqname, obj_idx),
+                    pack_crop,
+                    (seqname, crop_size, vidname, use_full, obj_idx),
+                    inputs=[
+                        "%s/%s%s.npy" % (seqdir % (datatype, seqname), prefix, suffix)
+                        for datatype in ["JPEGImages", "Depth", "Normal"]
+                        + ["FlowFW_%d" % delta for delta in delta_list]
+                        + ["FlowBW_%d" % delta for delta in delta_list]
+                        for suffix in ["", "-%02d" % obj_idx]
+                    ]
+                    + [
+                        "%s/%s%s-%02d.npy" % (seqdir % ("Annotations", seqname), prefix, suffix, obj_idx)
+                        for suffix in ["", "-crop2raw", "-is_detected"]
+                    ]
+                    + [
+                        "%s/%s-dinov2-%02d.npy" % (seqdir % ("Features", seqname), prefix, obj_idx)
+                    ],
+                    outputs=[
+                        "%s/%s-%02d.npk" % (seqdir % ("Packed", seqname), prefix, obj_idx)
+                    ],
+                    deps=["crop-%s" % seqname, dino_stage],
+                    group="pack-%02d" % obj_idx,
+                )
 
     # compute bg cameras
-    camera_registration(seqname, crop_size, vidname, num_obj=num_obj)
-    tsdf_fusion(seqname, vidname, num_obj=num_obj)
-    
-def run_extract_priors_multi(seqname, vidname, obj_idx, num_obj, obj_class_cam):
-    print("extracting priors(crop, camera_fg, obj): ", seqname, obj_idx)
+    for seqname in seqnames:
+        bg_inputs = [frames(seqname), depths(seqname)]
+        bg_inputs += sum([flows(seqname, delta) for delta in delta_list], [])
+        bg_inputs += [masks(seqname, obj_idx) for obj_idx in range(num_obj)]
+        graph.add(
+            "bgcamera-%s" % seqname,
+            camera_registration,
+            (seqname, crop_size, vidname, None, num_obj),
+            inputs=bg_inputs,
+            outputs=[cameras % (seqname, "bg.npy")],
+            deps=raw_deps(seqname)
+            + [seg_stages[(seqname, obj_idx)] for obj_idx in range(num_obj)],
+            group="bgcamera",
+        )
+    for seqname in seqnames:
+        # bg.npy is updated in place
+        graph.add(
+            "tsdf-%s" % seqname,
+            tsdf_fusion,
+            (seqname, vidname, None, num_obj),
+            inputs=[frames(seqname), depths(seqname), cameras % (seqname, "bg.npy")]
+            + [masks(seqname, obj_idx) for obj_idx in range(num_obj)],
+            outputs=[cameras % (seqname, "mesh-test-centered.obj")],
+            deps=["bgcamera-%s" % seqname],
+            group="tsdf",
+        )
 
-    # crop around object and process flow
-    extract_crop(seqname, crop_size, vidname, 0, obj_idx) #0,1 crop/full
-    extract_crop(seqname, crop_size, vidname, 1, obj_idx)
 
-    # compute fg cameras
-    camera_registration(seqname, crop_size, vidname, obj_idx) 
-    canonical_registration(seqname, crop_size, vidname, obj_idx, obj_class_cam)
+def run_manual_cameras(vidname, obj_idx):
+    from preprocess.scripts.manual_cameras import manual_camera_interface
+
+    mesh_path = "database/mesh-templates/cat-pikachu-remeshed.obj"
+    manual_camera_interface(vidname, obj_idx, mesh_path)
 
 
 if __name__ == "__main__":
+    # --dry-run: print the stages that would run without running them
+    dry_run = "--dry-run" in sys.argv
+    if dry_run:
+        sys.argv.remove("--dry-run")
+    # --workers N: cpu workers per crop and camera registration stage. Read
+    # from the environment, so that it also applies to workers of gpu_map
+    if "--workers" in sys.argv:
+        idx = sys.argv.index("--workers")
+        os.environ["REACTO_WORKERS"] = sys.argv[idx + 1]
+        del sys.argv[idx : idx + 2]
     if len(sys.argv) != 6: ### need to change follow the input
         print(
-            f"Usage: python {sys.argv[0]} <vidname> <num_obj> <text_prompt_seg> <obj_class_cam> <gpulist>"
+            f"Usage: python {sys.argv[0]} <vidname> <num_obj> <text_prompt_seg> <obj_class_cam> <gpulist> [--dry-run] [--workers N]"
         )
         print(
             f"  Example: python {sys.argv[0]} 1 cat-pikachu-0 cat quad '0,1,2,3,4,5,6,7' "
@@ -122,63 +372,37 @@ if __name__ == "__main__":
     os.makedirs("tmp", exist_ok=True)
 
     # download the videos
-    download_seq(vidname)
+    if not dry_run:
+        download_seq(vidname)
 
-    # set up parallel extraction
-    frame_args = []
-    for counter, infile in enumerate(sorted(glob.glob("%s/*" % viddir))):
-        seqname = "%s-%04d" % (vidname, counter)
-        frame_args.append((seqname, outdir, infile, use_filter_frames))
+    # each stage records the hashes of its inputs in the manifest, and only
+    # runs again if they change
+    graph = StageGraph(
+        "%s/manifest.json" % outdir,
+        runner=lambda func, args: gpu_map(func, args, gpus=gpulist),
+        dry_run=dry_run,
+    )
 
     # extract frames and filter frames without motion: frame id is the time stamp
-    gpu_map(run_extract_frames, frame_args, gpus=gpulist)
-
     # write config
-    write_config(vidname, num_obj, obj_class_cam, vidname)
+    build_frame_stages(
+        graph, vidname, outdir, viddir, num_obj, obj_class_cam, use_filter_frames
+    )
+    graph.run()
 
     # read config
+    config_path = "database/configs/%s.config" % vidname
+    if not os.path.exists(config_path):
+        print("%s does not exist yet, cannot plan the remaining stages" % config_path)
+        exit()
     config = configparser.RawConfigParser()
-    config.read("database/configs/%s.config" % vidname)
-    seg_args = []
-    prior_args_single = []
-    prior_args_multi = []
+    config.read(config_path)
+    seqnames = []
     for vidid in range(len(config.sections()) - 1):
         seqname = config.get("data_%d" % vidid, "img_path").strip("/").split("/")[-1]
-        
-        prior_args_single.append((seqname, outdir, num_obj, vidname))
-        
-        for obj_idx in range(num_obj):
-            ### the anno needs obj_idx: mask, camera, feature
-            seg_args.append((seqname, outdir, obj_idx, text_prompt_seg[obj_idx]))
-            prior_args_multi.append((seqname, vidname, obj_idx, num_obj, obj_class_cam[obj_idx]))
-            # True: manually annotate object masks | False: use detect object based on text prompt
-            use_manual_segment = True #if text_prompt_seg[obj_idx] == "other" else False
-            # True: manually annotate camera for key frames
-            use_manual_cameras = True if ((obj_class_cam[obj_idx] == "other") or (obj_class_cam[obj_idx] == "arti")) else False
-            
-            if obj_idx == 0:
-                # extract flow/depth only once
-                gpu_map(run_extract_priors_single, prior_args_single, gpus=gpulist)
-                
-            # let the user specify the segmentation mask
-            if use_manual_segment:
-                track_anything_gui(vidname, obj_idx)
-            else:
-                gpu_map(track_anything_lab4d, seg_args, gpus=gpulist)
-        
-            # Manually adjust camera positions
-            if use_manual_cameras:
-                from preprocess.scripts.manual_cameras import manual_camera_interface
-
-                mesh_path = "database/mesh-templates/cat-pikachu-remeshed.obj"
-                manual_camera_interface(vidname, obj_idx, mesh_path)
-
-            # extract camera/crop
-            gpu_map(run_extract_priors_multi, prior_args_multi, gpus=gpulist)
-
-            # extract dinov2 features
-            extract_dinov2(vidname, crop_size, vidname, obj_idx, gpulist=gpulist)
-        
-        # extract bg para
-        gpu_map(run_extract_priors_bg, prior_args_single, gpus=gpulist)
-        
\ No newline at end of file
+        seqnames.append(seqname)
+
+    build_prior_stages(
+        graph, vidname, outdir, seqnames, num_obj, text_prompt_seg, obj_class_cam, gpulist
+    )
+    graph.run()
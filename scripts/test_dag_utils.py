@@ -0,0 +1,160 @@
+# Test the incremental StageGraph with stub stages on CPU: reruns after input
+# changes, --dry-run output, and failed stages that are not recorded.
+# python scripts/test_dag_utils.py, or pytest scripts/test_dag_utils.py
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.dag_utils import StageGraph
+from utils.gpu_utils import TaskError
+
+calls = []  # names of the stages that ran
+
+
+def copy_stage(name, src, dst):
+    calls.append(name)
+    with open(src) as f:
+        content = f.read()
+    with open(dst, "w") as f:
+        f.write(content)
+
+
+def failing_stage(name, dst):
+    calls.append(name)
+    with open(dst, "w") as f:
+        f.write("partial")
+    raise RuntimeError("stage crashed")
+
+
+def failing_runner(func, args_list):
+    """Run tasks like gpu_map, with the first task failing"""
+    errors, outputs = {}, []
+    for it, args in enumerate(args_list):
+        if it == 0:
+            calls.append(args[0])
+            errors[it] = "traceback"
+            outputs.append(None)
+        else:
+            outputs.append(func(*args))
+    raise TaskError(errors, outputs)
+
+
+def run_graph(tmpdir, dry_run=False, runner=None):
+    """Build and run a chain in -> a -> b, returning the printed log"""
+    path = lambda name: os.path.join(tmpdir, name)
+    graph = StageGraph(path("manifest.json"), runner=runner, dry_run=dry_run)
+    graph.add(
+        "a",
+        copy_stage,
+        ("a", path("in.txt"), path("a.txt")),
+        [path("in.txt")],
+        [path("a.txt")],
+    )
+    graph.add(
+        "b",
+        copy_stage,
+        ("b", path("a.txt"), path("b.txt")),
+        [path("a.txt")],
+        [path("b.txt")],
+        deps=["a"],
+    )
+    calls.clear()
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        graph.run()
+    return graph, log.getvalue()
+
+
+def test_incremental():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, "in.txt"), "w") as f:
+            f.write("0")
+        run_graph(tmpdir)
+        assert calls == ["a", "b"]
+
+        # nothing changed
+        _, log = run_graph(tmpdir)
+        assert calls == []
+        assert "[skip] a" in log and "[skip] b" in log
+
+        # a dry run only plans the changed stage and its downstream stages
+        with open(os.path.join(tmpdir, "in.txt"), "w") as f:
+            f.write("1")
+        _, log = run_graph(tmpdir, dry_run=True)
+        assert calls == []
+        assert "[plan] a (inputs changed" in log
+        assert "[plan] b (upstream a)" in log
+
+        run_graph(tmpdir)
+        assert calls == ["a", "b"]
+        with open(os.path.join(tmpdir, "b.txt")) as f:
+            assert f.read() == "1"
+
+        # missing outputs are written again
+        os.remove(os.path.join(tmpdir, "b.txt"))
+        run_graph(tmpdir)
+        assert calls == ["b"]
+
+
+def test_failed_local_stage():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = lambda name: os.path.join(tmpdir, name)
+        for _ in range(2):
+            graph = StageGraph(path("manifest.json"))
+            graph.add(
+                "fail", failing_stage, ("fail", path("out.txt")), [], [path("out.txt")]
+            )
+            graph.add(
+                "down",
+                copy_stage,
+                ("down", path("out.txt"), path("down.txt")),
+                [path("out.txt")],
+                [path("down.txt")],
+                deps=["fail"],
+            )
+            calls.clear()
+            with contextlib.redirect_stdout(io.StringIO()):
+                graph.run()
+            # the partial output does not count as done, and the stage runs again
+            assert calls == ["fail"]
+            assert graph.failed == {"fail", "down"}
+            assert "fail" not in graph.manifest["stages"]
+
+
+def test_failed_remote_task():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, "in.txt"), "w") as f:
+            f.write("0")
+        path = lambda name: os.path.join(tmpdir, name)
+        # both stages of one group go to the runner, the first one fails after
+        # its output already exists
+        with open(path("a.txt"), "w") as f:
+            f.write("stale")
+        graph = StageGraph(path("manifest.json"), runner=failing_runner)
+        for name in ["a", "c"]:
+            graph.add(
+                name,
+                copy_stage,
+                (name, path("in.txt"), path("%s.txt" % name)),
+                [path("in.txt")],
+                [path("%s.txt" % name)],
+                group="copy",
+            )
+        calls.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            graph.run()
+        assert calls == ["a", "c"]
+        assert graph.failed == {"a"}
+        assert "a" not in graph.manifest["stages"]
+        assert "c" in graph.manifest["stages"]
+
+
+if __name__ == "__main__":
+    test_incremental()
+    test_failed_local_stage()
+    test_failed_remote_task()
+    print("all tests passed")
@@ -0,0 +1,73 @@
+# Test gpu_map with CPU workers: outputs, retries, and workers that die before
+# reporting back to the calling process.
+# python scripts/test_gpu_utils.py, or pytest scripts/test_gpu_utils.py
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.gpu_utils import TaskError, gpu_map
+
+
+def square(x):
+    return x * x
+
+
+def exit_at_start(x):
+    # dies before any message of the worker can be flushed
+    os._exit(3)
+
+
+def exit_once(x, flag_path):
+    # the first attempt of task 0 dies, every other attempt succeeds
+    if x == 0 and not os.path.exists(flag_path):
+        open(flag_path, "w").close()
+        os._exit(3)
+    return x * x
+
+
+def raise_odd(x):
+    if x % 2 == 1:
+        raise ValueError("odd")
+    return x
+
+
+def test_outputs():
+    outs = gpu_map(square, [(i,) for i in range(6)], gpus=["cpu", "cpu"], verbose=False)
+    assert outs == [i * i for i in range(6)]
+
+
+def test_worker_exit():
+    try:
+        gpu_map(exit_at_start, [(i,) for i in range(4)], gpus=["cpu"], retries=0)
+    except TaskError as e:
+        assert sorted(e.errors.keys()) == [0, 1, 2, 3]
+    else:
+        assert False, "TaskError not raised"
+
+
+def test_worker_exit_retry():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        flag_path = os.path.join(tmpdir, "exited")
+        args = [(i, flag_path) for i in range(4)]
+        outs = gpu_map(exit_once, args, gpus=["cpu"], retries=1, verbose=False)
+        assert outs == [i * i for i in range(4)]
+
+
+def test_task_error():
+    try:
+        gpu_map(raise_odd, [(i,) for i in range(4)], gpus=["cpu"], verbose=False)
+    except TaskError as e:
+        assert sorted(e.errors.keys()) == [1, 3]
+        assert e.outputs == [0, None, 2, None]
+    else:
+        assert False, "TaskError not raised"
+
+
+if __name__ == "__main__":
+    test_outputs()
+    test_worker_exit()
+    test_worker_exit_retry()
+    test_task_error()
+    print("all tests passed")
@@ -0,0 +1,66 @@
+# Test that NpyWriter writes the same bytes as np.save(np.stack(...)) on small
+# synthetic sequences, with entries written in any order.
+# python scripts/test_npy_writer.py, or pytest scripts/test_npy_writer.py
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../preprocess"))
+)
+
+from libs.io import NpyWriter
+
+
+def make_sequences(length=5, size=12):
+    """Synthetic per-frame outputs of the crop stage"""
+    rng = np.random.default_rng(0)
+    return {
+        "rgb": rng.random((length, size, size, 3)).astype(np.float16),
+        "gray": rng.integers(0, 255, (length, size, size), dtype=np.uint8),
+        "mask": rng.random((length, size, size, 2)) > 0.5,
+        "flow": rng.normal(size=(length, size, size, 3)).astype(np.float32),
+        "crop2raw": rng.random((length, 4)),
+    }
+
+
+def check_bytes(entries, order):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ref_path = os.path.join(tmpdir, "ref.npy")
+        np.save(ref_path, np.stack(entries))
+
+        path = os.path.join(tmpdir, "sub", "out.npy")
+        writer = NpyWriter(path, len(entries))
+        for index in order:
+            writer.write(index, entries[index])
+        assert not os.path.exists(path)  # only renamed on close
+        writer.close()
+
+        with open(ref_path, "rb") as f:
+            ref_bytes = f.read()
+        with open(path, "rb") as f:
+            assert f.read() == ref_bytes
+        assert os.listdir(os.path.dirname(path)) == ["out.npy"]  # no tmp file
+
+
+def test_same_bytes():
+    for name, array in make_sequences().items():
+        entries = list(array)
+        check_bytes(entries, range(len(entries)))
+        check_bytes(entries, np.random.default_rng(1).permutation(len(entries)))
+
+
+def test_no_entry():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "out.npy")
+        NpyWriter(path, 3).close()
+        assert os.listdir(tmpdir) == []
+
+
+if __name__ == "__main__":
+    test_same_bytes()
+    test_no_entry()
+    print("all tests passed")
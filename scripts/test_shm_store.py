@@ -0,0 +1,101 @@
+# Test that SharedMemoryStore recovers the segments of a crashed run: partial
+# segments are recreated, complete ones are adopted and unlinked at exit.
+# python scripts/test_shm_store.py, or pytest scripts/test_shm_store.py
+import os
+import subprocess
+import sys
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from dataloader.data_utils import SharedMemoryStore
+
+
+def dead_pid():
+    """Pid of a process that has exited"""
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    return proc.pid
+
+
+def crashed_segment(name, src, ready):
+    """Leave a segment behind as a run killed during or after the copy would"""
+    size = SharedMemoryStore.header_size + src.nbytes
+    shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    offset = SharedMemoryStore.pid_offset
+    shm.buf[offset : offset + 8] = np.int64(dead_pid()).tobytes()
+    offset = SharedMemoryStore.header_size
+    dst = np.ndarray(src.shape, src.dtype, buffer=shm.buf, offset=offset)
+    dst[:] = src if ready else 0
+    shm.buf[0] = int(ready)
+    del dst
+    shm.close()
+
+
+def exists(name):
+    return os.path.exists("/dev/shm/%s" % name)
+
+
+def new_store():
+    store = SharedMemoryStore()
+    store.budget = 1 << 20
+    return store
+
+
+def test_partial_segment():
+    name = "test-%s" % uuid.uuid4().hex[:8]
+    src = np.arange(24, dtype=np.float32).reshape(4, 6)
+    crashed_segment(name, src, ready=False)
+
+    store = new_store()
+    shared = store.share(name, src, create=True, timeout=5)
+    assert shared is not None
+    assert np.array_equal(shared.array, src)
+    attached = new_store()
+    assert attached.attach(name, timeout=5)
+    del shared
+    store.unlink()
+    assert not exists(name)
+
+
+def test_complete_segment():
+    name = "test-%s" % uuid.uuid4().hex[:8]
+    src = np.arange(24, dtype=np.float32).reshape(4, 6)
+    crashed_segment(name, src, ready=True)
+
+    store = new_store()
+    shared = store.share(name, np.zeros_like(src), create=True, timeout=5)
+    # the data of the previous run is reused, not copied again
+    assert np.array_equal(shared.array, src)
+    assert store.created == [name]
+    del shared
+    store.unlink()
+    assert not exists(name)
+
+
+def test_attach_dead_creator():
+    name = "test-%s" % uuid.uuid4().hex[:8]
+    src = np.ones((2, 3), dtype=np.float32)
+    crashed_segment(name, src, ready=False)
+    # without a live creator, attach gives up after the timeout
+    store = new_store()
+    assert not store.attach(name, timeout=0.5)
+    assert name not in store.segments
+    # once a live process creates the segment again, attach succeeds
+    creator = new_store()
+    shared = creator.share(name, src, create=True, timeout=5)
+    assert store.attach(name, timeout=5)
+    del shared
+    creator.unlink()
+    assert not exists(name)
+
+
+if __name__ == "__main__":
+    test_partial_segment()
+    test_complete_segment()
+    test_attach_dead_creator()
+    print("all tests passed")
@@ -0,0 +1,141 @@
+# Test that VidDatasetDevice on CPU returns the same data as VidDataset for a
+# fixed numpy seed, on a small synthetic video.
+# python scripts/test_vidloader_device.py, or pytest scripts/test_vidloader_device.py
+import os
+import sys
+import tempfile
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from dataloader.vidloader import VidDataset, VidDatasetDevice
+
+num_frames, img_size, feat_size = 8, 16, 8
+prefix = "crop-%d" % img_size
+
+
+def write_video(root):
+    """Write the frame data of a synthetic video, returns the rgb list"""
+    rng = np.random.RandomState(0)
+    seqdir = "Full-Resolution/cat-00"
+    rgblist = []
+    for it in range(num_frames):
+        for dirname in ["JPEGImages", "JPEGImagesRaw"]:
+            path = os.path.join(root, dirname, seqdir, "%05d.jpg" % it)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+        rgblist.append(os.path.join(root, "JPEGImages", seqdir, "%05d.jpg" % it))
+
+    def save(dirname, name, array):
+        path = os.path.join(root, dirname, seqdir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.save(path, array)
+
+    shape = (num_frames, img_size, img_size)
+    save("JPEGImages", "%s-00.npy" % prefix, rng.rand(*shape, 3).astype(np.float16))
+    save("Annotations", "%s-00.npy" % prefix, rng.rand(*shape, 2) > 0.5)
+    save("Depth", "%s-00.npy" % prefix, rng.rand(*shape).astype(np.float16))
+    save("Normal", "%s-00.npy" % prefix, rng.rand(*shape, 3).astype(np.float16))
+    feature = rng.rand(num_frames, feat_size, feat_size, 16).astype(np.float16)
+    save("Features", "%s-dinov2-00.npy" % prefix, feature)
+    for delta in [1, 2, 4]:
+        for dirname in ["FlowFW_%d" % delta, "FlowBW_%d" % delta]:
+            flow = rng.rand(*shape, 3).astype(np.float16)
+            save(dirname, "%s-00.npy" % prefix, flow)
+    save("Annotations", "%s-crop2raw-00.npy" % prefix, rng.rand(num_frames, 4))
+    save("Annotations", "%s-is_detected-00.npy" % prefix, np.ones(num_frames, bool))
+    return rgblist
+
+
+def make_opts(pixels_per_image):
+    return {
+        "delta_list": [2, 4],
+        "field_type": "fg",
+        "data_prefix": prefix,
+        "feature_type": "dinov2",
+        "pixels_per_image": pixels_per_image,
+        "load_pair": True,
+        "eval_res": img_size,
+        "eval_cache": False,
+        "data_device": "cpu",
+    }
+
+
+def assert_same(data_dict, data_dict_device):
+    assert data_dict.keys() == data_dict_device.keys()
+    for k, v in data_dict.items():
+        v = np.asarray(v)
+        v_device = data_dict_device[k].numpy()
+        assert v.shape == v_device.shape, k
+        if k == "feature":  # float32 sums may round differently
+            assert np.allclose(v, v_device, atol=1e-6), k
+        else:
+            assert v.dtype == v_device.dtype, k
+            assert np.array_equal(v, v_device), k
+
+
+def check_same(pixels_per_image):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rgblist = write_video(tmpdir)
+        opts = make_opts(pixels_per_image)
+        dataset = VidDataset(opts, rgblist, 0, [1, 1, 0, 0], [img_size, img_size])
+        dataset_device = VidDatasetDevice(
+            opts, rgblist, 0, [1, 1, 0, 0], [img_size, img_size]
+        )
+
+        for index in range(len(dataset)):
+            # a single pair, read by `read_raw`
+            np.random.seed(index)
+            dataset.idx_sampler.init_queue()
+            data_dict = dataset.load_data(index)
+            np.random.seed(index)
+            dataset_device.idx_sampler.init_queue()
+            data_dict_device = dataset_device.sample_batch([index])
+            data_dict_device = {k: v[0] for k, v in data_dict_device.items()}
+            assert_same(data_dict, data_dict_device)
+
+        # a batch of pairs, read by `read_raw_batch`
+        indices = [0, 3, 4, 4, 6]
+        np.random.seed(0)
+        dataset.idx_sampler.init_queue()
+        data_dict = dataset.__getitems__(indices)
+        np.random.seed(0)
+        dataset_device.idx_sampler.init_queue()
+        assert_same(data_dict, dataset_device.sample_batch(indices))
+
+
+def test_same_data():
+    check_same(pixels_per_image=20)
+
+
+def test_more_pixels_than_image():
+    check_same(pixels_per_image=img_size * img_size + 1)
+
+
+def test_device_sampling():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rgblist = write_video(tmpdir)
+        for pixels_per_image in [20, 100, img_size * img_size + 1]:
+            opts = make_opts(pixels_per_image)
+            dataset_device = VidDatasetDevice(
+                opts, rgblist, 0, [1, 1, 0, 0], [img_size, img_size]
+            )
+            generator = torch.Generator().manual_seed(0)
+            num_samples = min(pixels_per_image, img_size * img_size)
+            xy = dataset_device.sample_xy_batch(5, generator=generator)
+            assert xy.shape == (5, num_samples, 2)
+            # no pixel is sampled twice within a frame
+            for xy_frame in xy:
+                assert len(torch.unique(xy_frame, dim=0)) == num_samples
+
+            data_dict = dataset_device.sample_batch([0, 5], generator=generator)
+            assert data_dict["rgb"].shape == (2, 2, num_samples, 3)
+
+
+if __name__ == "__main__":
+    test_same_data()
+    test_more_pixels_than_image()
+    test_device_sampling()
+    print("all tests passed")
@@ -0,0 +1,81 @@
+# Test that VidDataset reads packed entries only while they match the .npy
+# sources: same feature type, and no source modified after packing.
+# python scripts/test_vidloader_pack.py, or pytest scripts/test_vidloader_pack.py
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from dataloader.data_utils import MmapArray, PackedArray
+from dataloader.vidloader import VidDataset
+from test_vidloader_device import img_size, make_opts, write_video
+from utils.pack_utils import write_pack
+
+
+def pack_video(dataset, feature_type, meta=True):
+    """Pack the .npy files of a dataset as `pack_crop` does"""
+    dict_list = dataset.dict_list
+    paths = {k: dict_list[k] for k in ["rgb", "mask", "depth", "normal"]}
+    paths["feature"] = dict_list["feature"]
+    paths["flowfw_1"] = dataset.flow_path(dict_list["flowfw"], 1)
+    arrays = {k: np.load(path, mmap_mode="r") for k, path in paths.items()}
+    frame_ids = {k: np.arange(len(v)) for k, v in arrays.items()}
+    meta = {
+        "feature_type": feature_type,
+        "mtimes": {k: os.path.getmtime(path) for k, path in paths.items()},
+    } if meta else None
+    os.makedirs(os.path.dirname(dict_list["packed"]), exist_ok=True)
+    write_pack(dict_list["packed"], arrays, frame_ids, len(arrays["rgb"]), meta=meta)
+
+
+def load(rgblist):
+    opts = make_opts(pixels_per_image=20)
+    return VidDataset(opts, rgblist, 0, [1, 1, 0, 0], [img_size, img_size])
+
+
+def test_packed_fallback():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rgblist = write_video(tmpdir)
+        dataset = load(rgblist)
+        pack_video(dataset, "dinov2")
+        mmap_list = load(rgblist).mmap_list
+        assert isinstance(mmap_list["rgb"], PackedArray)
+        assert isinstance(mmap_list["feature"], PackedArray)
+        assert isinstance(mmap_list["flowfw"][1], PackedArray)
+        assert isinstance(mmap_list["flowfw"][2], MmapArray)  # not packed
+
+        # features of another type are read from .npy
+        pack_video(dataset, "cse")
+        mmap_list = load(rgblist).mmap_list
+        assert isinstance(mmap_list["rgb"], PackedArray)
+        assert isinstance(mmap_list["feature"], MmapArray)
+
+        # sources modified after packing are read from .npy
+        pack_video(dataset, "dinov2")
+        for k in ["depth", "flowfw"]:
+            path = dataset.dict_list[k]
+            if k == "flowfw":
+                path = dataset.flow_path(path, 1)
+            mtime = os.path.getmtime(path) + 10
+            os.utime(path, (mtime, mtime))
+        mmap_list = load(rgblist).mmap_list
+        assert isinstance(mmap_list["rgb"], PackedArray)
+        assert isinstance(mmap_list["depth"], MmapArray)
+        assert isinstance(mmap_list["flowfw"][1], MmapArray)
+        assert isinstance(mmap_list["flowbw"][1], MmapArray)
+
+        # without metadata, only sources newer than the packed file are stale
+        pack_video(dataset, "dinov2", meta=False)
+        mmap_list = load(rgblist).mmap_list
+        assert isinstance(mmap_list["rgb"], PackedArray)
+        assert isinstance(mmap_list["feature"], MmapArray)
+        assert isinstance(mmap_list["depth"], MmapArray)
+
+
+if __name__ == "__main__":
+    test_packed_fallback()
+    print("all tests passed")
@@ -0,0 +1,269 @@
+import glob
+import hashlib
+import json
+import os
+
+from utils.gpu_utils import TaskError
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """Compute the sha1 of a file's content
+
+    Args:
+        path (str): Path to a file
+        chunk_size (int): Number of bytes to read at once
+    Returns:
+        digest (str): Hex digest
+    """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class Stage:
+    """A preprocessing step with declared inputs and outputs
+
+    Args:
+        name (str): Unique name of the stage, e.g. "crop-cat-0000-00-0"
+        func (Function): Function to run
+        args (Tuple): Arguments to func, part of the stage key
+        inputs (List(str)): Glob patterns of files read by the stage
+        outputs (List(str)): Glob patterns of files written by the stage. Each
+            pattern must match at least one file after the stage has run
+        deps (List(str)): Names of upstream stages whose outputs are read
+        group (str or None): Stages of the same group run in one batch
+        local (bool): If True, run in the calling process instead of the
+            parallel runner, e.g. for interactive or self-parallel stages
+        kwargs (Dict): Keyword arguments to func that do not affect the
+            outputs, e.g. a list of gpus. Not part of the stage key
+    """
+
+    def __init__(
+        self,
+        name,
+        func,
+        args,
+        inputs,
+        outputs,
+        deps=(),
+        group=None,
+        local=False,
+        kwargs=None,
+    ):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.group = name if group is None else group
+        self.local = local
+        self.kwargs = {} if kwargs is None else kwargs
+
+    @property
+    def key(self):
+        """Identify the computation, changes if the function or arguments do"""
+        return "%s.%s%s" % (self.func.__module__, self.func.__qualname__, self.args)
+
+    def run(self):
+        return self.func(*self.args, **self.kwargs)
+
+
+class StageGraph:
+    """Incremental pipeline of stages. Each stage records the content hashes of
+    its inputs in a manifest when it finishes, and is only run again if its
+    key or an input changed, an output is missing, or an upstream stage runs.
+
+    Content hashes are cached in the manifest by (size, mtime), so unchanged
+    files are not read again.
+
+    Args:
+        manifest_path (str): Path to the json manifest
+        runner (Function or None): Maps (func, args_list) to a list of outputs,
+            e.g. a wrapper of `gpu_map`. Stages run sequentially if None
+        dry_run (bool): If True, only print the stages that would run
+    """
+
+    def __init__(self, manifest_path, runner=None, dry_run=False):
+        self.manifest_path = manifest_path
+        self.runner = runner
+        self.dry_run = dry_run
+        self.stages = {}
+        self.pending = []  # stages added since the last call to `run()`
+        self.planned = set()  # stages that ran, or would run in a dry run
+        self.failed = set()
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"stages": {}, "files": {}}
+
+    def add(self, name, func, args, inputs, outputs, **kwargs):
+        """Add a stage, see `Stage`. Dependencies must be added first"""
+        if name in self.stages:
+            raise ValueError("Duplicate stage %s" % name)
+        stage = Stage(name, func, args, inputs, outputs, **kwargs)
+        for dep in stage.deps:
+            if dep not in self.stages:
+                raise ValueError("Stage %s depends on unknown stage %s" % (name, dep))
+        self.stages[name] = stage
+        self.pending.append(name)
+        return stage
+
+    def hash_inputs(self, stage):
+        """Compute content hashes of all files matched by the input patterns
+
+        Args:
+            stage (Stage): Stage to hash
+        Returns:
+            hashes (Dict(str, str)): Maps each input file to its sha1
+        """
+        file_cache = self.manifest["files"]
+        hashes = {}
+        for pattern in stage.inputs:
+            for path in sorted(glob.glob(pattern)):
+                if not os.path.isfile(path):
+                    continue
+                stat = os.stat(path)
+                cached = file_cache.get(path)
+                if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+                    hashes[path] = cached[2]
+                else:
+                    hashes[path] = hash_file(path)
+                    file_cache[path] = [stat.st_size, stat.st_mtime_ns, hashes[path]]
+        return hashes
+
+    def outputs_exist(self, stage):
+        return all(len(glob.glob(pattern)) > 0 for pattern in stage.outputs)
+
+    def reason(self, stage):
+        """Check whether a stage needs to run
+
+        Args:
+            stage (Stage): Stage to check
+        Returns:
+            reason (str or None): Why the stage needs to run, or None if it is
+                up to date
+        """
+        for dep in stage.deps:
+            if self.dry_run and dep in self.planned:
+                return "upstream %s" % dep
+
+        record = self.manifest["stages"].get(stage.name)
+        if record is None:
+            return "never run"
+        if record["key"] != stage.key:
+            return "arguments changed"
+        if not self.outputs_exist(stage):
+            return "missing outputs"
+        hashes = self.hash_inputs(stage)
+        if hashes != record["inputs"]:
+            paths = set(hashes.keys()) | set(record["inputs"].keys())
+            changed = [k for k in paths if hashes.get(k) != record["inputs"].get(k)]
+            return "inputs changed: %s" % ", ".join(sorted(changed)[:3])
+        return None
+
+    def run(self):
+        """Run all pending stages in the order they were added. Consecutive
+        stages of the same group are batched into one call of the runner.
+        """
+        groups = []
+        for name in self.pending:
+            stage = self.stages[name]
+            if len(groups) > 0 and groups[-1][0].group == stage.group:
+                assert groups[-1][0].func == stage.func
+                groups[-1].append(stage)
+            else:
+                groups.append([stage])
+        self.pending = []
+
+        for group in groups:
+            todo = []
+            for stage in group:
+                failed_deps = [dep for dep in stage.deps if dep in self.failed]
+                if len(failed_deps) > 0:
+                    print("[fail] %s (upstream %s failed)" % (stage.name, failed_deps[0]))
+                    self.failed.add(stage.name)
+                    continue
+                reason = self.reason(stage)
+                if reason is None:
+                    print("[skip] %s" % stage.name)
+                    continue
+                print("[%s] %s (%s)" % ("plan" if self.dry_run else "run", stage.name, reason))
+                todo.append(stage)
+            self.planned |= {stage.name for stage in todo}
+            if self.dry_run or len(todo) == 0:
+                continue
+
+            self.run_group(todo)
+            for stage in todo:
+                if stage.name in self.failed:
+                    self.manifest["stages"].pop(stage.name, None)
+                else:
+                    self.finish(stage)
+            self.save()
+
+    def run_group(self, stages):
+        """Run a batch of stages, local stages in this process and the others
+        with the runner. Stages that raise are added to `self.failed`, and are
+        not recorded even if they wrote some of their outputs
+
+        Args:
+            stages (List(Stage)): Stages to run
+        """
+        remote = []
+        for stage in stages:
+            if stage.local or self.runner is None:
+                try:
+                    stage.run()
+                except Exception as e:
+                    print("[error] %s: %s" % (stage.name, e))
+                    self.failed.add(stage.name)
+            else:
+                remote.append(stage)
+
+        # stages of a group share the function. The runner only passes
+        # positional arguments
+        if len(remote) > 0:
+            try:
+                self.runner(remote[0].func, [stage.args for stage in remote])
+            except TaskError as e:
+                for it in e.errors.keys():
+                    print("[error] %s" % remote[it].name)
+                    self.failed.add(remote[it].name)
+            except Exception as e:
+                # the runner failed as a whole, no stage is known to be done
+                print("[error] %s" % e)
+                self.failed |= {stage.name for stage in remote}
+
+    def finish(self, stage):
+        """Record a stage that ran, if it wrote its outputs
+
+        Args:
+            stage (Stage): Stage that ran
+        """
+        if not self.outputs_exist(stage):
+            print("[error] %s did not write its outputs" % stage.name)
+            self.failed.add(stage.name)
+            self.manifest["stages"].pop(stage.name, None)
+            return
+        # inputs are hashed after the run, since a stage may update its own
+        # inputs in place
+        self.manifest["stages"][stage.name] = {
+            "key": stage.key,
+            "inputs": self.hash_inputs(stage),
+        }
+
+    def save(self):
+        """Write the manifest atomically"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.manifest_path)), exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (self.manifest_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
@@ -249,12 +249,15 @@ def compute_crop_params(mask, crop_factor=1.2, crop_size=256, use_full=False):
         use_full (bool): If True, return a full image
     """
     if use_full or mask.min() < 0:  # no crop if no mask
-        mask = np.ones_like(mask)
+        xid = np.array([0, mask.shape[1] - 1])
+        yid = np.array([0, mask.shape[0] - 1])
         crop_factor = 1
+    else:
+        # bbox from the occupied rows and columns
+        mask = mask > 0
+        xid = np.flatnonzero(mask.any(0))
+        yid = np.flatnonzero(mask.any(1))
     # ss=time.time()
-    indices = np.where(mask > 0)
-    xid = indices[1]
-    yid = indices[0]
     center = ((xid.max() + xid.min()) // 2, (yid.max() + yid.min()) // 2)
     length = (
         (xid.max() - xid.min()) // 2,
@@ -1,128 +1,272 @@
 # Copyright (c) 2023 Jeff Tan, Carnegie Mellon University.
+import gc
+import itertools
 import multiprocessing
 import os
+import queue
+import time
+import traceback
+from collections import OrderedDict, deque
 
+import torch
 
-def gpu_map(func, args, gpus=None, method="static"):
-    """Map a function over GPUs
+# models cached by `cached_model()`, alive as long as the process, in least
+# recently used order: (model id, device, dtype) -> (model, bytes)
+_model_cache = OrderedDict()
+
+# fraction of the memory of a device that cached models may take, before the
+# least recently used ones are evicted
+MODEL_CACHE_FRACTION = 0.5
+
+
+class TaskError(RuntimeError):
+    """Raised by `gpu_map` if tasks still fail after all retries
+
+    Args:
+        errors (Dict(int, str)): Maps each failed task id to its traceback
+        outputs (List): Outputs of all tasks, None for failed tasks
+    """
+
+    def __init__(self, errors, outputs):
+        self.errors = errors
+        self.outputs = outputs
+        msg = "%d task(s) failed" % len(errors)
+        for it, tb in sorted(errors.items()):
+            msg += "\n--- task %d ---\n%s" % (it, tb)
+        super().__init__(msg)
+
+
+def cached_model(model_id, constructor, device="cuda", dtype=None):
+    """Return a model cached in the current process, loading it on first use.
+    Models are keyed by (model id, device, dtype), so that all stages and
+    sequences that run in the same process, e.g. on the same worker of
+    `gpu_map`, share one copy. When the models cached on a device take more
+    than `MODEL_CACHE_FRACTION` of its memory, the least recently used ones are
+    evicted. If loading runs out of GPU memory, the other models on the device
+    are evicted and loading is retried.
+
+    Args:
+        model_id (str): Name of the model, e.g. a torch.hub entry or checkpoint
+        constructor (Function): Called without arguments to load the model on
+            `device`, with `dtype`
+        device (str or torch.device): Device of the model
+        dtype (torch.dtype or None): Data type of the model, None if default
+    Returns:
+        model: Cached model
+    """
+    device = torch.device(device)
+    if device.type == "cuda" and device.index is None:
+        device = torch.device("cuda", torch.cuda.current_device())
+    key = (model_id, str(device), str(dtype))
+    if key in _model_cache:
+        _model_cache.move_to_end(key)
+        return _model_cache[key][0]
+
+    try:
+        model = constructor()
+    except torch.cuda.OutOfMemoryError:
+        evict_models(device, 0)
+        model = constructor()
+    _model_cache[key] = (model, model_bytes(model))
+    evict_models(device, MODEL_CACHE_FRACTION * device_memory(device), keep=key)
+    return model
+
+
+def evict_models(device, max_bytes, keep=None):
+    """Evict the least recently used models cached on a device, until the
+    remaining ones take at most `max_bytes`
+
+    Args:
+        device (torch.device): Device of the models
+        max_bytes (float): Maximum number of bytes of the cached models
+        keep (Tuple or None): Key of a model that is never evicted
+    """
+    keys = [k for k in _model_cache.keys() if k[1] == str(device)]
+    total = sum(_model_cache[k][1] for k in keys)
+    evicted = False
+    for key in keys:
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        total -= _model_cache.pop(key)[1]
+        evicted = True
+        print("cached_model: evicted %s from %s" % (key[0], key[1]))
+    if evicted:
+        gc.collect()
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+
+
+def model_bytes(model):
+    """Number of bytes of the parameters and buffers of a model. Objects that
+    are not modules, e.g. predictors that wrap networks, are searched one level
+    deep for modules
+    """
+    if isinstance(model, torch.nn.Module):
+        modules = [model]
+    else:
+        attrs = getattr(model, "__dict__", {}).values()
+        modules = [v for v in attrs if isinstance(v, torch.nn.Module)]
+    tensors = {}
+    for module in modules:
+        for tensor in itertools.chain(module.parameters(), module.buffers()):
+            tensors[id(tensor)] = tensor
+    return sum(t.numel() * t.element_size() for t in tensors.values())
+
+
+def device_memory(device):
+    """Total memory of a device in bytes, system memory for the CPU"""
+    if device.type == "cuda":
+        return torch.cuda.get_device_properties(device).total_memory
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def gpu_map(func, args, gpus=None, retries=1, verbose=True):
+    """Map a function over GPUs with a pool of persistent workers. One worker
+    process is started per device, and each worker is sent its next task as
+    soon as it becomes idle, so uneven workloads are balanced. Tasks are
+    assigned by the calling process, which therefore knows the task of a
+    worker that dies. Failed tasks are retried, and tracebacks are raised in
+    the calling process.
 
     Args:
         func (Function): Function to parallelize
-        args (List(Tuple)): List of argument tuples, to split evenly over GPUs
-        gpus (List(int) or None): Optional list of GPU device IDs to use
-        method (str): Either "static" or "dynamic" (default "static").
-            Static assignment is the fastest if workload per task is balanced;
-            dynamic assignment better handles tasks with uneven workload.
+        args (List(Tuple)): List of argument tuples, one per task
+        gpus (List(int or str) or None): Optional list of devices to use. Use
+            "cpu" for workers without a GPU. Defaults to all visible GPUs, or a
+            single CPU worker if there is none
+        retries (int): Number of times a failed task is run again
+        verbose (bool): If True, print the run time of each task
     Returns:
         outs (List): List of outputs
+    Raises:
+        TaskError: If some tasks failed after all retries, once all other
+            tasks are done
     """
     mp = multiprocessing.get_context("spawn")  # spawn allows CUDA usage
     devices = os.getenv("CUDA_VISIBLE_DEVICES")
-    outputs = None
 
     # Compute list of GPUs
     if gpus is None:
         if devices is None:
-            num_gpus = int(os.popen("nvidia-smi -L | wc -l").read())
+            num_gpus = int(os.popen("nvidia-smi -L 2>/dev/null | wc -l").read())
             gpus = list(range(num_gpus))
         else:
-            gpus = [int(n) for n in devices.split(",")]
+            gpus = [int(n) for n in devices.split(",") if n != ""]
+        if len(gpus) == 0:
+            gpus = ["cpu"]
+    if len(args) == 0:
+        return []
 
-    # Map arguments over GPUs using static or dynamic assignment
-    try:
-        if method == "static":
-            # Interleave arguments across GPUs
-            args_by_rank = [[] for rank in range(len(gpus))]
-            for it, arg in enumerate(args):
-                args_by_rank[it % len(gpus)].append(arg)
-
-            # Spawn processes
-            spawned_procs = []
-            result_queue = mp.Queue()
-            for rank, gpu_id in enumerate(gpus):
-                # Environment variables get copied on process creation
-                os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu_id)
-                proc_args = (func, args_by_rank[rank], rank, result_queue)
-                proc = mp.Process(target=gpu_map_static_helper, args=proc_args)
-                proc.start()
-                spawned_procs.append(proc)
-
-            # Wait to finish
-            for proc in spawned_procs:
-                proc.join()
-
-            # Construct output list
-            outputs_by_rank = {}
-            while True:
-                try:
-                    rank, out = result_queue.get(block=False)
-                    outputs_by_rank[rank] = out
-                except multiprocessing.queues.Empty:
-                    break
-
-            outputs = []
-            for it in range(len(args)):
-                rank = it % len(gpus)
-                idx = it // len(gpus)
-                outputs.append(outputs_by_rank[rank][idx])
-
-        elif method == "dynamic":
-            gpu_queue = mp.Queue()
-            for gpu_id in gpus:
-                gpu_queue.put(gpu_id)
-
-            # Spawn processes as GPUs become available
-            spawned_procs = []
-            result_queue = mp.Queue()
-            for it, arg in enumerate(args):
-                # Take latest available gpu_id (blocking)
-                gpu_id = gpu_queue.get()
-
-                # Environment variables get copied on process creation
-                os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu_id)
-                proc_args = (func, arg, it, gpu_id, result_queue, gpu_queue)
-                proc = mp.Process(target=gpu_map_dynamic_helper, args=proc_args)
-                proc.start()
-                spawned_procs.append(proc)
-
-            # Wait to finish
-            for proc in spawned_procs:
-                proc.join()
-
-            # Construct output list
-            outputs_by_it = {}
-            while True:
-                try:
-                    it, out = result_queue.get(block=False)
-                    outputs_by_it[it] = out
-                except multiprocessing.queues.Empty:
-                    break
-
-            outputs = []
-            for it in range(len(args)):
-                outputs.append(outputs_by_it[it])
+    pending = deque(range(len(args)))  # task ids not assigned to a worker
+    result_queue = mp.Queue()
+    task_queues = {}  # rank -> queue of the tasks sent to that worker
+
+    def start_worker(rank):
+        # Environment variables get copied on process creation. A fresh task
+        # queue is used, as a worker that died may have left its queue locked
+        device = gpus[rank]
+        os.environ["CUDA_VISIBLE_DEVICES"] = "" if device == "cpu" else str(device)
+        task_queues[rank] = mp.Queue()
+        proc_args = (func, rank, task_queues[rank], result_queue)
+        proc = mp.Process(target=gpu_map_worker, args=proc_args)
+        proc.start()
+        return proc
+
+    outputs = [None] * len(args)
+    attempts = [0] * len(args)
+    num_done = 0
+    errors = {}
+    running = {}  # rank -> task id
+    workers = {}
 
+    def dispatch(rank):
+        # the task is recorded before the worker can see it
+        if rank not in running and len(pending) > 0:
+            it = pending.popleft()
+            running[rank] = it
+            task_queues[rank].put((it, args[it]))
+
+    def fail(it, rank, tb):
+        attempts[it] += 1
+        if attempts[it] <= retries:
+            print("gpu_map: task %d failed on device %s, retrying" % (it, gpus[rank]))
+            pending.append(it)
         else:
-            raise NotImplementedError
+            print("gpu_map: task %d failed on device %s\n%s" % (it, gpus[rank], tb))
+            errors[it] = tb
 
-    except Exception as e:
-        pass
+    try:
+        for rank in range(min(len(gpus), len(args))):
+            workers[rank] = start_worker(rank)
+            dispatch(rank)
 
-    # Restore env vars
+        while num_done + len(errors) < len(args):
+            try:
+                msg = result_queue.get(timeout=1)
+            except queue.Empty:
+                # restart workers that died, e.g. killed by the OOM killer
+                for rank, proc in workers.items():
+                    if proc.is_alive():
+                        continue
+                    it = running.pop(rank, None)
+                    if it is not None:
+                        fail(it, rank, "worker exited with code %s" % proc.exitcode)
+                    workers[rank] = start_worker(rank)
+                for rank in workers.keys():
+                    dispatch(rank)
+                continue
+
+            kind, rank, it = msg[:3]
+            if running.get(rank) != it:
+                # result of a worker that was declared dead, the task was
+                # already retried or failed
+                continue
+            del running[rank]
+            if kind == "done":
+                outputs[it] = msg[3]
+                num_done += 1
+                if verbose:
+                    print(
+                        "gpu_map: task %d/%d done on device %s in %.1fs"
+                        % (it + 1, len(args), gpus[rank], msg[4])
+                    )
+            elif kind == "error":
+                fail(it, rank, msg[3])
+            # a retried task may go to any idle worker
+            for rank in workers.keys():
+                dispatch(rank)
+
+    # Restore env vars and stop workers
     finally:
         if devices is not None:
             os.environ["CUDA_VISIBLE_DEVICES"] = devices
-        else:
+        elif "CUDA_VISIBLE_DEVICES" in os.environ:
             del os.environ["CUDA_VISIBLE_DEVICES"]
-        return outputs
-
+        for rank in workers.keys():
+            task_queues[rank].put(None)
+        for proc in workers.values():
+            proc.join(timeout=10)
+            if proc.is_alive():
+                proc.terminate()
 
-def gpu_map_static_helper(func, args, rank, result_queue):
-    out = [func(*arg) for arg in args]
-    result_queue.put((rank, out))
+    if len(errors) > 0:
+        raise TaskError(errors, outputs)
+    return outputs
 
 
-def gpu_map_dynamic_helper(func, arg, it, gpu_id, result_queue, gpu_queue):
-    out = func(*arg)
-    gpu_queue.put(gpu_id)
-    result_queue.put((it, out))
+def gpu_map_worker(func, rank, task_queue, result_queue):
+    """Run the tasks sent to this worker until a None task is received"""
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        it, arg = task
+        start = time.time()
+        try:
+            out = func(*arg)
+        except Exception:
+            result_queue.put(("error", rank, it, traceback.format_exc()))
+            continue
+        result_queue.put(("done", rank, it, out, time.time() - start))
\ No newline at end of file
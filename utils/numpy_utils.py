@@ -105,29 +105,51 @@ def pca_numpy(raw_data, n_components):
     return apply_pca_fn
 
 
-def bilinear_interp(feat, xy_loc):
-    """Sample from a 2D feature map using bilinear interpolation
+def bilinear_interp(feat, xy_loc, frameid=None):
+    """Sample from a 2D feature map using bilinear interpolation. Only the
+    gathered pixels are converted to float32
 
     Args:
-        feat: (H,W,x) Input feature map
-        xy_loc: (N,2) Coordinates to sample, float
+        feat: (H,W,x) Input feature map, or (F,H,W,x) stack of feature maps
+        xy_loc: (N,2) Coordinates to sample, float. (M,N,2) if frameid is given
+        frameid: (M,) Feature map to sample for each row of xy_loc, if feat is
+            a stack of feature maps
     Returns:
-        feat_samp: (N,x) Sampled features
+        feat_samp: (N,x) or (M,N,x) Sampled features, float32
     """
-    dtype = feat.dtype
+    h, w = feat.shape[-3:-1]
     ul_loc = np.floor(xy_loc).astype(int)  # x,y
-    x = (xy_loc[:, 0] - ul_loc[:, 0])[:, None]  # (N, 1)
-    y = (xy_loc[:, 1] - ul_loc[:, 1])[:, None]  # (N, 1)
-    ul_loc = np.clip(ul_loc, 0, 110)  # clip
-    q11 = feat[ul_loc[:, 1], ul_loc[:, 0]]  # (N, 16)
-    q12 = feat[ul_loc[:, 1], ul_loc[:, 0] + 1]
-    q21 = feat[ul_loc[:, 1] + 1, ul_loc[:, 0]]
-    q22 = feat[ul_loc[:, 1] + 1, ul_loc[:, 0] + 1]
-    feat_samp = (
-        q11 * (1 - x) * (1 - y)
-        + q21 * (1 - x) * (y - 0)
-        + q12 * (x - 0) * (1 - y)
-        + q22 * (x - 0) * (y - 0)
-    )
-    feat_samp = feat_samp.astype(dtype)
+    x = (xy_loc[..., 0] - ul_loc[..., 0])[..., None].astype(np.float32)  # (N, 1)
+    y = (xy_loc[..., 1] - ul_loc[..., 1])[..., None].astype(np.float32)  # (N, 1)
+    ul_x = np.clip(ul_loc[..., 0], 0, w - 2)  # clip
+    ul_y = np.clip(ul_loc[..., 1], 0, h - 2)
+
+    if isinstance(feat, np.ndarray) and feat.flags.c_contiguous:
+        # gather all four corners with a single take on the flattened maps
+        ul_idx = ul_y * w + ul_x
+        if frameid is not None:
+            ul_idx = ul_idx + np.asarray(frameid)[:, None] * (h * w)
+        corner_idx = np.stack([ul_idx, ul_idx + 1, ul_idx + w, ul_idx + w + 1], 0)
+        feat_flat = feat.reshape((-1,) + feat.shape[-1:])
+        q11, q12, q21, q22 = np.take(feat_flat, corner_idx, axis=0).astype(np.float32)
+    else:
+        index = () if frameid is None else (np.asarray(frameid)[:, None],)
+        q11 = feat[index + (ul_y, ul_x)].astype(np.float32)  # (N, 16)
+        q12 = feat[index + (ul_y, ul_x + 1)].astype(np.float32)
+        q21 = feat[index + (ul_y + 1, ul_x)].astype(np.float32)
+        q22 = feat[index + (ul_y + 1, ul_x + 1)].astype(np.float32)
+    feat_samp = (q11 * (1 - x) + q12 * x) * (1 - y) + (q21 * (1 - x) + q22 * x) * y
     return feat_samp
+
+
+def normalize_feature(feat, eps=1e-6):
+    """Normalize features to unit length along the last axis
+
+    Args:
+        feat: (...,x) Input features, float32
+        eps (float): Added to the norm to avoid division by zero
+    Returns:
+        feat: (...,x) Normalized features, float32
+    """
+    norm = np.sqrt(np.einsum("...i,...i->...", feat, feat))
+    return feat / (norm[..., None] + eps)
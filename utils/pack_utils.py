@@ -0,0 +1,224 @@
+import json
+
+import numpy as np
+
+PACK_MAGIC = b"REACTOPK"
+PACK_ALIGN = 64  # alignment of each array entry, in bytes
+PAGE_SIZE = 4096  # alignment of each frame record, in bytes
+
+
+def align_offset(offset, alignment):
+    """Round an offset up to the next multiple of alignment
+
+    Args:
+        offset (int): Byte offset
+        alignment (int): Alignment in bytes
+    Returns:
+        offset (int): Aligned byte offset
+    """
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def tile_view(buffer, offset, shape, dtype, tile_size, tile_stride):
+    """Strided view of a tiled (H,W,...) entry, where tile (ty,tx) of the entry
+    starts at `offset + (ty * num_tiles_x + tx) * tile_stride` and stores its
+    (tile_size, tile_size, ...) pixels contiguously
+
+    Args:
+        buffer: Buffer holding the tiles, e.g. a memmap of the packed file
+        offset (int): Byte offset of the first tile of the entry
+        shape (List(int)): (H,W,...) shape of the entry
+        dtype (np.dtype): Data type of the entry
+        tile_size (int): Side length of a tile, in pixels
+        tile_stride (int): Byte distance between consecutive tiles
+    Returns:
+        tiles (np.array): (H/tile_size, W/tile_size, tile_size, tile_size, ...)
+            View into the buffer
+    """
+    dtype = np.dtype(dtype)
+    shape = tuple(shape)
+    num_tiles_y = shape[0] // tile_size
+    num_tiles_x = shape[1] // tile_size
+    inner_shape = (tile_size, tile_size) + shape[2:]
+    inner_strides = np.empty(inner_shape, dtype=dtype).strides
+    tiles = np.ndarray(
+        (num_tiles_y, num_tiles_x) + inner_shape,
+        dtype=dtype,
+        buffer=buffer,
+        offset=offset,
+        strides=(num_tiles_x * tile_stride, tile_stride) + inner_strides,
+    )
+    return tiles
+
+
+def to_tiles(image, tile_size):
+    """Split an image into tiles
+
+    Args:
+        image (np.array): (H,W,...) Image, H and W divisible by tile_size
+        tile_size (int): Side length of a tile, in pixels
+    Returns:
+        tiles (np.array): (H/tile_size, W/tile_size, tile_size, tile_size, ...)
+    """
+    h, w = image.shape[:2]
+    tiles = image.reshape(
+        (h // tile_size, tile_size, w // tile_size, tile_size) + image.shape[2:]
+    )
+    return np.swapaxes(tiles, 1, 2)
+
+
+def from_tiles(tiles):
+    """Merge tiles into an image, inverse of `to_tiles()`
+
+    Args:
+        tiles (np.array): (H/tile_size, W/tile_size, tile_size, tile_size, ...)
+    Returns:
+        image (np.array): (H,W,...) Image
+    """
+    num_tiles_y, num_tiles_x, tile_size = tiles.shape[:3]
+    image = np.swapaxes(tiles, 1, 2).reshape(
+        (num_tiles_y * tile_size, num_tiles_x * tile_size) + tiles.shape[4:]
+    )
+    return image
+
+
+def write_pack(
+    path, arrays, frame_ids, num_frames, tile_size=None, tile_keys=(), meta=None
+):
+    """Write per-frame arrays of a video into a single frame-major file.
+    All entries owned by frame i are stored contiguously in one page-aligned
+    record, so reading every modality of a frame touches adjacent pages.
+
+    With tiling, the (H,W,...) entries of `tile_keys` are split into
+    tile_size x tile_size tiles and all modalities of a tile are interleaved,
+    so gathering pixels from a few tiles reads a few contiguous byte ranges.
+
+    File layout: magic (8 bytes) | header size (uint64) | json header |
+    padding | frame record 0 | frame record 1 | ...
+
+    Args:
+        path (str): Output path
+        arrays (Dict(str, np.array)): Maps each key to a (L, ...) array of
+            entries, which may be a memmap
+        frame_ids (Dict(str, np.array)): Maps each key to a (L,) array of the
+            frame that owns each entry
+        num_frames (int): Number of frames in the video
+        tile_size (int or None): If given, store `tile_keys` as tiles
+        tile_keys (List(str)): Keys with (L,H,W,...) entries to store as tiles.
+            H and W must be divisible by tile_size and equal across keys
+        meta (Dict or None): Extra json-serializable metadata, stored in the
+            header under "meta"
+    """
+    if tile_size is None:
+        tile_keys = ()
+    for k in tile_keys:
+        shape = arrays[k].shape
+        assert shape[1] % tile_size == 0 and shape[2] % tile_size == 0
+        assert shape[1:3] == arrays[tile_keys[0]].shape[1:3]
+
+    # assign entries to frame records
+    entries_per_frame = [[] for _ in range(num_frames)]
+    for k, array in arrays.items():
+        for entry_id, frame_id in enumerate(frame_ids[k]):
+            entries_per_frame[frame_id].append((k, entry_id))
+
+    # compute offsets relative to the first record
+    index = {
+        k: {
+            "dtype": np.dtype(array.dtype).str,
+            "shape": list(array.shape[1:]),
+            "frame_ids": [int(i) for i in frame_ids[k]],
+            "offsets": [0] * len(array),
+        }
+        for k, array in arrays.items()
+    }
+    for k in tile_keys:
+        index[k]["tile_size"] = tile_size
+        index[k]["tile_strides"] = [0] * len(arrays[k])
+
+    offset = 0
+    tiled_size = [0] * num_frames  # size of the interleaved tiles of each record
+    for frame_id, entries in enumerate(entries_per_frame):
+        offset = align_offset(offset, PAGE_SIZE)
+        tiled_entries = [(k, i) for k, i in entries if k in tile_keys]
+        if len(tiled_entries) > 0:
+            shape = arrays[tiled_entries[0][0]].shape
+            num_tiles = (shape[1] // tile_size) * (shape[2] // tile_size)
+            tile_stride = 0
+            for k, entry_id in tiled_entries:
+                index[k]["offsets"][entry_id] = offset + tile_stride
+                tile_stride += arrays[k][entry_id].nbytes // num_tiles
+            for k, entry_id in tiled_entries:
+                index[k]["tile_strides"][entry_id] = tile_stride
+            tiled_size[frame_id] = tile_stride * num_tiles
+            offset += tiled_size[frame_id]
+
+        for k, entry_id in entries:
+            if k in tile_keys:
+                continue
+            offset = align_offset(offset, PACK_ALIGN)
+            index[k]["offsets"][entry_id] = offset
+            offset += arrays[k][entry_id].nbytes
+    data_size = offset
+
+    # header, padded such that records start at a page boundary
+    header = {"num_frames": num_frames, "arrays": index, "meta": meta or {}}
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = align_offset(len(PACK_MAGIC) + 8 + len(header_bytes), PAGE_SIZE)
+
+    with open(path, "wb") as f:
+        f.write(PACK_MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        f.truncate(data_start + data_size)
+        # write records sequentially
+        for frame_id, entries in enumerate(entries_per_frame):
+            if tiled_size[frame_id] > 0:
+                # interleave tiles of all modalities in memory, then write once
+                tiled_buffer = bytearray(tiled_size[frame_id])
+                tiled_start = None
+                for k, entry_id in entries:
+                    if k not in tile_keys:
+                        continue
+                    entry_offset = index[k]["offsets"][entry_id]
+                    if tiled_start is None:
+                        tiled_start = entry_offset
+                    tiles = tile_view(
+                        tiled_buffer,
+                        entry_offset - tiled_start,
+                        index[k]["shape"],
+                        arrays[k].dtype,
+                        tile_size,
+                        index[k]["tile_strides"][entry_id],
+                    )
+                    tiles[:] = to_tiles(arrays[k][entry_id], tile_size)
+                f.seek(data_start + tiled_start)
+                f.write(tiled_buffer)
+
+            for k, entry_id in entries:
+                if k in tile_keys:
+                    continue
+                f.seek(data_start + index[k]["offsets"][entry_id])
+                f.write(np.ascontiguousarray(arrays[k][entry_id]).tobytes())
+
+
+def read_pack_header(path):
+    """Read the index of a file written by `write_pack()`
+
+    Args:
+        path (str): Path to a packed file
+    Returns:
+        header (Dict): Maps "num_frames", "data_start", "arrays" and "meta" to
+            the file metadata. "arrays" maps each key to its dtype, per-entry
+            shape, owning frame ids, and byte offsets relative to "data_start".
+            "meta" is empty for files written without metadata
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(PACK_MAGIC))
+        if magic != PACK_MAGIC:
+            raise ValueError("Not a packed sample file: %s" % path)
+        header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_size).decode("utf-8"))
+    header.setdefault("meta", {})
+    header["data_start"] = align_offset(len(PACK_MAGIC) + 8 + header_size, PAGE_SIZE)
+    return header
@@ -173,3 +173,29 @@ def compress_state_with(state_dict, string):
     for key, value in state_dict.items():
         if string in key:
             state_dict[key] = value.mean(dim=0, keepdim=True)
+
+
+def bilinear_interp_batch(feat, frameid, xy_loc):
+    """Sample from a stack of 2D feature maps using bilinear interpolation
+
+    Args:
+        feat: (F,H,W,x) Input feature maps
+        frameid: (M,) Feature map to sample for each row of xy_loc
+        xy_loc: (M,N,2) Coordinates to sample, float
+    Returns:
+        feat_samp: (M,N,x) Sampled features, float32
+    """
+    h, w = feat.shape[1:3]
+    ul_loc = torch.floor(xy_loc).long()  # x,y
+    x = (xy_loc[..., 0] - ul_loc[..., 0])[..., None].float()  # (M, N, 1)
+    y = (xy_loc[..., 1] - ul_loc[..., 1])[..., None].float()  # (M, N, 1)
+    ul_x = ul_loc[..., 0].clamp(0, w - 2)  # clip
+    ul_y = ul_loc[..., 1].clamp(0, h - 2)
+    frameid = frameid[:, None]
+    q11 = feat[frameid, ul_y, ul_x].float()  # (M, N, x)
+    q12 = feat[frameid, ul_y, ul_x + 1].float()
+    q21 = feat[frameid, ul_y + 1, ul_x].float()
+    q22 = feat[frameid, ul_y + 1, ul_x + 1].float()
+    # same order of operations as numpy_utils.bilinear_interp
+    feat_samp = (q11 * (1 - x) + q12 * x) * (1 - y) + (q21 * (1 - x) + q22 * x) * y
+    return feat_samp